@@ -1,102 +1,265 @@
-from flask import Flask, request, jsonify, render_template, session, g
-from utils.ingestion import ingest_documents
-from utils.query_handler import get_query_answer
-from flask_caching import Cache
-from flask_session import Session
-from utils.vector_search import load_faiss_vector_store
-from utils.utils import process_chat_history
-import bmemcached
-import secrets
-import logging
-from utils.logging_config import setup_logging
-import os
-
-# Set the logging level to INFO or WARNING to reduce verbosity
-setup_logging(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-app = Flask(__name__)
-
-# Configure Memcached for session management
-app.config['SECRET_KEY'] = secrets.token_hex(16)  # Generates a 32-character hexadecimal string
-app.config['SESSION_TYPE'] = 'memcached'  # Use Memcached for session management
-app.config['SESSION_PERMANENT'] = False  # Session will not be permanent
-app.config['SESSION_USE_SIGNER'] = True  # Sign session to prevent tampering
-app.config['SESSION_KEY_PREFIX'] = 'chatbot_'  # Prefix to prevent key collisions
-
-# Configure Memcached server
-memcached_server = os.environ.get('MEMCACHED_SERVER', '127.0.0.1:11211')
-app.config['SESSION_MEMCACHED'] = bmemcached.Client([memcached_server])
-
-# Initialize session with Flask
-Session(app)
-
-# Cache configuration (optional, using simple cache here for quick access)
-cache = Cache(app, config={'CACHE_TYPE': 'simple'})
-
-# Load the FAISS vector store when the application starts
-with app.app_context():
-    vector_store, recognized_airlines  = load_faiss_vector_store()
-    if vector_store is None:
-        logger.warning('Vector store not found. Please ingest documents.')
-    else:
-        g.vector_store = vector_store
-        g.recognized_airlines = recognized_airlines
-
-@app.route('/')
-def home():
-    return render_template('index.html')
-
-@app.route('/ingest', methods=['POST'])
-def ingest():
-    try:
-        directory = request.form.get('directory', 'policies')  # Default to 'policies' directory
-        vector_store, recognized_airlines = ingest_documents(directory)
-        # Store in application context
-        g.vector_store = vector_store
-        g.recognized_airlines = recognized_airlines
-        return jsonify({'message': 'Documents ingested and embeddings generated successfully.'})
-    except Exception as e:
-        logger.error(f'Error during ingestion: {e}')
-        return jsonify({'error': 'Error during ingestion.'}), 500
-
-@app.route('/query', methods=['POST'])
-def query():
-    vector_store, recognized_airlines = load_faiss_vector_store()
-    if vector_store is None:
-        logger.warning('Vector store not found. Please ingest documents.')
-        return jsonify({'error': 'No documents ingested. Please run ingestion first.'}), 400
-    else:
-        g.vector_store = vector_store
-        g.recognized_airlines = recognized_airlines
-
-    data = request.json
-    query_text = data.get('question')
-    chat_history = data.get('chat_history', [])
-
-    try:
-        # Retrieve the session's chat history or initialize an empty list
-        session_chat_history = session.get('chat_history', [])
-
-        # Process chat history
-        processed_chat_history = process_chat_history(chat_history)
-        # Merge session chat history with the incoming one
-        processed_chat_history = session_chat_history + processed_chat_history
-
-        # Get the bot's answer
-        answer, source_documents, quick_replies = get_query_answer(
-            query_text, vector_store, processed_chat_history, recognized_airlines
-        )
-
-        # Update session chat history
-        processed_chat_history.append({'user': query_text, 'bot': answer})
-        session['chat_history'] = processed_chat_history[-5:]
-
-        # Return the answer and quick replies
-        return jsonify({'answer': answer, 'quickReplies': quick_replies})
-    except Exception as e:
-        logger.error(f'Error processing query: {e}')
-        return jsonify({'error': 'Error processing query.'}), 500
-
-if __name__ == '__main__':
+from flask import Flask, request, jsonify, render_template, session, Response, stream_with_context, g, url_for
+from utils.ingest_jobs import submit_ingest, wait_for_job, read_job, list_jobs, latest_job, start_runner
+from utils.query_handler import get_query_answer, stream_query_answer, llm_model
+from utils.context_builder import load_conversation, save_conversation, merge_history, record_turn
+from flask_session import Session
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from utils.store_registry import get_store
+from utils.utils import process_chat_history
+from utils.answer_cache import SemanticAnswerCache
+from utils import metrics
+from config import (
+    ANSWER_CACHE_ENABLED, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, SECRET_KEY,
+    METRICS_ENABLED, TRACE_SLOW_REQUEST_MS, TRACE_SAMPLE_RATE,
+    TRACE_PATH, TRACE_MAX_FILES
+)
+import bmemcached
+import secrets
+import logging
+import json
+from utils.logging_config import setup_logging
+import os
+
+# Set the logging level to INFO or WARNING to reduce verbosity
+setup_logging(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+# Configure Memcached for session management
+app.config['SECRET_KEY'] = SECRET_KEY or secrets.token_hex(16)  # Generates a 32-character hexadecimal string
+app.config['SESSION_TYPE'] = 'memcached'  # Use Memcached for session management
+app.config['SESSION_PERMANENT'] = False  # Session will not be permanent
+app.config['SESSION_USE_SIGNER'] = True  # Sign session to prevent tampering
+app.config['SESSION_KEY_PREFIX'] = 'chatbot_'  # Prefix to prevent key collisions
+
+# Configure Memcached server
+memcached_server = os.environ.get('MEMCACHED_SERVER', '127.0.0.1:11211')
+app.config['SESSION_MEMCACHED'] = bmemcached.Client([memcached_server])
+
+# Initialize session with Flask
+Session(app)
+
+REQUESTS = Counter('chatbot_requests_total', 'HTTP requests by endpoint and status', ['endpoint', 'method', 'status'])
+REQUEST_SECONDS = Histogram('chatbot_request_seconds', 'HTTP request latency, including streamed bodies', ['endpoint'])
+SESSION_SECONDS = Histogram('chatbot_session_seconds', 'Session store (Memcached) reads and writes', ['operation'])
+
+# Time every session read and write, so slow Memcached round trips show up in the metrics and traces
+app.session_interface = metrics.TimedSessionInterface(app.session_interface, SESSION_SECONDS)
+
+# Semantic answer cache, shared by all workers through the same Memcached server as the sessions
+answer_cache = SemanticAnswerCache(
+    app.config['SESSION_MEMCACHED'],
+    threshold=ANSWER_CACHE_THRESHOLD,
+    ttl=ANSWER_CACHE_TTL,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES
+) if ANSWER_CACHE_ENABLED else None
+
+# Load the FAISS vector store when the application starts; under gunicorn with preload_app this runs
+# once in the master and the workers share the loaded index
+if get_store() is None:
+    logger.warning('Vector store not found. Please ingest documents.')
+
+def endpoint_name():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_trace():
+    g.trace = metrics.start_trace(endpoint_name())
+
+def finish_request(trace):
+    REQUEST_SECONDS.labels(endpoint=trace.name).observe(trace.duration())
+    metrics.finish_trace(trace, TRACE_PATH, TRACE_SLOW_REQUEST_MS / 1000, TRACE_SAMPLE_RATE, TRACE_MAX_FILES)
+
+@app.after_request
+def count_request(response):
+    REQUESTS.labels(endpoint=endpoint_name(), method=request.method, status=response.status_code).inc()
+    # Streamed bodies are still being generated when the request context is torn down;
+    # finish their trace once the server has sent the whole body
+    if response.is_streamed and 'trace' in g:
+        trace = g.pop('trace')
+        response.call_on_close(lambda: finish_request(trace))
+    return response
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        finish_request(trace)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Metrics are disabled.'}), 404
+    registry = REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        # Under gunicorn: aggregate the values every worker and ingest job wrote to METRICS_PATH
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+@app.route('/')
+def home():
+    return render_template('index.html')
+
+@app.route('/ready')
+def ready():
+    # Readiness probe: ready once this worker has an index generation loaded
+    store = get_store()
+    if store is None:
+        return jsonify({'ready': False, 'reason': 'No documents ingested.'}), 503
+    return jsonify({
+        'ready': True,
+        'generation': store.generation,
+        'vectors': store.vector_store.index.ntotal,
+        'airlines': len(store.recognized_airlines),
+        'loadedAt': store.loaded_at
+    })
+
+@app.route('/ingest', methods=['POST'])
+def ingest():
+    # Queues a background ingest job and answers right away with its id; a request for a directory that
+    # already has a queued or running job gets that job. wait=true answers only once the job has finished.
+    directory = request.form.get('directory', 'policies')  # Default to 'policies' directory
+    wait = request.values.get('wait', 'false').lower() == 'true'
+    try:
+        job, coalesced = submit_ingest(directory)
+        if not wait:
+            return jsonify({
+                'message': 'Ingestion queued.',
+                'id': job['id'],
+                'state': job['state'],
+                'coalesced': coalesced,
+                'statusUrl': url_for('ingest_job', job_id=job['id'])
+            }), 202
+
+        job = wait_for_job(job['id'])
+        if job is None or job['state'] != 'done':
+            logger.error(f"Ingest job failed: {job and job['error']}")
+            return jsonify({'error': 'Error during ingestion.', 'id': job and job['id']}), 500
+        # The job ran in another process; swap the new generation in before answering
+        store = get_store(force=True)
+        return jsonify({
+            'message': 'Documents ingested and embeddings generated successfully.',
+            'id': job['id'],
+            'generation': store.generation if store else job['generation'],
+            'workersReloading': job['workersReloading'],
+            'stats': job['stats']
+        })
+    except Exception as e:
+        logger.error(f'Error during ingestion: {e}')
+        return jsonify({'error': 'Error during ingestion.'}), 500
+
+@app.route('/ingest/jobs/<job_id>')
+def ingest_job(job_id):
+    # Polling a job also restarts the queue if the process running it has exited
+    start_runner()
+    job = read_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown ingest job.'}), 404
+    return jsonify(job)
+
+@app.route('/ingest/jobs')
+def ingest_jobs():
+    return jsonify({'jobs': list_jobs()})
+
+@app.route('/ingest/status')
+def ingest_status():
+    # The newest job
+    start_runner()
+    return jsonify(latest_job() or {'state': 'idle'})
+
+@app.route('/query', methods=['POST'])
+def query():
+    # Hold on to this generation for the whole request, even if a newer one is published meanwhile
+    store = get_store()
+    if store is None:
+        logger.warning('Vector store not found. Please ingest documents.')
+        return jsonify({'error': 'No documents ingested. Please run ingestion first.'}), 400
+
+    data = request.json
+    query_text = data.get('question')
+    chat_history = data.get('chat_history', [])
+
+    try:
+        # The session holds the recent turns and a summary of older ones; merge in the client's history
+        # without the turns the session already has or has summarized
+        conversation = load_conversation(session)
+        processed_chat_history = merge_history(
+            conversation['turns'], process_chat_history(chat_history), conversation['summarized']
+        )
+
+        # Get the bot's answer
+        answer, source_documents, quick_replies, timings = get_query_answer(
+            query_text, store, processed_chat_history, answer_cache, conversation['summary']
+        )
+
+        # Update the session, folding the oldest turns into the summary when it grows too long
+        save_conversation(session, record_turn(conversation, processed_chat_history, query_text, answer, llm_model()))
+
+        # Return the answer and quick replies, with the per-stage timings (in milliseconds) as metadata
+        return jsonify({
+            'answer': answer,
+            'quickReplies': quick_replies,
+            'metadata': {'timings': {stage: round(seconds * 1000, 1) for stage, seconds in timings.items()}}
+        })
+    except Exception as e:
+        logger.error(f'Error processing query: {e}')
+        return jsonify({'error': 'Error processing query.'}), 500
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/query/stream', methods=['POST'])
+def query_stream():
+    store = get_store()
+    if store is None:
+        logger.warning('Vector store not found. Please ingest documents.')
+        return jsonify({'error': 'No documents ingested. Please run ingestion first.'}), 400
+
+    data = request.json
+    query_text = data.get('question')
+    chat_history = data.get('chat_history', [])
+
+    # Merge session chat history with the incoming one, as in /query
+    conversation = load_conversation(session)
+    processed_chat_history = merge_history(
+        conversation['turns'], process_chat_history(chat_history), conversation['summarized']
+    )
+
+    # Headers (including the session cookie) are sent before the body, so mark the session now;
+    # the finished turn is written to the session store at the end of the stream
+    save_conversation(session, conversation)
+
+    def generate():
+        try:
+            for event, payload in stream_query_answer(
+                query_text, store, processed_chat_history, answer_cache, conversation['summary']
+            ):
+                if event == 'token':
+                    yield format_sse('token', {'text': payload})
+                elif event == 'error':
+                    yield format_sse('error', payload)
+                else:
+                    answer = payload['answer']
+                    payload['metadata'] = {
+                        'timings': {stage: round(seconds * 1000, 1) for stage, seconds in payload.pop('timings').items()},
+                        'cached': payload.pop('cached')
+                    }
+                    yield format_sse('done', payload)
+
+                    # The client already has the answer, so summarizing old turns does not delay it
+                    save_conversation(session, record_turn(conversation, processed_chat_history, query_text, answer, llm_model()))
+                    app.session_interface.save_session(app, session, Response())
+        except Exception as e:
+            logger.error(f'Error streaming query: {e}')
+            yield format_sse('error', {'error': 'Error processing query.'})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
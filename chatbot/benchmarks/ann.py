@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+
+# Recall / latency / memory trade-off of the vector index types in utils.vector_search, measured against
+# exact (flat) search. Run from the chatbot directory:
+#   python -m benchmarks.ann --vectors 200000 --types flat sq ivf ivfpq hnsw --nprobe 4 16 64 --ef-search 32 128
+# --source store benchmarks the vectors of the index in STORAGE_PATH instead of a synthetic corpus.
+
+CHATBOT_DIR = Path(__file__).resolve().parent.parent
+
+def synthetic_vectors(count, dim, clusters, rng):
+    # Unit vectors drawn around random centers, so neighbourhoods look more like text embeddings than uniform noise
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)] + 0.35 * rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def store_vectors():
+    import faiss
+    from utils.vector_search import load_faiss_vector_store
+
+    vector_store, _ = load_faiss_vector_store(writable=True)
+    if vector_store is None:
+        raise SystemExit("No index found in STORAGE_PATH; run an ingest first or use --source synthetic")
+    index = vector_store.index
+    inner = faiss.downcast_index(index.index)
+    return inner.reconstruct_n(0, inner.ntotal), faiss.vector_to_array(index.id_map)
+
+def exact_neighbours(vectors, ids, queries, k, selector=None):
+    import faiss
+
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+    index.add_with_ids(vectors, ids)
+    params = faiss.SearchParameters(sel=selector) if selector is not None else None
+    return index.search(queries, k, params=params)[1]
+
+def recall_at_k(found, truth):
+    hits = sum(len(set(row[row >= 0]) & set(expected[expected >= 0])) for row, expected in zip(found, truth))
+    return hits / max(1, int((truth >= 0).sum()))
+
+def measure(index, queries, truth, k, selector=None, **search_options):
+    from benchmarks.run import percentiles
+    from utils.vector_search import search_parameters
+
+    params = search_parameters(index, selector, **search_options)
+    # One query per call, like the app does
+    latencies, found = [], []
+    for query in queries:
+        start = time.perf_counter()
+        labels = index.search(query.reshape(1, -1), k, params=params)[1]
+        latencies.append(time.perf_counter() - start)
+        found.append(labels[0])
+
+    start = time.perf_counter()
+    index.search(queries, k, params=params)
+    batch_seconds = time.perf_counter() - start
+    return {
+        'recall': recall_at_k(np.asarray(found), truth),
+        'latency': percentiles(latencies),
+        'batch_queries_per_second': len(queries) / batch_seconds if batch_seconds else 0.0,
+    }
+
+def benchmark_index_type(index_type, vectors, ids, queries, truth, filtered_truth, selector, args):
+    import faiss
+    from utils.vector_search import create_index, index_kind
+
+    start = time.perf_counter()
+    index = create_index(vectors.shape[1], vectors, index_type, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m)
+    train_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    index.add_with_ids(vectors, ids)
+    add_seconds = time.perf_counter() - start
+
+    index_bytes = int(faiss.serialize_index(index).nbytes)
+    result = {
+        'built': index_kind(index),
+        'train_seconds': train_seconds,
+        'add_seconds': add_seconds,
+        'index_bytes': index_bytes,
+        'bytes_per_vector': index_bytes / len(vectors),
+        'runs': [],
+    }
+
+    if result['built'].startswith('ivf'):
+        sweep = [('nprobe', value) for value in args.nprobe]
+    elif result['built'] == 'hnsw':
+        sweep = [('ef_search', value) for value in args.ef_search]
+    else:
+        sweep = [(None, None)]
+
+    for option, value in sweep:
+        search_options = {option: value} if option else {}
+        run = dict(search_options)
+        run['global'] = measure(index, queries, truth, args.k, **search_options)
+        run['filtered'] = measure(index, queries, filtered_truth, args.k, selector, **search_options)
+        result['runs'].append(run)
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Recall, latency and memory of the vector index types")
+    parser.add_argument('--source', choices=['synthetic', 'store'], default='synthetic')
+    parser.add_argument('--vectors', type=int, default=100000, help="synthetic corpus size")
+    parser.add_argument('--dim', type=int, default=1536, help="synthetic embedding dimension")
+    parser.add_argument('--clusters', type=int, default=200, help="synthetic topic clusters")
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--types', nargs='+', default=['flat', 'sq', 'ivf', 'ivfsq', 'ivfpq', 'hnsw'])
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--nlist', type=int, help="IVF lists (default: VECTOR_INDEX_NLIST or 4 * sqrt(vectors))")
+    parser.add_argument('--pq-m', type=int, help="PQ subquantizers (default: VECTOR_INDEX_PQ_M or dim / 16)")
+    parser.add_argument('--hnsw-m', type=int, help="HNSW neighbours per node (default: VECTOR_INDEX_HNSW_M)")
+    parser.add_argument('--filter-fraction', type=float, default=0.05,
+                        help="share of vectors a filtered search may return, like one airline's chunks")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results as JSON to this file (default: stdout)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.source == 'synthetic':
+        os.environ.setdefault('STORAGE_PATH', tempfile.mkdtemp(prefix='chatbot-ann-'))
+        os.environ.setdefault('OPENAI_API_KEY', 'benchmark-offline')
+    # Training and index builds must not fall back to flat for the corpus sizes benchmarked here
+    os.environ['VECTOR_INDEX_MIN_TRAIN'] = '0'
+    sys.path.insert(0, str(CHATBOT_DIR))
+
+    import faiss
+    from benchmarks.run import git_commit
+    from utils.vector_search import build_id_selector
+
+    rng = np.random.default_rng(args.seed)
+    if args.source == 'store':
+        vectors, ids = store_vectors()
+        queries = vectors[rng.choice(len(vectors), args.queries)] + 0.01 * rng.standard_normal((args.queries, vectors.shape[1])).astype(np.float32)
+    else:
+        data = synthetic_vectors(args.vectors + args.queries, args.dim, args.clusters, rng)
+        vectors, queries = data[:args.vectors], data[args.vectors:]
+        ids = np.arange(len(vectors), dtype=np.int64)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    filter_ids = np.sort(rng.choice(ids, max(args.k, int(len(ids) * args.filter_fraction)), replace=False))
+    selector = build_id_selector(filter_ids)
+    truth = exact_neighbours(vectors, ids, queries, args.k)
+    filtered_truth = exact_neighbours(vectors, ids, queries, args.k, selector)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'faiss': faiss.__version__,
+            'omp_threads': faiss.omp_get_max_threads(),
+            'vectors': len(vectors),
+            'dimension': vectors.shape[1],
+            'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        },
+        'results': {},
+    }
+    for index_type in args.types:
+        report['results'][index_type] = benchmark_index_type(
+            index_type, vectors, ids, queries, truth, filtered_truth, selector, args
+        )
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+
+# Throughput and chunk shape of the structure-aware chunker (utils.chunking) against the splitter it replaced:
+# Markdown rendered to HTML, flattened with BeautifulSoup and cut by a RecursiveCharacterTextSplitter built
+# for every file. Both run single-threaded over the same Markdown files. The previous splitter needs
+# markdown and beautifulsoup4, which are not app requirements any more. Run from the chatbot directory:
+#   python -m benchmarks.chunking --chunks 40000
+#   python -m benchmarks.chunking --source policies --unit chars tokens
+
+CHATBOT_DIR = Path(__file__).resolve().parent.parent
+# Chunks shorter than this carry too little text to be worth a retrieval slot
+SHORT_CHUNK_CHARS = 100
+
+def legacy_extract(file_path):
+    import markdown
+    from bs4 import BeautifulSoup
+
+    with open(file_path, 'r', encoding='utf-8') as file:
+        soup = BeautifulSoup(markdown.markdown(file.read()), 'html.parser')
+    links = [{'text': a.get_text(strip=True), 'url': a['href']} for a in soup.find_all('a', href=True)]
+    return soup.get_text(), links
+
+def legacy_split(text, chunk_size, chunk_overlap):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
+    )
+    return splitter.split_text(text)
+
+def chunk_shape(lengths):
+    values = np.asarray(lengths, dtype=np.float64)
+    if values.size == 0:
+        return {}
+    return {
+        'chunks': int(values.size),
+        'mean_chars': float(values.mean()),
+        'p10_chars': float(np.percentile(values, 10)),
+        'p50_chars': float(np.percentile(values, 50)),
+        'max_chars': float(values.max()),
+        'short_chunk_share': float((values < SHORT_CHUNK_CHARS).mean()),
+    }
+
+def run_legacy(files, chunk_size, chunk_overlap):
+    extract_seconds = split_seconds = 0.0
+    lengths = []
+    for file_path in files:
+        start = time.perf_counter()
+        text, _ = legacy_extract(file_path)
+        extract_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        lengths.extend(len(chunk) for chunk in legacy_split(text, chunk_size, chunk_overlap))
+        split_seconds += time.perf_counter() - start
+    return extract_seconds, split_seconds, lengths, None
+
+def run_structured(files, chunk_size, chunk_overlap, unit):
+    from utils.chunking import chunk_sections, get_splitter
+    from utils.file_loader import extract_markdown_sections
+
+    extract_seconds = split_seconds = 0.0
+    lengths = []
+    titled = 0
+    for file_path in files:
+        start = time.perf_counter()
+        sections, _ = extract_markdown_sections(file_path)
+        extract_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        chunks = chunk_sections(sections, get_splitter(chunk_size, chunk_overlap, unit))
+        split_seconds += time.perf_counter() - start
+        lengths.extend(len(chunk['text']) for chunk in chunks)
+        titled += sum(1 for chunk in chunks if chunk['title'])
+    return extract_seconds, split_seconds, lengths, titled
+
+def measure(run, files, characters, repeats):
+    # Best of repeats, so a cold page cache or a busy neighbour does not decide the result
+    best = None
+    for _ in range(repeats):
+        extract_seconds, split_seconds, lengths, titled = run()
+        if best is None or extract_seconds + split_seconds < best[0] + best[1]:
+            best = (extract_seconds, split_seconds, lengths, titled)
+    extract_seconds, split_seconds, lengths, titled = best
+    seconds = extract_seconds + split_seconds
+    result = {
+        'extract_seconds': extract_seconds,
+        'split_seconds': split_seconds,
+        'seconds': seconds,
+        'files_per_second': len(files) / seconds if seconds else 0.0,
+        'mb_per_second': characters / 1e6 / seconds if seconds else 0.0,
+        'chunks_per_second': len(lengths) / seconds if seconds else 0.0,
+    }
+    result.update(chunk_shape(lengths))
+    if titled is not None:
+        result['titled_chunk_share'] = titled / max(1, len(lengths))
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput of the structure-aware chunker against the previous splitter")
+    parser.add_argument('--source', choices=['synthetic', 'policies'], default='synthetic')
+    parser.add_argument('--chunks', type=int, default=20000, help="approximate number of chunks in the synthetic corpus")
+    parser.add_argument('--airlines', type=int, default=20)
+    parser.add_argument('--policies', default=str(CHATBOT_DIR / 'policies'), help="policies directory (seed or source)")
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--chunk-overlap', type=int, default=50)
+    parser.add_argument('--unit', nargs='+', choices=['chars', 'tokens'], default=['chars'],
+                        help="size units of the structure-aware chunker to measure")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results as JSON to this file (default: stdout)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ.setdefault('STORAGE_PATH', tempfile.mkdtemp(prefix='chatbot-chunking-'))
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark-offline')
+    sys.path.insert(0, str(CHATBOT_DIR))
+
+    from benchmarks.corpus import generate_corpus
+    from benchmarks.run import git_commit
+
+    workdir = None
+    if args.source == 'synthetic':
+        workdir = Path(tempfile.mkdtemp(prefix='chatbot-chunking-corpus-'))
+        generate_corpus(args.policies, workdir, args.chunks, args.airlines, args.seed)
+        root = workdir
+    else:
+        root = Path(args.policies)
+
+    try:
+        files = sorted(root.rglob('*.md'))
+        characters = sum(len(path.read_text(encoding='utf-8')) for path in files)
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'files': len(files),
+                'characters': characters,
+                'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+            },
+            'results': {
+                'legacy': measure(
+                    lambda: run_legacy(files, args.chunk_size, args.chunk_overlap), files, characters, args.repeats
+                ),
+            },
+        }
+        for unit in args.unit:
+            report['results'][f'structured_{unit}'] = measure(
+                lambda: run_structured(files, args.chunk_size, args.chunk_overlap, unit), files, characters, args.repeats
+            )
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import random
+import re
+from pathlib import Path
+
+# Characters of policy text per chunk after splitting (500-character chunks with 50 characters of overlap)
+CHARS_PER_CHUNK = 450
+TARGET_FILE_CHARS = 20000
+
+NUMBER_PATTERN = re.compile(r"\d+")
+
+def load_seed_documents(policies_dir):
+    seeds = []
+    for file_path in sorted(Path(policies_dir).rglob("*.md")):
+        text = file_path.read_text(encoding='utf-8')
+        paragraphs = [p for p in re.split(r"\n\s*\n", text) if p.strip()]
+        if paragraphs:
+            seeds.append((file_path.parent.name, file_path.stem, paragraphs))
+    if not seeds:
+        raise ValueError(f"No Markdown policy files found under {policies_dir}")
+    return seeds
+
+def vary_paragraph(paragraph, rng, source_airline, airline_name):
+    # Change fees and limits and swap the airline name, so chunks differ but read like real policies
+    paragraph = NUMBER_PATTERN.sub(lambda m: str(max(1, int(m.group()) + rng.randint(-5, 25))), paragraph)
+    return paragraph.replace(source_airline, airline_name)
+
+def generate_corpus(policies_dir, output_dir, target_chunks, airlines=20, seed=0):
+    # Scales the Markdown files of the policies/ tree up to roughly target_chunks chunks,
+    # written as <output_dir>/<Airline>/<Topic> <n>.md like the real tree
+    rng = random.Random(seed)
+    seeds = load_seed_documents(policies_dir)
+    output_dir = Path(output_dir)
+
+    target_chars = target_chunks * CHARS_PER_CHUNK
+    files_needed = max(airlines, -(-target_chars // TARGET_FILE_CHARS))
+    written_chars = 0
+    files = 0
+
+    for file_number in range(files_needed):
+        airline_name = f"Airline{file_number % airlines:03d}"
+        source_airline, topic, paragraphs = seeds[file_number % len(seeds)]
+        folder = output_dir / airline_name
+        folder.mkdir(parents=True, exist_ok=True)
+
+        parts = []
+        size = 0
+        while size < TARGET_FILE_CHARS and written_chars + size < target_chars:
+            paragraph = vary_paragraph(rng.choice(paragraphs), rng, source_airline, airline_name)
+            parts.append(paragraph)
+            size += len(paragraph) + 2
+        if not parts:
+            break
+
+        (folder / f"{topic} {file_number // airlines}.md").write_text("\n\n".join(parts), encoding='utf-8')
+        written_chars += size
+        files += 1
+
+    return {'files': files, 'airlines': min(airlines, files), 'characters': written_chars}
@@ -0,0 +1,75 @@
+import asyncio
+import re
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Any, Iterator, List, Optional
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+def hash_embedding(text, dim):
+    # Deterministic bag-of-words feature hashing: texts sharing words get similar unit vectors,
+    # so retrieval, airline filtering and the answer cache behave like they would with real embeddings
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in WORD_PATTERN.findall(text.lower()):
+        h = zlib.crc32(word.encode())
+        vector[h % dim] += 1.0 if (h >> 16) & 1 else -1.0
+    if not vector.any():
+        vector[zlib.crc32(text.encode()) % dim] = 1.0
+    return vector / np.linalg.norm(vector)
+
+# Stand-in for AsyncOpenAI: only client.embeddings.create(input=..., model=...) is used by utils.embeddings
+class FakeEmbeddingClient:
+    def __init__(self, dim=1536, latency=0.05, per_input_latency=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.per_input_latency = per_input_latency
+        self.calls = 0
+        self.inputs = 0
+        self.embeddings = self
+
+    async def create(self, input, model):
+        self.calls += 1
+        self.inputs += len(input)
+        await asyncio.sleep(self.latency + self.per_input_latency * len(input))
+        data = [
+            SimpleNamespace(index=i, embedding=hash_embedding(text, self.dim).tolist())
+            for i, text in enumerate(input)
+        ]
+        return SimpleNamespace(data=data)
+
+DEFAULT_ANSWER = (
+    "Checked bags on this airline cost $35 for the first bag and $45 for the second bag when you pay online. "
+    "Bags must weigh 50 pounds or less and measure no more than 62 linear inches.\n\n"
+    "Suggested Questions\n"
+    "- What are the fees for overweight bags?\n"
+    "- Can I bring a carry-on for free?\n"
+    "- Are bag fees waived for elite members?\n"
+)
+
+# Chat model with a configurable time to first token and per-token latency; supports invoke and stream
+class FakeStreamingChatModel(BaseChatModel):
+    answer: str = DEFAULT_ANSWER
+    first_token_latency: float = 0.3
+    token_latency: float = 0.01
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming-chat"
+
+    def _tokens(self):
+        return re.findall(r"\S+\s*|\s+", self.answer)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.first_token_latency + self.token_latency * len(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.first_token_latency)
+        for token in self._tokens():
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            time.sleep(self.token_latency)
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+
+# Offline benchmark harness. OpenAI is replaced by deterministic fakes, so results depend only on the code
+# and the machine. Run from the chatbot directory:
+#   python -m benchmarks.run --chunks 10000 --output results.json
+
+CHATBOT_DIR = Path(__file__).resolve().parent.parent
+SCENARIOS = ['ingest', 'index_load', 'retrieval', 'concurrent_retrieval', 'query']
+
+SAMPLE_QUESTIONS = [
+    "How much does a checked bag cost on {airline}?",
+    "Can I bring my dog in the cabin with {airline}?",
+    "What is the {airline} policy for lap infants?",
+    "Does {airline} charge for a carry-on bag?",
+    "What documents do I need to fly with my cat on {airline}?",
+    "How heavy can my checked bag be?",
+    "Can a child travel alone?",
+]
+
+def percentiles(samples):
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    if values.size == 0:
+        return {}
+    return {
+        'count': int(values.size),
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p90_ms': float(np.percentile(values, 90)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max()),
+    }
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=CHATBOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def configure_environment(args, storage_path):
+    # config.py reads the environment at import time, so this must run before any utils module is imported
+    os.environ['STORAGE_PATH'] = str(storage_path)
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark-offline')
+    os.environ['EMBEDDING_CACHE_ENABLED'] = 'true' if args.embedding_cache else 'false'
+    os.environ['ANSWER_CACHE_ENABLED'] = 'false'
+
+def install_fakes(args):
+    from benchmarks.fakes import FakeEmbeddingClient, FakeStreamingChatModel
+    from utils.embeddings import set_embedding_client
+    from utils.query_handler import set_llm
+    from utils.context_builder import set_summary_llm
+
+    embedding_client = FakeEmbeddingClient(dim=args.dim, latency=args.embed_latency_ms / 1000)
+    set_embedding_client(embedding_client)
+    chat_model = FakeStreamingChatModel(
+        first_token_latency=args.llm_first_token_ms / 1000,
+        token_latency=args.llm_token_ms / 1000
+    )
+    set_llm(chat_model)
+    set_summary_llm(chat_model)
+    return embedding_client
+
+def run_ingest(args, corpus_dir, embedding_client):
+    from utils.ingestion import ingest_documents
+
+    calls_before = embedding_client.calls
+    start = time.perf_counter()
+    _, recognized_airlines, stats = ingest_documents(corpus_dir)
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'chunks': stats['chunks'],
+        'chunks_per_second': stats['chunks'] / seconds if seconds else 0.0,
+        'airlines': len(recognized_airlines),
+        'embedding_requests': embedding_client.calls - calls_before,
+        'embedding_seconds': stats['embedding_seconds'],
+        'max_rss_mb': max_rss_mb(),
+        'stats': stats,
+    }
+
+def run_index_load(args):
+    from utils.vector_search import load_faiss_vector_store
+
+    samples = []
+    vectors = 0
+    rss_before = max_rss_mb()
+    for _ in range(args.load_repeats):
+        start = time.perf_counter()
+        vector_store, _ = load_faiss_vector_store()
+        samples.append(time.perf_counter() - start)
+        vectors = vector_store.index.ntotal
+        del vector_store
+    return {'vectors': vectors, 'latency': percentiles(samples), 'max_rss_growth_mb': max_rss_mb() - rss_before}
+
+def sample_questions(recognized_airlines, count, rng):
+    questions = []
+    for _ in range(count):
+        template = rng.choice(SAMPLE_QUESTIONS)
+        questions.append(template.format(airline=rng.choice(recognized_airlines)))
+    return questions
+
+def run_retrieval(args, rng):
+    from utils.store_registry import get_store
+    from utils.query_handler import analyze_question, retrieve_documents
+
+    store = get_store()
+    results = {}
+    for label, use_airline in (('global', False), ('airline_filtered', True)):
+        # Global questions name no airline, so nothing is detected and the whole index is searched
+        questions = sample_questions(store.recognized_airlines if use_airline else ['the airline'], args.queries, rng)
+        embed_samples, lexical_samples, search_samples = [], [], []
+        skipped = 0
+        for question in questions:
+            timings = {}
+            airline, query_embedding, lexical_hits = analyze_question(question, store, [], timings)
+            start = time.perf_counter()
+            retrieve_documents(query_embedding, store, airline, lexical_hits=lexical_hits)
+            search_samples.append(time.perf_counter() - start)
+            if 'embed' in timings:
+                embed_samples.append(timings['embed'])
+            else:
+                skipped += 1
+            if 'lexical' in timings:
+                lexical_samples.append(timings['lexical'])
+        results[label] = {
+            'embed': percentiles(embed_samples),
+            'lexical': percentiles(lexical_samples),
+            'search': percentiles(search_samples),
+            'embedding_skipped': skipped,
+        }
+    results['vectors'] = store.vector_store.index.ntotal
+    return results
+
+def run_concurrent_retrieval(args, rng, embedding_client):
+    # Question embedding and search of concurrent requests, with and without query micro-batching
+    from config import QUERY_BATCH_ENABLED
+    from utils.store_registry import get_store
+    from utils.query_handler import analyze_question, retrieve_documents
+    from utils.embeddings import query_embedding_batcher
+    from utils.vector_search import search_batcher
+
+    store = get_store()
+    questions = sample_questions(store.recognized_airlines, args.requests, rng)
+
+    def retrieve(question):
+        start = time.perf_counter()
+        airline, query_embedding, lexical_hits = analyze_question(question, store, [], {})
+        retrieve_documents(query_embedding, store, airline, lexical_hits=lexical_hits)
+        return time.perf_counter() - start
+
+    results = {}
+    for batched in (False, True):
+        query_embedding_batcher.enabled = search_batcher.enabled = batched
+        mode = results['batched' if batched else 'unbatched'] = {}
+        for concurrency in args.concurrency:
+            calls_before = embedding_client.calls
+            inputs_before = embedding_client.inputs
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                latencies = list(executor.map(retrieve, questions))
+            seconds = time.perf_counter() - start
+            calls = embedding_client.calls - calls_before
+            mode[str(concurrency)] = {
+                'requests': len(latencies),
+                'seconds': seconds,
+                'requests_per_second': len(latencies) / seconds if seconds else 0.0,
+                'latency': percentiles(latencies),
+                'embedding_requests': calls,
+                'questions_per_embedding_request': (embedding_client.inputs - inputs_before) / calls if calls else 0.0,
+            }
+    query_embedding_batcher.enabled = search_batcher.enabled = QUERY_BATCH_ENABLED
+
+    # Batched relative to unbatched; at low concurrency batching should cost nothing (ratios close to 1)
+    results['batched_vs_unbatched'] = {
+        level: {
+            'p50_ratio': batched['latency']['p50_ms'] / results['unbatched'][level]['latency']['p50_ms'],
+            'p99_ratio': batched['latency']['p99_ms'] / results['unbatched'][level]['latency']['p99_ms'],
+            'throughput_ratio': batched['requests_per_second'] / results['unbatched'][level]['requests_per_second'],
+        }
+        for level, batched in results['batched'].items()
+    }
+    return results
+
+def run_query(args, rng):
+    from utils.store_registry import get_store
+    import app as chatbot_app
+
+    client_app = chatbot_app.app
+    questions = sample_questions(get_store().recognized_airlines, args.requests, rng)
+
+    def send(question):
+        client = client_app.test_client()
+        start = time.perf_counter()
+        response = client.post('/query', json={'question': question, 'chat_history': []})
+        return time.perf_counter() - start, response.status_code
+
+    results = {}
+    for concurrency in args.concurrency:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(send, questions))
+        seconds = time.perf_counter() - start
+        results[str(concurrency)] = {
+            'requests': len(outcomes),
+            'errors': sum(1 for _, status in outcomes if status != 200),
+            'seconds': seconds,
+            'requests_per_second': len(outcomes) / seconds if seconds else 0.0,
+            'latency': percentiles([latency for latency, _ in outcomes]),
+        }
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline performance benchmarks for the airline policy chatbot")
+    parser.add_argument('--chunks', type=int, default=10000, help="approximate number of chunks in the synthetic corpus")
+    parser.add_argument('--airlines', type=int, default=20)
+    parser.add_argument('--dim', type=int, default=1536, help="embedding dimension of the fake embedding model")
+    parser.add_argument('--embed-latency-ms', type=float, default=50.0, help="latency of one fake embedding request")
+    parser.add_argument('--llm-first-token-ms', type=float, default=300.0)
+    parser.add_argument('--llm-token-ms', type=float, default=10.0)
+    parser.add_argument('--queries', type=int, default=200, help="queries for the retrieval scenario")
+    parser.add_argument('--requests', type=int, default=100, help="/query requests per concurrency level")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 16])
+    parser.add_argument('--load-repeats', type=int, default=5)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--embedding-cache', action='store_true', help="keep the on-disk embedding cache enabled")
+    parser.add_argument('--policies', default=str(CHATBOT_DIR / 'policies'), help="seed policies directory")
+    parser.add_argument('--workdir', help="directory for the corpus and index (default: a temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="keep the working directory afterwards")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results as JSON to this file (default: stdout)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='chatbot-bench-'))
+    corpus_dir = workdir / 'corpus'
+    storage_path = workdir / 'index'
+    storage_path.mkdir(parents=True, exist_ok=True)
+
+    configure_environment(args, storage_path)
+    sys.path.insert(0, str(CHATBOT_DIR))
+    rng = random.Random(args.seed)
+
+    from benchmarks.corpus import generate_corpus
+    embedding_client = install_fakes(args)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'workdir', 'keep')},
+        },
+        'results': {},
+    }
+
+    try:
+        start = time.perf_counter()
+        if not corpus_dir.exists():
+            report['meta']['corpus'] = generate_corpus(args.policies, corpus_dir, args.chunks, args.airlines, args.seed)
+        report['meta']['corpus_seconds'] = time.perf_counter() - start
+
+        # Every later scenario needs an index, so ingest always runs when no index exists yet
+        if 'ingest' in args.scenarios or not any(storage_path.iterdir()):
+            report['results']['ingest'] = run_ingest(args, corpus_dir, embedding_client)
+        if 'index_load' in args.scenarios:
+            report['results']['index_load'] = run_index_load(args)
+        if 'retrieval' in args.scenarios:
+            report['results']['retrieval'] = run_retrieval(args, rng)
+        if 'concurrent_retrieval' in args.scenarios:
+            report['results']['concurrent_retrieval'] = run_concurrent_retrieval(args, rng, embedding_client)
+        if 'query' in args.scenarios:
+            report['results']['query'] = run_query(args, rng)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,158 @@
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# Define any additional configuration here, e.g., file paths or API keys
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
-STORAGE_PATH = os.getenv("STORAGE_PATH")
-if not os.path.exists(STORAGE_PATH):
-    os.makedirs(STORAGE_PATH) 
-
-# File path for saving the FAISS index and documents
-FAISS_INDEX_PATH = STORAGE_PATH + '/faiss_index.index'
-DOCUMENTS_PATH = STORAGE_PATH + '/documents.pkl'
-DOCSTORE_MAPPING_PATH = STORAGE_PATH + '/index_to_docstore_id.pkl'
\ No newline at end of file
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Define any additional configuration here, e.g., file paths or API keys
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# Session signing key. Set it when workers are not forked from one preloaded master (or across restarts),
+# otherwise every process generates its own key and rejects the others' session cookies.
+SECRET_KEY = os.getenv("SECRET_KEY")
+
+STORAGE_PATH = os.getenv("STORAGE_PATH")
+if not os.path.exists(STORAGE_PATH):
+    os.makedirs(STORAGE_PATH) 
+
+# File path for saving the FAISS index and documents
+FAISS_INDEX_PATH = STORAGE_PATH + '/faiss_index.index'
+DOCUMENTS_PATH = STORAGE_PATH + '/documents.pkl'
+DOCSTORE_MAPPING_PATH = STORAGE_PATH + '/index_to_docstore_id.pkl'
+# Every ingest writes a new generation directory (memory-mapped compact format) under GENERATIONS_PATH.
+# GENERATION_PATH names the current one and is written last, so workers never see a partial write.
+# The pickle paths above are only read for indexes saved before the compact format.
+GENERATIONS_PATH = STORAGE_PATH + '/generations'
+GENERATION_PATH = STORAGE_PATH + '/generation'
+# Generation directories kept on disk, including the current one
+STORE_KEEP_GENERATIONS = max(1, int(os.getenv("STORE_KEEP_GENERATIONS", "2")))
+
+# How often (in seconds) a worker checks the index files on disk for a newer generation
+STORE_RELOAD_INTERVAL = float(os.getenv("STORE_RELOAD_INTERVAL", "5"))
+# Under gunicorn, replace the workers after an ingest so they share the new index from the master
+RELOAD_WORKERS_AFTER_INGEST = os.getenv("RELOAD_WORKERS_AFTER_INGEST", "true").lower() == "true"
+
+# Embedding model shared by ingestion, queries and the embedding cache key
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+
+# On-disk embedding cache, keyed by a hash of the model name and the text
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", STORAGE_PATH + '/embedding_cache')
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+
+# Per-file record of the last ingest (mtime, size, content hash, chunk ids) used for incremental re-ingestion
+MANIFEST_PATH = STORAGE_PATH + '/manifest.json'
+# Chunking: files are split on Markdown headings and PDF pages first, then on paragraphs, lines and sentences,
+# into chunks of at most CHUNK_SIZE characters, or embedding-model tokens with CHUNK_SIZE_UNIT=tokens. Pieces
+# of one long section overlap by CHUNK_OVERLAP. Changing these re-chunks every file on the next ingest.
+CHUNK_SIZE_UNIT = os.getenv("CHUNK_SIZE_UNIT", "chars").lower()
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+# Each chunk gets its KEYWORDS_PER_CHUNK top TF-IDF terms as keywords, weighted by document frequencies over the
+# whole corpus that are kept in KEYWORD_STATS_PATH and updated incrementally
+KEYWORDS_PER_CHUNK = int(os.getenv("KEYWORDS_PER_CHUNK", "5"))
+KEYWORD_STATS_PATH = STORAGE_PATH + '/keyword_stats.json'
+
+# Semantic answer cache in memcached: questions whose embedding is at least this cosine-similar
+# to an earlier one (same airline and index generation) get the earlier answer without an LLM call
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "200"))
+
+# Embedding requests: batches are packed up to these limits and sent with bounded, adaptive concurrency
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "8"))
+EMBEDDING_MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "100000"))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "1000"))
+EMBEDDING_MAX_INPUT_TOKENS = int(os.getenv("EMBEDDING_MAX_INPUT_TOKENS", "8191"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "8"))
+EMBEDDING_BACKOFF_BASE = float(os.getenv("EMBEDDING_BACKOFF_BASE", "1.0"))
+EMBEDDING_BACKOFF_MAX = float(os.getenv("EMBEDDING_BACKOFF_MAX", "60"))
+
+# Document extraction: PDF pages fan out over a process pool, and OCR pages go to a separate, smaller pool.
+# INGEST_CPUS (0 = all) caps the cores an ingest may use, and with it the default pool sizes.
+INGEST_CPUS = int(os.getenv("INGEST_CPUS", "0"))
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(INGEST_CPUS or os.cpu_count() or 1)))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(max(1, (INGEST_CPUS or os.cpu_count() or 1) // 2))))
+ENABLE_OCR = os.getenv("ENABLE_OCR", "false").lower() == "true"
+OCR_THRESHOLD = float(os.getenv("OCR_THRESHOLD", "0.1"))
+
+# Hybrid retrieval: BM25 and vector hits are merged with reciprocal rank fusion. When BM25 already found
+# results, the question embedding is awaited for at most HYBRID_EMBED_BUDGET_MS before answering from BM25
+# alone (0 waits indefinitely). Questions whose top BM25 hits match every term and clearly outscore the rest
+# skip the embedding call entirely when LEXICAL_SKIP_EMBEDDING is on and the answer cache is off.
+HYBRID_RETRIEVAL_ENABLED = os.getenv("HYBRID_RETRIEVAL_ENABLED", "true").lower() == "true"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_EMBED_BUDGET_MS = float(os.getenv("HYBRID_EMBED_BUDGET_MS", "1500"))
+LEXICAL_SKIP_EMBEDDING = os.getenv("LEXICAL_SKIP_EMBEDDING", "true").lower() == "true"
+LEXICAL_CONFIDENCE_MARGIN = float(os.getenv("LEXICAL_CONFIDENCE_MARGIN", "1.5"))
+
+# Query micro-batching: question embeddings and vector searches of concurrent requests arriving within
+# QUERY_BATCH_MAX_WAIT_MS of each other are sent as one embedding request and one FAISS search of at most
+# QUERY_BATCH_MAX_SIZE questions. Questions only wait for a batch once the stage's concurrency limit is in
+# flight; before that they are embedded and searched right away.
+QUERY_BATCH_ENABLED = os.getenv("QUERY_BATCH_ENABLED", "true").lower() == "true"
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "16"))
+QUERY_BATCH_MAX_WAIT_MS = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", "5"))
+
+# Vector index: flat (exact), sq (8-bit scalar-quantized exact scan), ivf, ivfsq, ivfpq (inverted file with
+# full, 8-bit or product-quantized vectors) or hnsw. Trained types (ivf*) fall back to flat below
+# VECTOR_INDEX_MIN_TRAIN vectors and are trained on a sample of at most VECTOR_INDEX_TRAIN_SAMPLE vectors.
+# VECTOR_INDEX_NLIST=0 picks about 4 * sqrt(vectors) lists; VECTOR_INDEX_PQ_M=0 picks dimension / 16 subquantizers.
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "flat").lower()
+VECTOR_INDEX_NLIST = int(os.getenv("VECTOR_INDEX_NLIST", "0"))
+VECTOR_INDEX_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", "16"))
+VECTOR_INDEX_PQ_M = int(os.getenv("VECTOR_INDEX_PQ_M", "0"))
+VECTOR_INDEX_HNSW_M = int(os.getenv("VECTOR_INDEX_HNSW_M", "32"))
+VECTOR_INDEX_EF_CONSTRUCTION = int(os.getenv("VECTOR_INDEX_EF_CONSTRUCTION", "200"))
+VECTOR_INDEX_EF_SEARCH = int(os.getenv("VECTOR_INDEX_EF_SEARCH", "128"))
+VECTOR_INDEX_TRAIN_SAMPLE = int(os.getenv("VECTOR_INDEX_TRAIN_SAMPLE", "100000"))
+VECTOR_INDEX_MIN_TRAIN = int(os.getenv("VECTOR_INDEX_MIN_TRAIN", "10000"))
+
+# Prometheus /metrics endpoint. Under gunicorn, prometheus_client runs in multiprocess mode: every worker and
+# ingest job writes its metrics to files in METRICS_PATH, and /metrics aggregates them.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PATH = os.getenv("METRICS_PATH", STORAGE_PATH + '/metrics')
+
+# Requests slower than TRACE_SLOW_REQUEST_MS (0 disables tracing) have their per-stage trace written as JSON
+# to TRACE_PATH. TRACE_SAMPLE_RATE of the slow requests are written, and the newest TRACE_MAX_FILES are kept.
+TRACE_SLOW_REQUEST_MS = float(os.getenv("TRACE_SLOW_REQUEST_MS", "0"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+TRACE_PATH = os.getenv("TRACE_PATH", STORAGE_PATH + '/traces')
+TRACE_MAX_FILES = int(os.getenv("TRACE_MAX_FILES", "100"))
+
+# Prompt assembly: the prompt (template, question, history and retrieved chunks) is kept within
+# PROMPT_TOKEN_BUDGET tokens, of which conversation history may use HISTORY_TOKEN_BUDGET. Up to
+# CONTEXT_MAX_CHUNKS chunks are retrieved and added in rank order while they fit.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+CONTEXT_MAX_CHUNKS = int(os.getenv("CONTEXT_MAX_CHUNKS", "3"))
+# The session keeps the last HISTORY_MAX_TURNS turns verbatim; older turns are folded into a running summary
+# by HISTORY_SUMMARY_MODEL (or dropped when HISTORY_SUMMARY_ENABLED is off)
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "5"))
+HISTORY_SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY_ENABLED", "true").lower() == "true"
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gpt-4o-mini")
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "300"))
+# Old turns are summarized this many at a time, so the summary is not recomputed on every turn
+HISTORY_SUMMARY_BATCH_TURNS = max(1, int(os.getenv("HISTORY_SUMMARY_BATCH_TURNS", "3")))
+
+# Streaming ingestion: files are extracted INGEST_FILES_IN_FLIGHT at a time, chunked into batches of about
+# INGEST_BATCH_CHUNKS chunks and indexed one batch at a time, with at most INGEST_QUEUE_SIZE batches waiting
+# between stages. The embeddings of up to INGEST_EMBED_IN_FLIGHT batches are requested at once, enough by
+# default for the 2-3 API requests of each batch to fill EMBEDDING_CONCURRENCY. Work in progress is checkpointed to INGEST_CHECKPOINT_PATH every
+# INGEST_CHECKPOINT_SECONDS seconds or INGEST_CHECKPOINT_CHUNKS chunks, and an interrupted ingest of the
+# same directory resumes from the last checkpoint.
+INGEST_BATCH_CHUNKS = max(1, int(os.getenv("INGEST_BATCH_CHUNKS", "2000")))
+INGEST_QUEUE_SIZE = max(1, int(os.getenv("INGEST_QUEUE_SIZE", "4")))
+INGEST_EMBED_IN_FLIGHT = max(1, int(os.getenv("INGEST_EMBED_IN_FLIGHT", str(max(2, EMBEDDING_CONCURRENCY // 2)))))
+INGEST_FILES_IN_FLIGHT = max(1, int(os.getenv("INGEST_FILES_IN_FLIGHT", str(EXTRACT_WORKERS * 2))))
+INGEST_CHECKPOINT_SECONDS = float(os.getenv("INGEST_CHECKPOINT_SECONDS", "300"))
+INGEST_CHECKPOINT_CHUNKS = int(os.getenv("INGEST_CHECKPOINT_CHUNKS", "50000"))
+INGEST_CHECKPOINT_PATH = os.getenv("INGEST_CHECKPOINT_PATH", STORAGE_PATH + '/ingest_checkpoint')
+# Ingest jobs: status files of queued, running and the last INGEST_JOBS_KEEP finished jobs, and the lock held
+# by the process running them. Jobs run one at a time in a child process niced by INGEST_NICENESS and, when
+# INGEST_CPUS is set, pinned to that many cores.
+INGEST_JOBS_PATH = os.getenv("INGEST_JOBS_PATH", STORAGE_PATH + '/ingest_jobs')
+INGEST_JOBS_KEEP = int(os.getenv("INGEST_JOBS_KEEP", "50"))
+INGEST_LOCK_PATH = os.getenv("INGEST_LOCK_PATH", STORAGE_PATH + '/ingest.lock')
+INGEST_NICENESS = int(os.getenv("INGEST_NICENESS", "10"))
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+# Production server: gunicorn -c gunicorn.conf.py app:app
+# With preload_app the master imports the app, and with it the index, once before forking, so all workers
+# share the index pages copy-on-write. Threaded workers keep serving while requests wait on OpenAI.
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", str(os.cpu_count() or 1)))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# Ingestion runs in its own process, so no request needs long: a worker that stops answering the master's
+# heartbeat for this long is hung and gets replaced (a sync worker is also killed when one request takes this long)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "120"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+# Restart workers after this many requests (0 disables) to bound memory growth
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# FAISS threads per worker; the default of one per core in every worker oversubscribes the CPU
+faiss_threads = int(os.getenv("FAISS_THREADS", "1"))
+
+# prometheus_client multiprocess mode: workers and ingest jobs write their metrics to files in METRICS_PATH,
+# and /metrics aggregates them. The client reads the directory when it is first imported, so it is set here,
+# before the app is preloaded; workers and ingest jobs inherit it. The first time the master reads this file
+# (a SIGHUP reads it again) the files of a previous server run are removed, so they are not aggregated.
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    from config import METRICS_PATH
+    shutil.rmtree(METRICS_PATH, ignore_errors=True)
+    os.makedirs(METRICS_PATH)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = METRICS_PATH
+
+def on_reload(server):
+    # SIGHUP (sent after an ingest): load the new generation in the master before the new workers are forked
+    if preload_app:
+        from utils.store_registry import get_store
+        store = get_store(force=True)
+        server.log.info(f"Master loaded index generation {store.generation if store else None} before reloading workers")
+
+def post_fork(server, worker):
+    from utils.serving import register_master
+    register_master(server.pid)
+
+    if faiss_threads > 0:
+        import faiss
+        faiss.omp_set_num_threads(faiss_threads)
+
+    # Connections opened in the master must not be shared between workers
+    if preload_app:
+        from app import app
+        app.config['SESSION_MEMCACHED'].disconnect_all()
+        from utils.store_registry import publish_current_store
+        publish_current_store()
+
+def child_exit(server, worker):
+    # Drop the per-process gauges of a worker that exited; its counters and histograms stay in the totals
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -86,7 +86,7 @@ function hideTypingIndicator() {
     $('#typing-indicator').remove();
 }
 
-// Function to send message to backend
+// Function to send message to backend, streaming the answer when the browser supports it
 function sendMessage(message) {
     // Remove any existing quick replies
     $('.quick-replies').remove();
@@ -100,6 +100,128 @@ function sendMessage(message) {
         chat_history: chatHistoryData
     };
 
+    if (window.fetch && window.ReadableStream && window.TextDecoder) {
+        streamMessage(dataToSend);
+    } else {
+        sendMessageBlocking(dataToSend);
+    }
+}
+
+// Create an empty bot bubble that is filled in while tokens arrive
+function createStreamingBotBubble() {
+    let chatHistory = $('#chat-history');
+    let time = new Date().toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+    let bubble = $(`
+    <div class="chat-message bot">
+        <div class="chat-bubble bot-bubble" role="dialog" aria-label="Bot message at ${time}">
+            <div class="message"></div>
+            <div class="metadata">${time}</div>
+        </div>
+    </div>`);
+    chatHistory.append(bubble);
+    return bubble.find('.message');
+}
+
+// Parse one Server-Sent Events block ("event: ...\ndata: ...")
+function parseSseEvent(block) {
+    let event = 'message';
+    let data = '';
+    block.split('\n').forEach(line => {
+        if (line.startsWith('event:')) {
+            event = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+            data += line.slice(5).trim();
+        }
+    });
+    return { event: event, data: data ? JSON.parse(data) : {} };
+}
+
+// Stream the answer from /query/stream and render tokens as they arrive
+async function streamMessage(dataToSend) {
+    let messageElement = null;
+    let answer = '';
+    let finished = false;
+
+    let handleEvent = function(parsed) {
+        if (parsed.event === 'token') {
+            if (!messageElement) {
+                hideTypingIndicator();
+                messageElement = createStreamingBotBubble();
+            }
+            answer += parsed.data.text;
+            messageElement.html(formatAnswer(answer));
+            $('#chat-history').scrollTop($('#chat-history')[0].scrollHeight);
+        } else if (parsed.event === 'done') {
+            finished = true;
+            hideTypingIndicator();
+            if (!messageElement) {
+                messageElement = createStreamingBotBubble();
+            }
+            // The final event carries the cleaned-up answer, so it replaces the streamed text
+            messageElement.html(formatAnswer(parsed.data.answer));
+            chatHistoryData.push({ sender: 'bot', message: parsed.data.answer });
+            if (parsed.data.quickReplies && parsed.data.quickReplies.length > 0) {
+                addQuickReplies(parsed.data.quickReplies);
+            }
+            $('#chat-history').scrollTop($('#chat-history')[0].scrollHeight);
+        } else if (parsed.event === 'error') {
+            finished = true;
+            hideTypingIndicator();
+            if (messageElement) {
+                messageElement.closest('.chat-message').remove();
+            }
+            addMessageToHistory('bot', parsed.data.error || "Something went wrong. Please try again.");
+        }
+    };
+
+    try {
+        let response = await fetch('/query/stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(dataToSend)
+        });
+
+        if (!response.ok) {
+            hideTypingIndicator();
+            let errorMessage = "Something went wrong. Please try again.";
+            if (response.status === 400) {
+                let errorResponse = await response.json();
+                errorMessage = errorResponse.error || errorMessage;
+            }
+            addMessageToHistory('bot', errorMessage);
+            return;
+        }
+
+        let reader = response.body.getReader();
+        let decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            let { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                let block = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                if (block.trim()) {
+                    handleEvent(parseSseEvent(block));
+                }
+            }
+        }
+
+        if (!finished) {
+            handleEvent({ event: 'error', data: {} });
+        }
+    } catch (error) {
+        if (!finished) {
+            handleEvent({ event: 'error', data: {} });
+        }
+    }
+}
+
+// Send the message to the blocking /query endpoint
+function sendMessageBlocking(dataToSend) {
     // Send the user's message to the backend
     $.ajax({
         type: 'POST',
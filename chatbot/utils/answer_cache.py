@@ -0,0 +1,131 @@
+import logging
+import time
+import uuid
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Semantic answer cache shared by all workers through memcached.
+# Answers are grouped in buckets per index generation and detected airline. A bucket holds the
+# normalized question embeddings (float16) of its entries in LRU order; each answer payload is
+# stored under its own key. A question whose cosine similarity to a cached one reaches the
+# threshold gets the cached answer. New generations use new buckets, so re-ingesting invalidates
+# every cached answer and old buckets simply expire.
+class SemanticAnswerCache:
+    def __init__(self, client, threshold=0.95, ttl=3600, max_entries=200, key_prefix='answer_cache'):
+        self.client = client
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+
+    def _bucket_key(self, generation, airline):
+        return f"{self.key_prefix}:{generation}:{airline or '_all'}"
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _best_match(self, bucket, query):
+        now = time.time()
+        live = [i for i, expires in enumerate(bucket['expires']) if expires > now]
+        if not live:
+            return None, 0.0
+        vectors = np.frombuffer(bucket['vectors'], dtype=np.float16).reshape(len(bucket['ids']), -1)[live]
+        similarities = vectors.astype(np.float32) @ query
+        best = int(np.argmax(similarities))
+        return live[best], float(similarities[best])
+
+    def lookup(self, embedding, generation, airline):
+        query = self._normalize(embedding)
+        bucket_key = self._bucket_key(generation, airline)
+        try:
+            bucket = self.client.get(bucket_key)
+            if not bucket:
+                self.misses += 1
+                return None
+
+            position, similarity = self._best_match(bucket, query)
+            if position is None or similarity < self.threshold:
+                self.misses += 1
+                return None
+
+            entry_id = bucket['ids'][position]
+            result = self.client.get(f"{bucket_key}:{entry_id}")
+            if result is None:
+                # The payload expired or was evicted by memcached; the bucket is cleaned up on the next store
+                self.misses += 1
+                return None
+
+            self._touch(bucket_key, entry_id)
+            self.hits += 1
+            logger.debug(f"Answer cache hit in {bucket_key} (similarity {similarity:.3f})")
+            return result
+        except Exception as e:
+            logger.warning(f"Answer cache lookup failed: {e}")
+            self.misses += 1
+            return None
+
+    def store(self, embedding, generation, airline, result):
+        query = self._normalize(embedding).astype(np.float16)
+        bucket_key = self._bucket_key(generation, airline)
+        entry_id = uuid.uuid4().hex[:12]
+        try:
+            self.client.set(f"{bucket_key}:{entry_id}", result, time=self.ttl)
+            self._update_bucket(bucket_key, lambda bucket: self._append(bucket, entry_id, query))
+        except Exception as e:
+            logger.warning(f"Answer cache store failed: {e}")
+
+    def _append(self, bucket, entry_id, query):
+        if bucket is None or (bucket['ids'] and len(bucket['vectors']) // len(bucket['ids']) != query.nbytes):
+            bucket = {'ids': [], 'expires': [], 'vectors': b''}
+
+        now = time.time()
+        row_size = query.nbytes
+        rows = [
+            (entry, expires, bucket['vectors'][i * row_size:(i + 1) * row_size])
+            for i, (entry, expires) in enumerate(zip(bucket['ids'], bucket['expires']))
+            if expires > now
+        ]
+        rows.append((entry_id, now + self.ttl, query.tobytes()))
+        # Least recently used entries sit at the front of the bucket
+        rows = rows[-self.max_entries:]
+        return {
+            'ids': [entry for entry, _, _ in rows],
+            'expires': [expires for _, expires, _ in rows],
+            'vectors': b''.join(vector for _, _, vector in rows),
+        }
+
+    def _touch(self, bucket_key, entry_id):
+        def move_to_end(bucket):
+            if bucket is None or entry_id not in bucket['ids']:
+                return None
+            position = bucket['ids'].index(entry_id)
+            row_size = len(bucket['vectors']) // len(bucket['ids'])
+            vector = bucket['vectors'][position * row_size:(position + 1) * row_size]
+            expires = bucket['expires'][position]
+            ids = bucket['ids'][:position] + bucket['ids'][position + 1:] + [entry_id]
+            expiries = bucket['expires'][:position] + bucket['expires'][position + 1:] + [expires]
+            vectors = bucket['vectors'][:position * row_size] + bucket['vectors'][(position + 1) * row_size:] + vector
+            return {'ids': ids, 'expires': expiries, 'vectors': vectors}
+
+        self._update_bucket(bucket_key, move_to_end)
+
+    def _update_bucket(self, bucket_key, update, attempts=3):
+        # Compare-and-swap so concurrent workers do not overwrite each other's entries
+        for _ in range(attempts):
+            bucket, cas = self.client.gets(bucket_key)
+            new_bucket = update(bucket)
+            if new_bucket is None:
+                return
+            if self.client.cas(bucket_key, new_bucket, cas, time=self.ttl):
+                return
+        logger.debug(f"Gave up updating {bucket_key} after {attempts} conflicting writes")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
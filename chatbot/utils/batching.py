@@ -0,0 +1,175 @@
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from config import QUERY_BATCH_ENABLED, QUERY_BATCH_MAX_SIZE, QUERY_BATCH_MAX_WAIT_MS
+from prometheus_client import Counter, Histogram
+from utils.metrics import trace_attribute
+
+logger = logging.getLogger(__name__)
+
+QUERY_BATCH_SIZE = Histogram(
+    'chatbot_query_batch_size', 'Questions per micro-batch', ['stage'], buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+QUERY_BATCH_FILL = Histogram(
+    'chatbot_query_batch_fill_ratio', 'Micro-batch size as a fraction of the maximum batch size', ['stage'],
+    buckets=(0.125, 0.25, 0.5, 0.75, 1.0)
+)
+QUERY_BATCH_WAIT_SECONDS = Histogram(
+    'chatbot_query_batch_wait_seconds', 'Time a question waited for its micro-batch to be sent', ['stage'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+)
+QUERY_BATCHES = Counter(
+    'chatbot_query_batches_total', 'Micro-batches sent, by why they were sent (full, timeout, idle, direct)', ['stage', 'reason']
+)
+
+# Coalesces the single-question work of concurrent requests (question embeddings, vector searches) into
+# batched calls. Request threads submit items and wait on a future; one dispatcher thread per process takes
+# the first waiting item and keeps collecting until the batch holds max_size items or max_wait has passed
+# since the first one arrived. Up to `concurrency` calls run at once, and while one of them is free items
+# are not held back: the dispatcher sends what it has right away, and an item that finds nothing else
+# waiting skips the dispatcher, running on the calling thread for call() and on the pool for submit().
+# Batches therefore only form once every slot is busy, and a request at low load never pays the wait or
+# the hand-offs. Items of one batch are grouped by key (e.g. the index and filter a search runs against),
+# and every group is one run_batch(items) call, which returns one result per item in order. Every item
+# carries the context it was submitted from, so each request's trace gets the size of its batch and how long
+# it waited for it, and an item run alone runs in its request's context.
+class MicroBatcher:
+    def __init__(self, stage, run_batch, max_size=QUERY_BATCH_MAX_SIZE, max_wait_ms=QUERY_BATCH_MAX_WAIT_MS,
+                 concurrency=4, enabled=QUERY_BATCH_ENABLED):
+        self.stage = stage
+        self.run_batch = run_batch
+        self.max_size = max(1, max_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.concurrency = max(1, concurrency)
+        self.enabled = enabled and self.max_size > 1
+        self._lock = threading.Lock()
+        # Signalled whenever a call finishes, so a batch held back by busy slots goes out as soon as one frees
+        self._slot_free = threading.Condition(self._lock)
+        self._pid = None
+        self._queue = None
+        self._pool = None
+        self._in_flight = 0
+        self._dispatching = False
+
+    def _start(self):
+        # Threads do not survive a fork, so every gunicorn worker starts its own dispatcher on first use
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f'{self.stage}-batch')
+                self._in_flight = 0
+                self._dispatching = False
+                self._pid = os.getpid()
+            if self.enabled and not self._dispatching:
+                threading.Thread(target=self._dispatch, args=(self._queue,), name=f'{self.stage}-batcher', daemon=True).start()
+                self._dispatching = True
+
+    def submit(self, item, key=None):
+        # Returns a future of the item's result. With batching off, or a call slot free and nothing waiting,
+        # the item runs alone on the pool, so callers can still stop waiting for it.
+        if self._pid != os.getpid() or (self.enabled and not self._dispatching):
+            self._start()
+        if not self.enabled:
+            return self._pool.submit(contextvars.copy_context().run, lambda: self.run_batch([item])[0])
+        if self._claim_slot():
+            return self._pool.submit(contextvars.copy_context().run, self._run_alone, item)
+        future = Future()
+        self._queue.put((key, item, future, time.perf_counter(), contextvars.copy_context()))
+        return future
+
+    def call(self, item, key=None):
+        if not self.enabled:
+            return self.run_batch([item])[0]
+        if self._pid != os.getpid() or not self._dispatching:
+            self._start()
+        # With a call slot free and nothing waiting, the item runs on the calling thread instead of paying
+        # the hand-offs to the dispatcher and the pool
+        if self._claim_slot():
+            return self._run_alone(item)
+        future = Future()
+        self._queue.put((key, item, future, time.perf_counter(), contextvars.copy_context()))
+        return future.result()
+
+    def _claim_slot(self):
+        with self._lock:
+            if self._in_flight < self.concurrency and self._queue.empty():
+                self._in_flight += 1
+                return True
+        return False
+
+    def _run_alone(self, item):
+        QUERY_BATCHES.labels(stage=self.stage, reason='direct').inc()
+        QUERY_BATCH_SIZE.labels(stage=self.stage).observe(1)
+        QUERY_BATCH_FILL.labels(stage=self.stage).observe(1 / self.max_size)
+        trace_attribute(f'{self.stage}_batch_size', 1)
+        try:
+            return self.run_batch([item])[0]
+        finally:
+            self._release_slot()
+
+    def _release_slot(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._slot_free.notify()
+
+    def _dispatch(self, items):
+        while True:
+            batch = [items.get()]
+            deadline = batch[0][3] + self.max_wait
+            reason = 'full'
+            while len(batch) < self.max_size:
+                try:
+                    batch.append(items.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                if self._in_flight < self.concurrency:
+                    reason = 'idle'
+                    break
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    reason = 'timeout'
+                    break
+                with self._slot_free:
+                    if self._in_flight >= self.concurrency:
+                        self._slot_free.wait(remaining)
+
+            now = time.perf_counter()
+            QUERY_BATCHES.labels(stage=self.stage, reason=reason).inc()
+            QUERY_BATCH_SIZE.labels(stage=self.stage).observe(len(batch))
+            QUERY_BATCH_FILL.labels(stage=self.stage).observe(len(batch) / self.max_size)
+            wait_seconds = QUERY_BATCH_WAIT_SECONDS.labels(stage=self.stage)
+            for entry in batch:
+                wait_seconds.observe(now - entry[3])
+                entry[4].run(trace_attribute, f'{self.stage}_batch_wait_ms', round((now - entry[3]) * 1000, 1))
+
+            groups = {}
+            for entry in batch:
+                groups.setdefault(entry[0], []).append(entry)
+            for entries in groups.values():
+                for entry in entries:
+                    entry[4].run(trace_attribute, f'{self.stage}_batch_size', len(entries))
+                with self._lock:
+                    self._in_flight += 1
+                self._pool.submit(self._run, entries)
+
+    def _run(self, entries):
+        try:
+            items = [item for _, item, _, _, _ in entries]
+            # A batch of several requests belongs to none of them; one request's item runs in its context
+            results = self.run_batch(items) if len(entries) > 1 else entries[0][4].run(self.run_batch, items)
+            if len(results) != len(entries):
+                raise RuntimeError(f"{self.stage} batch of {len(entries)} returned {len(results)} results")
+        except BaseException as e:
+            logger.warning(f"{self.stage} batch of {len(entries)} failed: {e}")
+            for _, _, future, _, _ in entries:
+                future.set_exception(e)
+        else:
+            for (_, _, future, _, _), result in zip(entries, results):
+                future.set_result(result)
+        finally:
+            self._release_slot()
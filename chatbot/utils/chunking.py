@@ -0,0 +1,84 @@
+import logging
+from collections import namedtuple
+from functools import lru_cache
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from config import CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_SIZE_UNIT, EMBEDDING_MODEL
+from utils.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Structure-aware chunking. Extraction hands over each file as sections: the heading sections of a Markdown
+# file, or the pages of a PDF. Chunks are cut at section boundaries first, and only a section longer than
+# CHUNK_SIZE is split further, on paragraphs, lines, sentences and words in that order (with CHUNK_OVERLAP
+# of overlap between its pieces). Sections too short to be a useful chunk on their own, like a heading
+# followed straight by a subheading or a nearly empty page, are joined with the sections after them.
+# Sizes are in characters, or in embedding-model tokens with CHUNK_SIZE_UNIT=tokens.
+SEPARATORS = ["\n\n", "\n", ".", "!", "?", ",", " ", ""]
+SECTION_SEPARATOR = "\n\n"
+# Whole sections are joined while the chunk is shorter than this fraction of CHUNK_SIZE
+MIN_CHUNK_FRACTION = 0.25
+# Recorded in the manifest: files chunked with other settings are chunked again by the next ingest
+CHUNKER_VERSION = 2
+
+def chunker_settings():
+    return f"{CHUNKER_VERSION}:{CHUNK_SIZE_UNIT}:{CHUNK_SIZE}:{CHUNK_OVERLAP}"
+
+# A cached splitter together with the size limit and length function it was built with
+Splitter = namedtuple('Splitter', ['text_splitter', 'chunk_size', 'length'])
+
+def token_length(text):
+    return count_tokens(text, EMBEDDING_MODEL)
+
+@lru_cache(maxsize=None)
+def get_splitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, unit=CHUNK_SIZE_UNIT):
+    # One splitter per configuration, shared by every file instead of built for each one
+    if unit not in ('chars', 'tokens'):
+        logger.warning(f"Unknown CHUNK_SIZE_UNIT {unit!r}, sizing chunks in characters")
+        unit = 'chars'
+    length = token_length if unit == 'tokens' else len
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=SEPARATORS,
+        length_function=length
+    )
+    return Splitter(text_splitter, chunk_size, length)
+
+def make_chunk(parts):
+    # A chunk of several sections is titled after the longest of them and starts on the page of the first
+    title = max(parts, key=lambda part: len(part[2]))[0]
+    return {'text': SECTION_SEPARATOR.join(part[2] for part in parts), 'title': title, 'page': parts[0][1]}
+
+def chunk_sections(sections, splitter=None):
+    # sections: dicts with 'text' and optionally 'title' and 'page', in document order.
+    # Returns the chunks as dicts with 'text', 'title' and 'page'.
+    splitter = splitter or get_splitter()
+    length = splitter.length
+    chunk_size = splitter.chunk_size
+    separator_size = length(SECTION_SEPARATOR)
+
+    chunks = []
+    parts = []  # (title, page, text) of the chunk being built
+    parts_size = 0
+    # Only a chunk made of whole sections takes in more sections; pieces of a split section stay as cut
+    joinable = False
+    for section in sections:
+        text = (section.get('text') or '').strip()
+        if not text:
+            continue
+        size = length(text)
+        pieces = [text] if size <= chunk_size else splitter.text_splitter.split_text(text)
+        for piece in pieces:
+            piece_size = size if len(pieces) == 1 else length(piece)
+            if parts and not (
+                joinable and parts_size < chunk_size * MIN_CHUNK_FRACTION
+                and parts_size + separator_size + piece_size <= chunk_size
+            ):
+                chunks.append(make_chunk(parts))
+                parts, parts_size = [], 0
+            parts_size += (separator_size if parts else 0) + piece_size
+            parts.append((section.get('title'), section.get('page'), piece))
+            joinable = len(pieces) == 1
+    if parts:
+        chunks.append(make_chunk(parts))
+    return chunks
@@ -0,0 +1,271 @@
+import json
+import logging
+import mmap
+import os
+from collections.abc import MutableMapping
+import faiss
+import numpy as np
+from langchain.schema import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+logger = logging.getLogger(__name__)
+
+# On-disk layout of one index generation, written once and then only read:
+#   header.json         format version, row count, and the interned airline / file / link tables
+#   index.faiss         the FAISS index
+#   ids.i64             chunk id of every row, sorted
+#   text.bin            UTF-8 chunk texts back to back, sliced with text_offsets.i64 (rows + 1 entries)
+#   airline.i32         per-row code into the airline table (-1 when the chunk has no airline)
+#   file.i32            per-row code into the file table
+#   links.i32           per-row code into the link-list table (the links are shared by all chunks of a file)
+#   extras.bin          remaining metadata (keywords, ...) as JSON per row, sliced with extras_offsets.i64
+# Everything is memory-mapped read-only, so gunicorn workers share the pages through the OS page cache
+# and a Document is only built for the rows a search actually returns.
+FORMAT_NAME = 'compact-docstore'
+FORMAT_VERSION = 1
+HEADER_FILE = 'header.json'
+INDEX_FILE = 'index.faiss'
+
+COLUMN_KEYS = ('airline_name', 'file_name', 'links')
+
+def _map_array(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+def _map_blob(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class _Interner:
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value, key=None):
+        if value is None:
+            return -1
+        key = value if key is None else key
+        if key not in self.codes:
+            self.codes[key] = len(self.values)
+            self.values.append(value)
+        return self.codes[key]
+
+def is_compact_store(directory):
+    return os.path.exists(os.path.join(directory, HEADER_FILE))
+
+def write_compact_store(directory, index, rows):
+    # rows yields (chunk id, Document) in ascending chunk id order
+    os.makedirs(directory, exist_ok=True)
+    airlines, files, links = _Interner(), _Interner(), _Interner()
+    ids, text_offsets, extras_offsets = [], [0], [0]
+    airline_codes, file_codes, link_codes = [], [], []
+
+    with open(os.path.join(directory, 'text.bin'), 'wb') as texts, open(os.path.join(directory, 'extras.bin'), 'wb') as extras:
+        for chunk_id, doc in rows:
+            metadata = doc.metadata or {}
+            ids.append(chunk_id)
+            text = doc.page_content.encode('utf-8')
+            texts.write(text)
+            text_offsets.append(text_offsets[-1] + len(text))
+
+            airline_codes.append(airlines.code(metadata.get('airline_name')))
+            file_codes.append(files.code(metadata.get('file_name')))
+            link_list = metadata.get('links')
+            link_codes.append(links.code(link_list, json.dumps(link_list, sort_keys=True)) if 'links' in metadata else -1)
+
+            rest = {key: value for key, value in metadata.items() if key not in COLUMN_KEYS}
+            encoded = json.dumps(rest, default=str).encode('utf-8') if rest else b''
+            extras.write(encoded)
+            extras_offsets.append(extras_offsets[-1] + len(encoded))
+
+    if any(a >= b for a, b in zip(ids, ids[1:])):
+        raise ValueError("Rows must be written in ascending chunk id order")
+
+    np.asarray(ids, dtype=np.int64).tofile(os.path.join(directory, 'ids.i64'))
+    np.asarray(text_offsets, dtype=np.int64).tofile(os.path.join(directory, 'text_offsets.i64'))
+    np.asarray(extras_offsets, dtype=np.int64).tofile(os.path.join(directory, 'extras_offsets.i64'))
+    np.asarray(airline_codes, dtype=np.int32).tofile(os.path.join(directory, 'airline.i32'))
+    np.asarray(file_codes, dtype=np.int32).tofile(os.path.join(directory, 'file.i32'))
+    np.asarray(link_codes, dtype=np.int32).tofile(os.path.join(directory, 'links.i32'))
+    faiss.write_index(index, os.path.join(directory, INDEX_FILE))
+
+    # The header is written last; a directory without one is an unfinished write
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'count': len(ids),
+        'dimension': index.d,
+        'airlines': airlines.values,
+        'files': files.values,
+        'links': links.values,
+    }
+    with open(os.path.join(directory, HEADER_FILE + '.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(header, f)
+    os.replace(os.path.join(directory, HEADER_FILE + '.tmp'), os.path.join(directory, HEADER_FILE))
+    return len(ids)
+
+def read_header(directory):
+    with open(os.path.join(directory, HEADER_FILE), encoding='utf-8') as f:
+        header = json.load(f)
+    if header.get('format') != FORMAT_NAME or header.get('version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported index format {header.get('format')} version {header.get('version')} in {directory}")
+    return header
+
+def read_compact_index(directory, writable=False):
+    # Serving workers map the vectors instead of copying them; an index that will be modified must be read into memory
+    flags = 0 if writable else getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+    return faiss.read_index(os.path.join(directory, INDEX_FILE), flags)
+
+# Read-only view of a compact store as a LangChain docstore. Documents are built from the mapped
+# columns on every search; adds and deletes made during an incremental ingest are kept in memory
+# on top of the mapped rows until the next generation is written.
+class CompactDocstore(Docstore, AddableMixin):
+    def __init__(self, directory):
+        header = read_header(directory)
+        self.directory = directory
+        self._airline_table = header['airlines']
+        self._file_table = header['files']
+        self._links_table = header['links']
+        self.ids = _map_array(os.path.join(directory, 'ids.i64'), np.int64)
+        self._text_offsets = _map_array(os.path.join(directory, 'text_offsets.i64'), np.int64)
+        self._extras_offsets = _map_array(os.path.join(directory, 'extras_offsets.i64'), np.int64)
+        self._airline_codes = _map_array(os.path.join(directory, 'airline.i32'), np.int32)
+        self._file_codes = _map_array(os.path.join(directory, 'file.i32'), np.int32)
+        self._link_codes = _map_array(os.path.join(directory, 'links.i32'), np.int32)
+        self._texts = _map_blob(os.path.join(directory, 'text.bin'))
+        self._extras = _map_blob(os.path.join(directory, 'extras.bin'))
+        if len(self.ids) != header['count']:
+            raise ValueError(f"Index in {directory} has {len(self.ids)} rows, expected {header['count']}")
+        self._added = {}
+        self._deleted = set()
+
+    def _row(self, chunk_id):
+        position = int(np.searchsorted(self.ids, chunk_id))
+        if position < len(self.ids) and self.ids[position] == chunk_id:
+            return position
+        return None
+
+    def document_at(self, row):
+        start, end = self._text_offsets[row], self._text_offsets[row + 1]
+        text = self._texts[start:end].decode('utf-8')
+
+        metadata = {}
+        if self._file_codes[row] >= 0:
+            metadata['file_name'] = self._file_table[self._file_codes[row]]
+        extras_start, extras_end = self._extras_offsets[row], self._extras_offsets[row + 1]
+        if extras_end > extras_start:
+            metadata.update(json.loads(self._extras[extras_start:extras_end]))
+        if self._link_codes[row] >= 0:
+            metadata['links'] = self._links_table[self._link_codes[row]]
+        if self._airline_codes[row] >= 0:
+            metadata['airline_name'] = self._airline_table[self._airline_codes[row]]
+        return Document(page_content=text, metadata=metadata)
+
+    def search(self, search):
+        if search in self._added:
+            return self._added[search]
+        row = self._row(int(search)) if search not in self._deleted and search.lstrip('-').isdigit() else None
+        if row is None:
+            return f"ID {search} not found."
+        return self.document_at(row)
+
+    def add(self, texts):
+        overlapping = [doc_id for doc_id in texts if doc_id in self]
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        self._added.update(texts)
+
+    def delete(self, ids):
+        for doc_id in ids:
+            if doc_id in self._added:
+                self._added.pop(doc_id)
+            elif doc_id in self:
+                self._deleted.add(doc_id)
+            else:
+                raise ValueError(f"Tried to delete ids that does not exist: {doc_id}")
+
+    def __contains__(self, doc_id):
+        if doc_id in self._added:
+            return True
+        return doc_id not in self._deleted and doc_id.lstrip('-').isdigit() and self._row(int(doc_id)) is not None
+
+    def __len__(self):
+        return len(self.ids) - len(self._deleted) + len(self._added)
+
+    def _live_rows(self):
+        if not self._deleted:
+            return np.ones(len(self.ids), dtype=bool)
+        deleted = np.fromiter((int(doc_id) for doc_id in self._deleted), dtype=np.int64)
+        return ~np.isin(self.ids, deleted)
+
+    def airlines(self):
+        live = self._live_rows()
+        names = {self._airline_table[code] for code in np.unique(self._airline_codes[live]) if code >= 0}
+        names.update(doc.metadata['airline_name'] for doc in self._added.values() if doc.metadata.get('airline_name'))
+        return names
+
+    def airline_partitions(self):
+        # Grouped straight from the airline column, without building any Document
+        live = self._live_rows()
+        partitions = {}
+        for code, airline_name in enumerate(self._airline_table):
+            ids = self.ids[live & (self._airline_codes == code)]
+            if len(ids):
+                partitions[airline_name] = [int(chunk_id) for chunk_id in ids]
+        for doc_id, doc in self._added.items():
+            airline_name = doc.metadata.get('airline_name')
+            if airline_name:
+                partitions.setdefault(airline_name, []).append(int(doc_id))
+        return partitions
+
+# index_to_docstore_id for a compact store: every chunk id maps to str(chunk id), so the mapped id
+# column serves as the keys instead of a dict with one entry per chunk in every worker
+class ChunkIdMap(MutableMapping):
+    def __init__(self, ids):
+        self.ids = ids
+        self._added = {}
+        self._hidden = set()
+
+    def _in_base(self, key):
+        position = int(np.searchsorted(self.ids, key))
+        return position < len(self.ids) and self.ids[position] == key
+
+    def __getitem__(self, key):
+        if key in self._added:
+            return self._added[key]
+        if key in self._hidden or not self._in_base(key):
+            raise KeyError(key)
+        return str(int(key))
+
+    def __setitem__(self, key, value):
+        if self._in_base(key):
+            self._hidden.add(key)
+        self._added[key] = value
+
+    def __delitem__(self, key):
+        if key in self._added:
+            del self._added[key]
+        elif key not in self._hidden and self._in_base(key):
+            self._hidden.add(key)
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for chunk_id in self.ids:
+            if int(chunk_id) not in self._hidden:
+                yield int(chunk_id)
+        yield from list(self._added)
+
+    def __len__(self):
+        return len(self.ids) - len(self._hidden) + len(self._added)
+
+def iter_sorted_documents(index_to_docstore_id, docstore):
+    # Yields (chunk id, Document) for every vector in the store, in the order write_compact_store expects
+    for chunk_id in sorted(index_to_docstore_id):
+        doc = docstore.search(index_to_docstore_id[chunk_id])
+        if not isinstance(doc, Document):
+            raise ValueError(f"Vector {chunk_id} has no document in the docstore")
+        yield int(chunk_id), doc
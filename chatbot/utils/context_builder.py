@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import time
+from langchain_core.documents import Document
+from config import (
+    PROMPT_TOKEN_BUDGET, HISTORY_TOKEN_BUDGET, HISTORY_MAX_TURNS, HISTORY_SUMMARY_ENABLED, HISTORY_SUMMARY_MODEL,
+    HISTORY_SUMMARY_MAX_TOKENS, HISTORY_SUMMARY_BATCH_TURNS
+)
+from prometheus_client import Counter, Histogram
+from utils.metrics import trace_stage
+from utils.tokens import count_tokens, truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SUMMARIES = Counter('chatbot_history_summaries_total', 'Conversation summaries updated, by outcome', ['outcome'])
+HISTORY_SUMMARY_SECONDS = Histogram('chatbot_history_summary_seconds', 'Time to fold old turns into the conversation summary')
+PROMPT_DOCUMENTS_DROPPED = Counter('chatbot_prompt_documents_dropped_total', 'Retrieved chunks left out of the prompt by the token budget')
+
+# Keys of summarized turns kept in the session, so the client's full history cannot bring them back
+MAX_SUMMARIZED_KEYS = 200
+
+summary_prompt = """Update the summary of a conversation between a user and an airline policy assistant.
+Keep the airlines, topics and policy facts the user was told, and anything the user said about their trip.
+Write at most {max_words} words of plain text.
+
+Summary so far:
+{summary}
+
+New turns:
+{turns}
+
+Updated summary:"""
+
+_summary_llm = None
+
+def set_summary_llm(chat_model):
+    # Swap the summarization model (e.g. for offline benchmarks)
+    global _summary_llm
+    _summary_llm = chat_model
+
+def get_summary_llm():
+    global _summary_llm
+    if _summary_llm is None:
+        from langchain_openai import ChatOpenAI
+        _summary_llm = ChatOpenAI(model_name=HISTORY_SUMMARY_MODEL, temperature=0, max_tokens=HISTORY_SUMMARY_MAX_TOKENS)
+    return _summary_llm
+
+def turn_key(turn):
+    normalized = ' '.join((turn.get('user') or '').split()) + '\x00' + ' '.join((turn.get('bot') or '').split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+def merge_history(session_turns, client_turns, summarized_keys=()):
+    # The client sends its whole conversation on every request, so it repeats the turns the session already
+    # holds and the ones already folded into the summary. Turns without an answer (like the question being
+    # asked right now) are dropped too.
+    seen = set(summarized_keys)
+    merged = []
+    for turn in list(session_turns or []) + list(client_turns or []):
+        if not turn.get('bot'):
+            continue
+        key = turn_key(turn)
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append({'user': turn.get('user') or '', 'bot': turn['bot']})
+    return merged
+
+def format_turn(turn):
+    return f"User: {turn['user']}\nBot: {turn['bot']}"
+
+def format_history(summary, turns):
+    parts = [f"Summary of the earlier conversation: {summary}"] if summary else []
+    parts.extend(format_turn(turn) for turn in turns)
+    return "\n".join(parts)
+
+def select_history(summary, turns, budget, model):
+    # The summary first, then as many of the most recent turns as fit, oldest of them first
+    if summary and count_tokens(summary, model) > budget // 2:
+        summary = truncate_tokens(summary, budget // 2, model)
+    remaining = budget - (count_tokens(summary, model) if summary else 0)
+
+    selected = []
+    for turn in reversed(turns):
+        tokens = count_tokens(format_turn(turn), model)
+        if tokens > remaining:
+            break
+        selected.append(turn)
+        remaining -= tokens
+    selected.reverse()
+    return summary, selected
+
+def select_documents(documents, budget, model):
+    # Chunks in rank order while they fit; one that does not fit is skipped so a smaller, lower-ranked
+    # chunk can still use the space. If no chunk fits, the best one is truncated to the budget.
+    selected = []
+    remaining = budget
+    for document in documents:
+        tokens = count_tokens(document.page_content, model) + 1
+        if tokens <= remaining:
+            selected.append(document)
+            remaining -= tokens
+    if not selected and documents and budget > 1:
+        # A copy, so the document held by the docstore is left untouched
+        top = documents[0]
+        selected.append(Document(page_content=truncate_tokens(top.page_content, budget - 1, model), metadata=top.metadata))
+    if len(selected) < len(documents):
+        PROMPT_DOCUMENTS_DROPPED.inc(len(documents) - len(selected))
+    return selected
+
+def build_context(prompt, question, airlines, documents, turns, summary, model):
+    # Assembles the prompt inputs within PROMPT_TOKEN_BUDGET tokens: the template and question always go in,
+    # history (summary plus recent turns) gets at most HISTORY_TOKEN_BUDGET, and retrieved chunks get the rest.
+    # Returns (inputs, documents that made it into the prompt).
+    inputs = {"airlines": ', '.join(airlines), "conversation_history": "", "context": "", "question": question}
+    fixed = count_tokens(prompt.format(**inputs), model)
+
+    summary, history = select_history(summary, turns, min(HISTORY_TOKEN_BUDGET, max(0, PROMPT_TOKEN_BUDGET - fixed)), model)
+    inputs["conversation_history"] = format_history(summary, history)
+    history_tokens = count_tokens(inputs["conversation_history"], model) if inputs["conversation_history"] else 0
+
+    # Chunks are joined by a blank line, counted as one token each in select_documents
+    documents = select_documents(documents, PROMPT_TOKEN_BUDGET - fixed - history_tokens, model)
+    inputs["context"] = "\n\n".join(document.page_content for document in documents)
+    return inputs, documents
+
+def summarize_turns(summary, turns):
+    max_words = max(20, HISTORY_SUMMARY_MAX_TOKENS * 3 // 4)
+    text = summary_prompt.format(
+        max_words=max_words,
+        summary=summary or "(none)",
+        turns="\n".join(format_turn(turn) for turn in turns)
+    )
+    result = get_summary_llm().invoke(text)
+    return (getattr(result, 'content', result) or "").strip()
+
+def compact_history(state, model):
+    # Moves the oldest turns out of the session once it holds more than HISTORY_MAX_TURNS turns or more
+    # than HISTORY_TOKEN_BUDGET tokens. Evicted turns are folded into the cached running summary (one small
+    # LLM call over the previous summary and the evicted turns only), or simply dropped when summaries are
+    # off or the call fails. Turns are evicted HISTORY_SUMMARY_BATCH_TURNS at a time, so the summary is
+    # updated every few turns rather than on every one.
+    turns = state['turns']
+    summary_tokens = count_tokens(state['summary'], model) if state['summary'] else 0
+    budget = max(0, HISTORY_TOKEN_BUDGET - summary_tokens)
+
+    turn_tokens = [count_tokens(format_turn(turn), model) for turn in turns]
+    evicted = []
+    while len(turns) > 1 and (
+        len(turns) > HISTORY_MAX_TURNS or sum(turn_tokens) > budget or 0 < len(evicted) < HISTORY_SUMMARY_BATCH_TURNS
+    ):
+        evicted.append(turns.pop(0))
+        turn_tokens.pop(0)
+    if not evicted:
+        return state
+
+    state['summarized'] = (state['summarized'] + [turn_key(turn) for turn in evicted])[-MAX_SUMMARIZED_KEYS:]
+    if not HISTORY_SUMMARY_ENABLED:
+        HISTORY_SUMMARIES.labels(outcome='dropped').inc()
+        return state
+
+    start = time.perf_counter()
+    try:
+        state['summary'] = truncate_tokens(summarize_turns(state['summary'], evicted), HISTORY_SUMMARY_MAX_TOKENS, model)
+        HISTORY_SUMMARIES.labels(outcome='updated').inc()
+    except Exception as e:
+        logger.warning(f"Could not summarize {len(evicted)} old turns, dropping them: {e}")
+        HISTORY_SUMMARIES.labels(outcome='failed').inc()
+    seconds = time.perf_counter() - start
+    HISTORY_SUMMARY_SECONDS.observe(seconds)
+    trace_stage('history_summary', seconds)
+    return state
+
+# Conversation state kept in the session: the recent turns verbatim, the running summary of older turns,
+# and the keys of the summarized turns.
+
+def load_conversation(session):
+    return {
+        'turns': list(session.get('chat_history', [])),
+        'summary': session.get('history_summary', ''),
+        'summarized': list(session.get('summarized_turns', [])),
+    }
+
+def save_conversation(session, state):
+    session['chat_history'] = state['turns']
+    session['history_summary'] = state['summary']
+    session['summarized_turns'] = state['summarized']
+
+def record_turn(state, turns, question, answer, model):
+    # turns is the merged history the question was answered with
+    state['turns'] = turns + [{'user': question, 'bot': answer}]
+    return compact_history(state, model)
@@ -0,0 +1,205 @@
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Header layout (int64): dimension, capacity, write version, access tick, high-water row
+_DIM, _CAPACITY, _VERSION, _TICK, _HIGH_WATER = range(5)
+_HEADER_SIZE = 5
+
+# Content-addressed embedding cache shared by ingestion and queries.
+# Vectors live in a memory-mapped float32 matrix; row i belongs to the sha256 key stored in keys[i].
+# Every file is a fixed-size memmap, so several worker processes can share one cache directory:
+# writers serialize on a file lock and bump the header version, readers rebuild their key->row map
+# only when that version changes.
+class EmbeddingCache:
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._synced_version = -1
+        self._header = None
+        self._vectors = None
+        self._keys = None
+        self._last_used = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._header_path = os.path.join(directory, 'header.i64')
+        self._vectors_path = os.path.join(directory, 'vectors.f32')
+        self._keys_path = os.path.join(directory, 'keys.s64')
+        self._last_used_path = os.path.join(directory, 'last_used.i64')
+        self._lock_path = os.path.join(directory, 'cache.lock')
+
+    @staticmethod
+    def make_key(model, text):
+        return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest().encode('ascii')
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _open(self):
+        header = np.memmap(self._header_path, dtype=np.int64, mode='r+', shape=(_HEADER_SIZE,))
+        dim, capacity = int(header[_DIM]), int(header[_CAPACITY])
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r+', shape=(capacity, dim))
+        self._keys = np.memmap(self._keys_path, dtype='S64', mode='r+', shape=(capacity,))
+        self._last_used = np.memmap(self._last_used_path, dtype=np.int64, mode='r+', shape=(capacity,))
+        self._header = header
+        if capacity != self.max_entries:
+            logger.info(f"Embedding cache at {self.directory} keeps its existing capacity of {capacity} entries")
+
+    def _create(self, dim):
+        capacity = self.max_entries
+        # The data files are sparse until rows are written, so a large capacity costs no disk up front
+        np.memmap(self._vectors_path, dtype=np.float32, mode='w+', shape=(capacity, dim)).flush()
+        np.memmap(self._keys_path, dtype='S64', mode='w+', shape=(capacity,)).flush()
+        np.memmap(self._last_used_path, dtype=np.int64, mode='w+', shape=(capacity,)).flush()
+
+        # The header appears last, so other processes never open a cache whose data files are missing
+        header = np.memmap(self._header_path + '.tmp', dtype=np.int64, mode='w+', shape=(_HEADER_SIZE,))
+        header[_DIM] = dim
+        header[_CAPACITY] = capacity
+        header.flush()
+        del header
+        os.replace(self._header_path + '.tmp', self._header_path)
+        self._open()
+
+    def _sync(self):
+        version = int(self._header[_VERSION])
+        if version == self._synced_version:
+            return
+        keys = np.asarray(self._keys)
+        filled = np.flatnonzero(keys != b'')
+        self._rows = {bytes(keys[row]): int(row) for row in filled}
+        self._synced_version = version
+
+    def _next_tick(self):
+        self._header[_TICK] += 1
+        return int(self._header[_TICK])
+
+    def lookup(self, model, texts):
+        keys = [self.make_key(model, text) for text in texts]
+        found = {}
+
+        with self._lock:
+            if self._header is None and os.path.exists(self._header_path):
+                self._open()
+            if self._header is not None:
+                self._sync()
+                tick = self._next_tick()
+                for i, key in enumerate(keys):
+                    row = self._rows.get(key)
+                    # Another process may have evicted and reused the row since our last sync, or be
+                    # doing so right now. Writers clear a row's key before overwriting its vector, so
+                    # the key still being there after the copy means the copy is whole.
+                    if row is None or self._keys[row] != key:
+                        continue
+                    vector = np.array(self._vectors[row])
+                    if self._keys[row] == key:
+                        found[i] = vector
+                        self._last_used[row] = tick
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        missing = [i for i in range(len(keys)) if i not in found]
+        return found, missing
+
+    def store(self, model, texts, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(texts) == 0:
+            return
+
+        # Deduplicate within the batch; the last vector for a key wins
+        entries = {}
+        for text, vector in zip(texts, vectors):
+            entries[self.make_key(model, text)] = vector
+
+        with self._lock, self._file_lock():
+            if self._header is None:
+                if os.path.exists(self._header_path):
+                    self._open()
+                else:
+                    self._create(vectors.shape[1])
+            if vectors.shape[1] != self._vectors.shape[1]:
+                logger.warning(f"Not caching {vectors.shape[1]}-dimensional embeddings in a {self._vectors.shape[1]}-dimensional cache")
+                return
+
+            self._sync()
+            new_entries = [(key, vector) for key, vector in entries.items() if key not in self._rows]
+            # Never try to keep more entries than the cache can hold
+            new_entries = new_entries[-len(self._keys):]
+            if not new_entries:
+                return
+
+            rows = self._allocate(len(new_entries))
+            tick = self._next_tick()
+            for row, (key, vector) in zip(rows, new_entries):
+                self._vectors[row] = vector
+                self._keys[row] = key
+                self._last_used[row] = tick
+                self._rows[key] = row
+
+            self._vectors.flush()
+            self._keys.flush()
+            self._last_used.flush()
+            self._header[_VERSION] += 1
+            self._header.flush()
+            self._synced_version = int(self._header[_VERSION])
+
+    def _allocate(self, count):
+        capacity = len(self._keys)
+        tick = self._next_tick()
+
+        # Use rows that were never written first
+        high_water = int(self._header[_HIGH_WATER])
+        rows = list(range(high_water, min(high_water + count, capacity)))
+        self._header[_HIGH_WATER] = high_water + len(rows)
+
+        # Then holes left behind by earlier evictions
+        if len(rows) < count and high_water >= capacity:
+            holes = np.flatnonzero(np.asarray(self._keys) == b'')
+            rows.extend(int(row) for row in holes[:count - len(rows)])
+
+        # Reserve the rows picked so far so they cannot be chosen for eviction below
+        self._last_used[rows] = tick
+
+        needed = count - len(rows)
+        if needed:
+            # Evict the least recently used entries, a few extra at once so eviction stays rare
+            batch = min(capacity - len(rows), max(needed, capacity // 20))
+            victims = np.argpartition(np.asarray(self._last_used), batch - 1)[:batch]
+            for row in victims:
+                self._rows.pop(bytes(self._keys[row]), None)
+            self._keys[victims] = b''
+            self.evictions += batch
+            rows.extend(int(row) for row in victims[:needed])
+        return rows
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._rows)
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'capacity': self.max_entries,
+        }
@@ -1,28 +1,253 @@
-from openai import OpenAI
-import time
-from concurrent.futures import ThreadPoolExecutor
-from openai import OpenAIError, RateLimitError
-from config import OPENAI_API_KEY
-
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-# Function to generate embeddings for a batch of documents
-def generate_embeddings(texts, batch_size=100):
-    embeddings = []
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(generate_batch_embeddings, texts[i:i+batch_size]) for i in range(0, len(texts), batch_size)]
-        for future in futures:
-            embeddings.extend(future.result())
-    return embeddings
-
-# Helper function to generate embeddings for a batch with retry on failure
-def generate_batch_embeddings(batch):
-    try:
-        response = client.embeddings.create(input=batch, model="text-embedding-ada-002")
-        return [item.embedding for item in response.data]
-    except RateLimitError:  # Correct exception class
-        time.sleep(5)
-        return generate_batch_embeddings(batch)
-    except OpenAIError as e:  # Catch any other OpenAI-related errors
-        print(f"OpenAI API error: {e}")
-        return []
\ No newline at end of file
+from openai import AsyncOpenAI
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import numpy as np
+from openai import OpenAIError, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from langchain_core.embeddings import Embeddings
+from config import (
+    OPENAI_API_KEY, EMBEDDING_MODEL, EMBEDDING_CACHE_ENABLED, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES,
+    EMBEDDING_CONCURRENCY, EMBEDDING_MAX_BATCH_TOKENS, EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_MAX_INPUT_TOKENS,
+    EMBEDDING_MAX_RETRIES, EMBEDDING_BACKOFF_BASE, EMBEDDING_BACKOFF_MAX
+)
+from utils.batching import MicroBatcher
+from utils.embedding_cache import EmbeddingCache
+from utils.tokens import count_tokens, truncate_tokens
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Covers both ingestion and question embeddings
+EMBEDDING_REQUESTS = Counter('chatbot_embedding_requests_total', 'Embedding API requests by outcome', ['outcome'])
+EMBEDDING_REQUEST_SECONDS = Histogram('chatbot_embedding_request_seconds', 'Latency of one embedding API request')
+EMBEDDING_BATCHES = Counter('chatbot_embedding_batches_total', 'Batches the embedding inputs were packed into')
+EMBEDDING_RETRIES = Counter('chatbot_embedding_retries_total', 'Embedding batches retried after a retryable error')
+EMBEDDING_TOKENS = Counter('chatbot_embedding_tokens_total', 'Tokens sent to the embedding API')
+EMBEDDING_CACHE_LOOKUPS = Counter('chatbot_embedding_cache_lookups_total', 'Embedding cache lookups per text', ['result'])
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES) if EMBEDDING_CACHE_ENABLED else None
+
+# Errors worth retrying; anything else (bad request, auth, ...) fails the whole call immediately
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+class EmbeddingError(Exception):
+    pass
+
+# Concurrency limit that halves when the API throttles us and creeps back up while requests succeed,
+# so large ingests settle just below the provider's rate ceiling instead of stalling on 429s
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.active = 0
+        self.successes = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self.successes += 1
+        if self.limit < self.max_concurrency and self.successes >= self.limit:
+            self.limit += 1
+            self.successes = 0
+
+    def on_throttle(self):
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
+
+# The OpenAI async client is bound to the event loop it first runs on, so every process keeps
+# one background loop (and client) that all request threads submit their embedding work to. The
+# concurrency limiter lives there too, so a cut made after a 429 holds for the calls that follow.
+_runtime_lock = threading.Lock()
+_runtime = None
+_client_override = None
+
+def set_embedding_client(client):
+    # Lets benchmarks and tools swap in a client with the same embeddings.create interface
+    global _client_override, _runtime
+    with _runtime_lock:
+        _client_override = client
+        _runtime = None
+
+def _get_runtime():
+    global _runtime
+    with _runtime_lock:
+        # A forked worker must not reuse the parent's loop thread, which does not exist in the child
+        if _runtime is None or _runtime['pid'] != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='embedding-loop', daemon=True)
+            thread.start()
+            client = _client_override or AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+            limiter = AdaptiveConcurrencyLimiter(EMBEDDING_CONCURRENCY)
+            _runtime = {'pid': os.getpid(), 'loop': loop, 'client': client, 'limiter': limiter}
+        return _runtime
+
+def batch_by_tokens(token_counts, max_tokens=EMBEDDING_MAX_BATCH_TOKENS, max_size=EMBEDDING_MAX_BATCH_SIZE):
+    # Packs consecutive inputs into batches that stay under the request's token and input limits
+    batches = []
+    current = []
+    current_tokens = 0
+    for i, tokens in enumerate(token_counts):
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_size):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def retry_delay(error, attempt):
+    # Honour the server's retry-after hint when there is one, otherwise back off exponentially with full jitter
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return random.uniform(0, min(EMBEDDING_BACKOFF_MAX, EMBEDDING_BACKOFF_BASE * 2 ** attempt))
+
+async def embed_batch(client, texts, limiter, stats):
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        async with limiter:
+            stats['embedding_calls'] += 1
+            start = time.perf_counter()
+            try:
+                response = await client.embeddings.create(input=texts, model=EMBEDDING_MODEL)
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, RateLimitError):
+                    limiter.on_throttle()
+                EMBEDDING_REQUESTS.labels(outcome='rate_limited' if isinstance(e, RateLimitError) else 'retryable_error').inc()
+                error = e
+            except OpenAIError as e:
+                EMBEDDING_REQUESTS.labels(outcome='error').inc()
+                raise EmbeddingError(f"Embedding request failed: {e}") from e
+            else:
+                limiter.on_success()
+                EMBEDDING_REQUESTS.labels(outcome='success').inc()
+                EMBEDDING_REQUEST_SECONDS.observe(time.perf_counter() - start)
+                data = sorted(response.data, key=lambda item: item.index)
+                if len(data) != len(texts):
+                    raise EmbeddingError(f"Expected {len(texts)} embeddings but got {len(data)}")
+                return [item.embedding for item in data]
+
+        if attempt == EMBEDDING_MAX_RETRIES:
+            break
+        # Sleep outside the limiter so waiting batches do not hold a concurrency slot
+        delay = retry_delay(error, attempt)
+        stats['embedding_retries'] += 1
+        EMBEDDING_RETRIES.inc()
+        logger.warning(f"Embedding batch of {len(texts)} failed ({type(error).__name__}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    raise EmbeddingError(f"Embedding batch of {len(texts)} failed after {EMBEDDING_MAX_RETRIES} retries: {error}")
+
+async def embed_texts_async(client, limiter, texts, stats):
+    # Every batch writes its vectors back into the rows of its own inputs, so results stay aligned with
+    # the texts regardless of completion order; any batch that finally fails fails the whole call
+    inputs = []
+    for text in texts:
+        text = text or " "
+        if count_tokens(text, EMBEDDING_MODEL) > EMBEDDING_MAX_INPUT_TOKENS:
+            logger.warning(f"Truncating a {len(text)}-character input to {EMBEDDING_MAX_INPUT_TOKENS} tokens")
+            text = truncate_tokens(text, EMBEDDING_MAX_INPUT_TOKENS, EMBEDDING_MODEL)
+        inputs.append(text)
+
+    token_counts = [count_tokens(text, EMBEDDING_MODEL) for text in inputs]
+    batches = batch_by_tokens(token_counts)
+    stats['embedding_batches'] += len(batches)
+    EMBEDDING_BATCHES.inc(len(batches))
+    EMBEDDING_TOKENS.inc(sum(token_counts))
+    results = [None] * len(inputs)
+
+    async def run(batch):
+        vectors = await embed_batch(client, [inputs[i] for i in batch], limiter, stats)
+        for i, vector in zip(batch, vectors):
+            results[i] = vector
+
+    tasks = [asyncio.ensure_future(run(batch)) for batch in batches]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return results
+
+# Function to generate embeddings for a batch of documents.
+# Returns a contiguous float32 matrix with one row per input text, in input order, or raises EmbeddingError.
+# If a stats dict is given, the embedding API calls, batches, retries, the time spent and the cache hits/misses are added to it.
+def generate_embeddings(texts, stats=None):
+    if stats is None:
+        stats = {}
+    for key in ('embedding_calls', 'embedding_batches', 'embedding_retries', 'cache_hits', 'cache_misses'):
+        stats.setdefault(key, 0)
+    stats.setdefault('embedding_seconds', 0.0)
+
+    # Only the texts the cache has not seen before go to the API
+    if embedding_cache is not None:
+        cached, missing = embedding_cache.lookup(EMBEDDING_MODEL, texts)
+    else:
+        cached, missing = {}, list(range(len(texts)))
+    stats['cache_hits'] += len(cached)
+    stats['cache_misses'] += len(missing)
+    if embedding_cache is not None:
+        EMBEDDING_CACHE_LOOKUPS.labels(result='hit').inc(len(cached))
+        EMBEDDING_CACHE_LOOKUPS.labels(result='miss').inc(len(missing))
+    missing_texts = [texts[i] for i in missing]
+
+    start = time.perf_counter()
+    embeddings = []
+    if missing_texts:
+        runtime = _get_runtime()
+        future = asyncio.run_coroutine_threadsafe(
+            embed_texts_async(runtime['client'], runtime['limiter'], missing_texts, stats), runtime['loop']
+        )
+        embeddings = future.result()
+    stats['embedding_seconds'] += time.perf_counter() - start
+
+    if embeddings and embedding_cache is not None:
+        embedding_cache.store(EMBEDDING_MODEL, missing_texts, embeddings)
+
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    dim = len(embeddings[0]) if embeddings else len(next(iter(cached.values())))
+    matrix = np.empty((len(texts), dim), dtype=np.float32)
+    for i, vector in cached.items():
+        matrix[i] = vector
+    if embeddings:
+        matrix[missing] = embeddings
+    return matrix
+
+def embed_questions(texts):
+    return generate_embeddings(texts).tolist()
+
+# Questions of concurrent requests share one embedding request
+query_embedding_batcher = MicroBatcher('embedding', embed_questions, concurrency=EMBEDDING_CONCURRENCY)
+
+# LangChain embedding function backed by generate_embeddings, so retriever queries share the embedding cache
+class CachedEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return generate_embeddings(texts).tolist()
+
+    def embed_query(self, text):
+        return query_embedding_batcher.call(text)
+
+    def submit_query(self, text):
+        # Future of the question's embedding, for callers that wait a limited time
+        return query_embedding_batcher.submit(text)
@@ -1,59 +1,169 @@
-import pdfplumber
-import pytesseract
-from bs4 import BeautifulSoup
-import markdown
-import logging
-
-# Centralized logging configuration
-logger = logging.getLogger(__name__)
-
-def extract_text_from_pdf(file_path, enable_ocr=False, ocr_threshold=0.1):
-    text = ""
-    links = []
-
-    try:
-        with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text() or ""
-                text += page_text
-
-                # Decide whether to use OCR based on text density
-                if enable_ocr and len(page_text.strip()) / (page.width * page.height) < ocr_threshold:
-                    image = page.to_image(resolution=300).original
-                    ocr_text = pytesseract.image_to_string(image)
-                    text += ocr_text
-
-                # Extract hyperlinks from annotations
-                if hasattr(page, 'annotations') and page.annotations:
-                    for annot in page.annotations:
-                        if annot.get("Subtype") == "/Link":
-                            uri = annot.get("URI")
-                            if uri:
-                                links.append(uri)
-
-    except Exception as e:
-        logger.error(f"Error extracting text from PDF {file_path}: {e}")
-
-    return text, links
-
-def extract_text_from_markdown(file_path):
-    text = ""
-    links = []
-
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-            html_content = markdown.markdown(content)
-            soup = BeautifulSoup(html_content, 'html.parser')
-            text = soup.get_text()
-
-            # Extract hyperlinks
-            for a_tag in soup.find_all('a', href=True):
-                link_text = a_tag.get_text(strip=True)
-                href = a_tag['href']
-                links.append({'text': link_text, 'url': href})
-
-    except Exception as e:
-        logger.error(f"Error processing markdown {file_path}: {e}")
-
-    return text, links
+import html
+import logging
+import re
+from collections import OrderedDict
+import pdfplumber
+import pytesseract
+from markdown_it import MarkdownIt
+
+# Centralized logging configuration
+logger = logging.getLogger(__name__)
+
+# Each extraction worker process keeps its few most recently used PDFs open, because reopening the
+# document for every page would re-parse it. Streaming ingestion extracts several files at once, so
+# the pages of different files arrive interleaved.
+OPEN_PDF_LIMIT = 4
+_open_pdf = OrderedDict()
+
+def _get_pdf(file_path):
+    file_path = str(file_path)
+    if file_path in _open_pdf:
+        _open_pdf.move_to_end(file_path)
+        return _open_pdf[file_path]
+    while len(_open_pdf) >= OPEN_PDF_LIMIT:
+        _open_pdf.popitem(last=False)[1].close()
+    _open_pdf[file_path] = pdfplumber.open(file_path)
+    return _open_pdf[file_path]
+
+def count_pdf_pages(file_path):
+    try:
+        return len(_get_pdf(file_path).pages)
+    except Exception as e:
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+def extract_pdf_page(file_path, page_number, enable_ocr=False, ocr_threshold=0.1):
+    # Returns the page text, its hyperlinks, and whether the page is text-light enough to need OCR
+    page = _get_pdf(file_path).pages[page_number]
+    try:
+        page_text = page.extract_text() or ""
+
+        # Decide whether to use OCR based on text density
+        needs_ocr = enable_ocr and len(page_text.strip()) / (page.width * page.height) < ocr_threshold
+
+        # Extract hyperlinks from annotations
+        links = []
+        if hasattr(page, 'annotations') and page.annotations:
+            for annot in page.annotations:
+                if annot.get("Subtype") == "/Link":
+                    uri = annot.get("URI")
+                    if uri:
+                        links.append(uri)
+        return page_text, links, needs_ocr
+    except Exception as e:
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    finally:
+        # Drop the parsed layout so long documents do not accumulate every page in memory
+        page.close()
+
+def ocr_pdf_page(file_path, page_number, resolution=300):
+    page = _get_pdf(file_path).pages[page_number]
+    try:
+        image = page.to_image(resolution=resolution).original
+        return pytesseract.image_to_string(image)
+    except Exception as e:
+        # Some library exceptions cannot be unpickled, which would break the whole process pool
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    finally:
+        page.close()
+
+def extract_text_from_pdf(file_path, enable_ocr=False, ocr_threshold=0.1):
+    parts = []
+    links = []
+
+    try:
+        for page_number in range(count_pdf_pages(file_path)):
+            page_text, page_links, needs_ocr = extract_pdf_page(file_path, page_number, enable_ocr, ocr_threshold)
+            parts.append(page_text)
+            if needs_ocr:
+                parts.append(ocr_pdf_page(file_path, page_number))
+            links.extend(page_links)
+
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF {file_path}: {e}")
+
+    return "\n".join(parts), links
+
+# Markdown is parsed into CommonMark block tokens (markdown-it-py) and turned into plain text, rather than
+# rendered to HTML and parsed back, so the heading structure survives: every heading starts a section titled
+# with its heading path ("Pets > Carry-On Pets"), and the heading stays the first line of the section's text.
+# Paragraphs, list items, code blocks and tables are the blocks of a section's text.
+MARKDOWN = MarkdownIt('commonmark').enable('table')
+# Nothing is rendered, so links are kept whatever their scheme (the parser drops javascript: links by default)
+MARKDOWN.validateLink = lambda url: True
+TAG_PATTERN = re.compile(r'</?[A-Za-z][^>]*>')
+
+def inline_text(token, links):
+    # Plain text of an inline token; links found in it are appended to links
+    parts = []
+    link = None  # (url, index in parts where the link text starts)
+    for child in token.children or []:
+        if child.type in ('text', 'code_inline'):
+            parts.append(child.content)
+        elif child.type in ('softbreak', 'hardbreak'):
+            parts.append('\n')
+        elif child.type == 'link_open':
+            link = (child.attrGet('href'), len(parts))
+        elif child.type == 'link_close' and link is not None:
+            links.append({'text': ' '.join(''.join(parts[link[1]:]).split()), 'url': link[0]})
+            link = None
+        # Emphasis markers, images and inline HTML tags add no text
+    return ''.join(parts)
+
+def parse_markdown(content):
+    # Returns (sections, links); sections are {'title', 'text'} dicts in document order
+    links = []
+    sections = []
+    headings = []  # (level, text) of the enclosing headings
+    blocks = []  # text of the current section, one entry per paragraph, list item, code block or table
+    rows = None  # rows of the table being read
+    cells = None  # cells of the table row being read
+
+    def open_section(level, heading):
+        text = '\n\n'.join(blocks)
+        if text:
+            sections.append({'title': ' > '.join(title for _, title in headings) or None, 'text': text})
+        blocks.clear()
+        if level:
+            headings[:] = [entry for entry in headings if entry[0] < level] + [(level, heading)]
+            blocks.append(heading)
+
+    tokens = MARKDOWN.parse(content)
+    for index, token in enumerate(tokens):
+        if token.type == 'inline':
+            text = inline_text(token, links).strip()
+            if tokens[index - 1].type == 'heading_open':
+                open_section(int(tokens[index - 1].tag[1:]), text)
+            elif cells is not None:
+                cells.append(text)
+            elif text:
+                blocks.append(text)
+        elif token.type in ('fence', 'code_block'):
+            text = token.content.strip('\n')
+            if text.strip():
+                blocks.append(text)
+        elif token.type == 'html_block':
+            text = html.unescape(TAG_PATTERN.sub('', token.content)).strip()
+            if text:
+                blocks.append(text)
+        elif token.type == 'table_open':
+            rows = []
+        elif token.type == 'tr_open':
+            cells = []
+        elif token.type == 'tr_close':
+            rows.append(' | '.join(cells))
+            cells = None
+        elif token.type == 'table_close':
+            blocks.append('\n'.join(rows))
+            rows = None
+    open_section(0, None)
+    return sections, links
+
+def extract_markdown_sections(file_path):
+    # sections is None if the file could not be read or parsed
+    sections, links = None, []
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            sections, links = parse_markdown(file.read())
+    except Exception as e:
+        logger.error(f"Error processing markdown {file_path}: {e}")
+    return sections, links
@@ -0,0 +1,328 @@
+import argparse
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from config import (
+    INGEST_JOBS_PATH, INGEST_JOBS_KEEP, INGEST_LOCK_PATH, INGEST_NICENESS, INGEST_CPUS, RELOAD_WORKERS_AFTER_INGEST
+)
+from utils.ingestion import ingest_documents
+from utils.logging_config import setup_logging
+from utils.serving import register_master, registered_master, request_worker_reload
+from utils.store_registry import get_store
+from utils.vector_search import current_generation
+
+logger = logging.getLogger(__name__)
+
+# Ingest job queue shared by every worker using STORAGE_PATH. Each job is a JSON file in INGEST_JOBS_PATH.
+# Requests for a directory that already has a queued or running job share that job instead of starting
+# another. Whichever worker takes the exclusive flock on INGEST_LOCK_PATH runs the queued jobs one at a time,
+# each in a child process at a lower CPU priority (and on at most INGEST_CPUS cores), so indexing neither
+# holds a request thread nor takes CPU from the workers answering queries. A crashed runner releases the lock
+# with its processes, and its job then reads as interrupted.
+STATUS_WRITE_INTERVAL = 1.0
+# Working directory of the job processes, so they import config and utils like the app does
+CHATBOT_DIR = Path(__file__).resolve().parent.parent
+ACTIVE_STATES = ('queued', 'running')
+
+os.makedirs(INGEST_JOBS_PATH, exist_ok=True)
+
+def acquire_lock(path=INGEST_LOCK_PATH, blocking=False):
+    # Returns the locked file, or None if another process holds the lock
+    handle = open(path, 'a+')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        handle.close()
+        return None
+    return handle
+
+def release_lock(handle):
+    fcntl.flock(handle, fcntl.LOCK_UN)
+    handle.close()
+
+def ingest_running():
+    handle = acquire_lock()
+    if handle is None:
+        return True
+    release_lock(handle)
+    return False
+
+@contextmanager
+def queue_lock():
+    # Held briefly while jobs are added, coalesced or claimed
+    handle = acquire_lock(INGEST_LOCK_PATH + '.queue', blocking=True)
+    try:
+        yield
+    finally:
+        release_lock(handle)
+
+def job_path(job_id):
+    return os.path.join(INGEST_JOBS_PATH, f"{job_id}.json")
+
+def write_job(job):
+    path = job_path(job['id'])
+    try:
+        with open(f"{path}.{os.getpid()}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(job, f, default=str)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+    except OSError as e:
+        logger.warning(f"Could not write the status of ingest job {job['id']}: {e}")
+
+def read_job(job_id, running=None):
+    # running: whether a runner holds the lock, if the caller already knows
+    try:
+        with open(job_path(job_id), encoding='utf-8') as f:
+            job = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read the status of ingest job {job_id}: {e}")
+        return None
+    if job['state'] == 'running' and not (ingest_running() if running is None else running):
+        job['state'] = 'interrupted'
+    return job
+
+def list_jobs():
+    # Newest first
+    running = ingest_running()
+    jobs = []
+    for name in os.listdir(INGEST_JOBS_PATH):
+        if name.endswith('.json'):
+            job = read_job(name[:-5], running)
+            if job is not None:
+                jobs.append(job)
+    return sorted(jobs, key=lambda job: job['createdAt'], reverse=True)
+
+def latest_job():
+    jobs = list_jobs()
+    return jobs[0] if jobs else None
+
+def remove_old_jobs(jobs):
+    finished = [job for job in jobs if job['state'] not in ACTIVE_STATES]
+    for job in finished[INGEST_JOBS_KEEP:]:
+        try:
+            os.remove(job_path(job['id']))
+        except OSError:
+            pass
+
+def new_job(directory):
+    now = time.time()
+    return {
+        'id': uuid.uuid4().hex[:12],
+        'state': 'queued',
+        'directory': directory,
+        'createdAt': now,
+        'updatedAt': now,
+        'startedAt': None,
+        'finishedAt': None,
+        'pid': None,
+        'stage': 'queued',
+        'filesTotal': 0,
+        'filesDone': 0,
+        'chunksDone': 0,
+        'chunksRemoved': 0,
+        'checkpoints': 0,
+        'stats': None,
+        'generation': None,
+        'workersReloading': False,
+        'error': None,
+    }
+
+def submit_ingest(directory):
+    # Returns (job, coalesced): the queued or running job for the same directory if there is one,
+    # otherwise a newly queued job
+    directory = str(Path(directory).resolve())
+    with queue_lock():
+        jobs = list_jobs()
+        for job in jobs:
+            if job['directory'] == directory and job['state'] in ACTIVE_STATES:
+                logger.info(f"Ingest of {directory} joins job {job['id']} ({job['state']})")
+                return job, True
+        job = new_job(directory)
+        write_job(job)
+        remove_old_jobs(jobs)
+    logger.info(f"Queued ingest job {job['id']} for {directory}")
+    start_runner()
+    return job, False
+
+def wait_for_job(job_id, poll_interval=0.5):
+    while True:
+        job = read_job(job_id)
+        if job is None or job['state'] not in ACTIVE_STATES:
+            return job
+        time.sleep(poll_interval)
+
+def claim_next_job():
+    # Oldest queued job, marked running; only called by the runner holding the ingest lock
+    with queue_lock():
+        jobs = list_jobs()
+        for job in jobs:
+            if job['state'] != 'running':
+                continue
+            # Nothing runs while this runner holds the lock, so these were left by a runner that stopped
+            if job['pid'] is None:
+                job['state'] = 'queued'
+            else:
+                job.update(state='interrupted', finishedAt=job['updatedAt'])
+            write_job(job)
+        queued = [job for job in jobs if job['state'] == 'queued']
+        if not queued:
+            return None
+        job = min(queued, key=lambda job: job['createdAt'])
+        job.update(state='running', stage='starting', updatedAt=time.time())
+        write_job(job)
+        return job
+
+def start_runner():
+    # Starts running the queue in this process unless another process already does; also picks up
+    # jobs left queued by a runner that exited
+    lock = acquire_lock()
+    if lock is None:
+        return False
+    threading.Thread(target=run_queue, args=(lock,), name='ingest-runner', daemon=True).start()
+    return True
+
+def run_queue(lock):
+    try:
+        while True:
+            job = claim_next_job()
+            if job is None:
+                break
+            run_job_process(job, lock)
+    finally:
+        release_lock(lock)
+    # A job queued after the last claim, while this runner still held the lock
+    if any(job['state'] == 'queued' for job in list_jobs()):
+        start_runner()
+
+def run_job_process(job, lock):
+    # The job runs in a fresh interpreter (python -m utils.ingest_jobs <id>) rather than a fork of this
+    # threaded worker: a forked child inherits every lock another thread held at the fork (metrics,
+    # embedding runtime and cache, OpenMP) and can wait on it forever, holding the ingest lock with it.
+    # The child gets the descriptor of the ingest lock, so the lock stays held until it exits even if this
+    # worker dies first. Under gunicorn it inherits PROMETHEUS_MULTIPROC_DIR, so its metrics are aggregated
+    # with the workers'.
+    command = [sys.executable, '-m', 'utils.ingest_jobs', job['id']]
+    if registered_master() is not None:
+        command += ['--master-pid', str(registered_master())]
+    try:
+        process = subprocess.Popen(command, cwd=CHATBOT_DIR, pass_fds=(lock.fileno(),))
+        limit_resources(process.pid)
+        status = process.wait()
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            # Drop the per-process gauges of the job process, as gunicorn does for its workers
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(process.pid)
+    except OSError as e:
+        logger.error(f"Could not start the process for ingest job {job['id']}: {e}")
+        status = str(e)
+    finished = read_job(job['id'], running=True)
+    if finished is not None and finished['state'] == 'running':
+        # The child died without recording an outcome (killed, out of memory, ...)
+        finished.update(state='failed', error=f"Ingest process exited with status {status}", finishedAt=time.time())
+        write_job(finished)
+    elif finished is not None and finished['state'] == 'done':
+        # Swap the new generation in for this worker right away; the others are reloaded by the master
+        # or pick it up from disk
+        get_store(force=True)
+
+def limit_resources(pid):
+    # The job process runs at a lower priority than the serving threads, optionally pinned to INGEST_CPUS cores.
+    # Set right after it starts, before it has any other threads, so its imports already run niced and the
+    # threads and extraction pools it starts inherit both.
+    try:
+        if INGEST_NICENESS:
+            os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, 0) + INGEST_NICENESS)
+        if INGEST_CPUS and hasattr(os, 'sched_setaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(pid, cpus[-INGEST_CPUS:])
+    except OSError as e:
+        logger.warning(f"Could not limit the resources of ingest process {pid}: {e}")
+
+class JobProgress:
+    # Writes a running job's progress at most once per STATUS_WRITE_INTERVAL; stage changes are always written
+    def __init__(self, job):
+        self.job = job
+        self.last_write = 0.0
+
+    def update(self, force=False, **fields):
+        stage_changed = 'stage' in fields and fields['stage'] != self.job['stage']
+        self.job.update(fields)
+        self.job['updatedAt'] = time.time()
+        now = time.monotonic()
+        if force or stage_changed or now - self.last_write >= STATUS_WRITE_INTERVAL:
+            self.last_write = now
+            write_job(self.job)
+
+    def __call__(self, counters):
+        self.update(
+            stage=counters['stage'],
+            filesTotal=counters['files_total'],
+            filesDone=counters['files_done'],
+            chunksDone=counters['chunks_done'],
+            chunksRemoved=counters['chunks_removed'],
+            checkpoints=counters['checkpoints'],
+        )
+
+def run_job(job):
+    # Runs in the job process
+    progress = JobProgress(job)
+    progress.update(force=True, pid=os.getpid(), startedAt=time.time())
+    try:
+        _, _, stats = ingest_documents(job['directory'], progress=progress)
+        # The generation marker was switched last by the save, so serving workers see the whole new index or none
+        # of it. The master is asked from here, as the worker that started this process may be replaced meanwhile;
+        # while more jobs are queued, workers pick the generation up from disk instead of being replaced under
+        # the runner.
+        more_queued = any(other['state'] == 'queued' for other in list_jobs())
+        workers_reloading = RELOAD_WORKERS_AFTER_INGEST and not more_queued and request_worker_reload()
+        progress.update(
+            force=True, state='done', stage='done', stats=stats, generation=current_generation(),
+            workersReloading=workers_reloading, finishedAt=time.time()
+        )
+    except BaseException as e:
+        logger.exception(f"Ingest job {job['id']} of {job['directory']} failed")
+        progress.update(force=True, state='failed', error=str(e) or type(e).__name__, finishedAt=time.time())
+        raise
+
+def main(argv=None):
+    # Entry point of the job process started by run_job_process
+    parser = argparse.ArgumentParser(description="Run one queued ingest job")
+    parser.add_argument('job_id')
+    parser.add_argument('--master-pid', type=int, help="gunicorn master to ask for a worker reload afterwards")
+    args = parser.parse_args(argv)
+    setup_logging(level=logging.INFO)
+    if args.master_pid:
+        register_master(args.master_pid)
+    if INGEST_CPUS and hasattr(os, 'sched_getaffinity'):
+        # One OpenMP thread per core the runner pinned this process to
+        import faiss
+        faiss.omp_set_num_threads(len(os.sched_getaffinity(0)))
+
+    # The runner that started this process holds the ingest lock
+    job = read_job(args.job_id, running=True)
+    if job is None:
+        logger.error(f"Ingest job {args.job_id} not found")
+        return 1
+    try:
+        run_job(job)
+    except BaseException:
+        return 1  # Logged and recorded in the job status
+    finally:
+        # The runner does this too once the process has exited, unless the reload this job asked for
+        # replaced its worker first
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(os.getpid())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,53 +1,540 @@
-import logging
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from utils.file_loader import extract_text_from_pdf, extract_text_from_markdown
-from utils.utils import split_content, enrich_chunks
-from utils.embeddings import generate_embeddings
-from utils.vector_search import setup_faiss_vector_store
-from utils.utils import get_recognized_airlines
-
-logger = logging.getLogger(__name__)
-
-def process_file(file_path, airline_name):
-    try:
-        if file_path.suffix.lower() == '.pdf':
-            text, links = extract_text_from_pdf(file_path)
-        elif file_path.suffix.lower() == '.md':
-            text, links = extract_text_from_markdown(file_path)
-        else:
-            logger.warning(f"Unsupported file type: {file_path}")
-            return []
-
-        chunks = split_content(text)
-        enriched_chunks = enrich_chunks(chunks, file_path.name, links, airline_name)
-        return enriched_chunks
-
-    except Exception as e:
-        logger.error(f"Error processing file {file_path}: {e}")
-        return []
-
-def ingest_documents(directory):
-    all_chunks = []
-    directory_path = Path(directory)
-
-    with ThreadPoolExecutor() as executor:
-        futures = []
-        for airline_folder in directory_path.iterdir():
-            if airline_folder.is_dir():
-                airline_name = airline_folder.stem
-                for file_path in airline_folder.rglob("*"):
-                    futures.append(executor.submit(process_file, file_path, airline_name))
-
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                all_chunks.extend(result)
-
-    # Generate embeddings and setup FAISS vector store
-    texts = [chunk['text'] for chunk in all_chunks]
-    embeddings = generate_embeddings(texts)
-    vector_store = setup_faiss_vector_store(all_chunks)
-    recognized_airlines = get_recognized_airlines(vector_store)
-    return vector_store, recognized_airlines
-
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from itertools import islice
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from config import (
+    EXTRACT_WORKERS, OCR_WORKERS, ENABLE_OCR, OCR_THRESHOLD, INGEST_BATCH_CHUNKS, INGEST_QUEUE_SIZE,
+    INGEST_FILES_IN_FLIGHT, INGEST_CHECKPOINT_SECONDS, INGEST_CHECKPOINT_CHUNKS, INGEST_CHECKPOINT_PATH,
+    INGEST_EMBED_IN_FLIGHT, KEYWORD_STATS_PATH
+)
+from utils.file_loader import count_pdf_pages, extract_pdf_page, ocr_pdf_page, extract_markdown_sections
+from utils.chunking import chunk_sections, chunker_settings
+from utils.utils import enrich_chunks
+from utils.embeddings import generate_embeddings
+from utils.vector_search import (
+    load_faiss_vector_store, save_faiss_vector_store, load_vector_store_at, write_vector_store,
+    create_streaming_vector_store, train_configured_index, add_documents_with_ids, remove_documents_by_ids,
+    supports_incremental_updates, matches_configured_index, get_documents
+)
+from utils.compact_store import CompactDocstore, ChunkIdMap, is_compact_store, iter_sorted_documents
+from utils.keywords import KeywordExtractor, STATS_FILE as KEYWORD_STATS_FILE
+from utils.manifest import new_manifest, load_manifest, save_manifest, fingerprint_file
+from utils.utils import get_recognized_airlines
+from prometheus_client import Counter, Histogram
+from utils.metrics import trace_stage
+
+logger = logging.getLogger(__name__)
+
+INGEST_STAGES = ('extract', 'chunk', 'embedding', 'index', 'total')
+INGEST_STAGE_SECONDS = Histogram(
+    'chatbot_ingest_stage_seconds', 'Time spent in each ingestion stage', ['stage'],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+INGEST_FILES = Counter('chatbot_ingest_files_total', 'Policy files seen by ingestion, by status', ['status'])
+INGEST_PAGES = Counter('chatbot_ingest_pages_total', 'PDF pages extracted')
+INGEST_OCR_PAGES = Counter('chatbot_ingest_ocr_pages_total', 'PDF pages sent to OCR')
+INGEST_CHUNKS = Counter('chatbot_ingest_chunks_total', 'Chunks added to or removed from the index', ['operation'])
+
+# End of a bounded stage's output
+_DONE = object()
+
+def bounded_stage(items, maxsize, name='ingest-stage'):
+    # Runs a generator in a background thread, at most maxsize items ahead of its consumer, so the next
+    # batches are prepared while the current one is embedded without the whole corpus piling up in memory.
+    # An exception in the generator is raised in the consumer; a consumer that stops early stops the generator.
+    results = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+            put((True, _DONE))
+        except BaseException as e:
+            put((False, e))
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = results.get()
+            if not ok:
+                raise item
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def iter_extracted_documents(files, stats):
+    # Extracts files in a process pool and yields (file, sections, links, error) in input order: the heading
+    # sections of a Markdown file or the pages of a PDF, as utils.chunking takes them. sections is None when
+    # the file could not be extracted at all; error describes what failed, also when only some PDF pages
+    # did, and is None for a file extracted in full. PDFs fan out one task
+    # per page so CPU-bound parsing runs on all cores and one large PDF does not hold up the rest; text-light
+    # pages go to a separate, smaller OCR pool. At most INGEST_FILES_IN_FLIGHT files are extracted at once,
+    # so the extracted text of a large corpus is never held in memory all together.
+    stats.setdefault('pages', 0)
+    stats.setdefault('ocr_pages', 0)
+    if not files:
+        return
+    stats_lock = threading.Lock()
+
+    with ProcessPoolExecutor(max_workers=EXTRACT_WORKERS) as pool, \
+            ProcessPoolExecutor(max_workers=OCR_WORKERS) as ocr_pool, \
+            ThreadPoolExecutor(max_workers=INGEST_FILES_IN_FLIGHT, thread_name_prefix='ingest-extract') as files_pool:
+
+        def extract_file(file_path):
+            if file_path.suffix.lower() != '.pdf':
+                sections, links = pool.submit(extract_markdown_sections, file_path).result()
+                return sections, links, None if sections is not None else "Markdown extraction failed"
+
+            try:
+                page_count = pool.submit(count_pdf_pages, file_path).result()
+            except Exception as e:
+                logger.error(f"Error extracting text from PDF {file_path}: {e}")
+                return None, [], f"PDF extraction failed: {e}"
+            pages = [[] for _ in range(page_count)]
+            page_links = [[] for _ in range(page_count)]
+            page_futures = {
+                pool.submit(extract_pdf_page, file_path, page_number, ENABLE_OCR, OCR_THRESHOLD): page_number
+                for page_number in range(page_count)
+            }
+
+            ocr_futures = {}
+            failed_pages = set()
+            for future in as_completed(page_futures):
+                page_number = page_futures[future]
+                try:
+                    page_text, links, needs_ocr = future.result()
+                except Exception as e:
+                    logger.error(f"Error extracting page {page_number + 1} of PDF {file_path}: {e}")
+                    failed_pages.add(page_number + 1)
+                    continue
+                pages[page_number].append(page_text)
+                page_links[page_number] = links
+                if needs_ocr:
+                    ocr_futures[ocr_pool.submit(ocr_pdf_page, file_path, page_number)] = page_number
+
+            for future in as_completed(ocr_futures):
+                page_number = ocr_futures[future]
+                try:
+                    pages[page_number].append(future.result())
+                except Exception as e:
+                    logger.error(f"Error running OCR on page {page_number + 1} of PDF {file_path}: {e}")
+                    failed_pages.add(page_number + 1)
+
+            with stats_lock:
+                stats['pages'] += page_count
+                stats['ocr_pages'] += len(ocr_futures)
+            sections = [
+                {'text': "\n".join(parts), 'page': page_number + 1} for page_number, parts in enumerate(pages)
+            ]
+            error = None
+            if failed_pages:
+                error = f"PDF pages {', '.join(str(page) for page in sorted(failed_pages))} could not be extracted"
+            return sections, [link for links in page_links for link in links], error
+
+        pending = deque()
+        remaining = iter(files)
+        try:
+            for item in islice(remaining, INGEST_FILES_IN_FLIGHT):
+                pending.append((item, files_pool.submit(extract_file, item[2])))
+            while pending:
+                item, future = pending.popleft()
+                sections, links, error = future.result()
+                for next_item in islice(remaining, 1):
+                    pending.append((next_item, files_pool.submit(extract_file, next_item[2])))
+                yield item, sections, links, error
+        finally:
+            # Stopped early: files not started yet are skipped; pages already queued still finish
+            for _, future in pending:
+                future.cancel()
+
+def chunk_document(sections, links, file_name, airline_name):
+    # Returns None if the file could not be chunked
+    try:
+        chunks = chunk_sections(sections)
+        enriched_chunks = enrich_chunks(chunks, file_name, links, airline_name)
+        return enriched_chunks
+
+    except Exception as e:
+        logger.error(f"Error processing file {file_name}: {e}")
+        return None
+
+def iter_chunk_batches(extracted, stats):
+    # Chunks and enriches each extracted file and groups whole files into batches of at least
+    # INGEST_BATCH_CHUNKS chunks. A file never spans two batches, so once a batch is indexed the
+    # manifest can record its files as done. Batches hold (relative_path, chunks, error); chunks is None
+    # for a file that could not be extracted or chunked.
+    stats.setdefault('extract_seconds', 0.0)
+    stats.setdefault('chunk_seconds', 0.0)
+    batch, size = [], 0
+    while True:
+        # Time spent waiting for the extraction pools
+        stage_start = time.perf_counter()
+        item = next(extracted, None)
+        stats['extract_seconds'] += time.perf_counter() - stage_start
+        if item is None:
+            break
+
+        (relative_path, airline_name, file_path), sections, links, error = item
+        chunks = None
+        if sections is not None:
+            stage_start = time.perf_counter()
+            chunks = chunk_document(sections, links, file_path.name, airline_name)
+            stats['chunk_seconds'] += time.perf_counter() - stage_start
+            if chunks is None:
+                error = "Chunking failed"
+        batch.append((relative_path, chunks, error))
+        size += len(chunks or [])
+        if size >= INGEST_BATCH_CHUNKS:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+def iter_embedded_batches(batches, stats):
+    # Requests the embeddings of up to INGEST_EMBED_IN_FLIGHT batches at once, so the next batches are
+    # embedded while the current one is indexed and their requests together fill the process's
+    # EMBEDDING_CONCURRENCY limit. Yields (batch, chunks, embeddings) in batch order.
+    pool = ThreadPoolExecutor(max_workers=INGEST_EMBED_IN_FLIGHT, thread_name_prefix='ingest-embed')
+    pending = deque()
+
+    def embed(chunks):
+        # Each call counts into its own dict, merged once it is done, as the calls run side by side
+        call_stats = {}
+        return generate_embeddings([chunk['text'] for chunk in chunks], stats=call_stats), call_stats
+
+    try:
+        batches = iter(batches)
+        while True:
+            while len(pending) < INGEST_EMBED_IN_FLIGHT:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                chunks = [chunk for _, file_chunks, _ in batch for chunk in file_chunks or []]
+                pending.append((batch, chunks, pool.submit(embed, chunks)))
+            if not pending:
+                return
+            batch, chunks, future = pending.popleft()
+            # Time the index stage spends waiting for embeddings
+            stage_start = time.perf_counter()
+            embeddings, call_stats = future.result()
+            stats['embedding_seconds'] += time.perf_counter() - stage_start
+            for key, value in call_stats.items():
+                if key != 'embedding_seconds':
+                    stats[key] += value
+            yield batch, chunks, embeddings
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+SUPPORTED_SUFFIXES = {'.pdf', '.md'}
+
+def scan_policy_files(directory_path):
+    # Yields (relative path, airline name, file path) for every supported file, one folder per airline
+    for airline_folder in sorted(directory_path.iterdir()):
+        if airline_folder.is_dir():
+            airline_name = airline_folder.stem
+            for file_path in sorted(airline_folder.rglob("*")):
+                if not file_path.is_file():
+                    continue
+                if file_path.suffix.lower() not in SUPPORTED_SUFFIXES:
+                    logger.warning(f"Unsupported file type: {file_path}")
+                    continue
+                yield file_path.relative_to(directory_path).as_posix(), airline_name, file_path
+
+# Checkpoints of an ingest in progress: the index, documents and manifest of every file indexed so far,
+# written to a fresh directory under INGEST_CHECKPOINT_PATH and named by the 'current' file once complete
+
+def checkpoint_directory():
+    pointer = os.path.join(INGEST_CHECKPOINT_PATH, 'current')
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        directory = os.path.join(INGEST_CHECKPOINT_PATH, f.read().strip())
+    return directory if is_compact_store(directory) else None
+
+def write_checkpoint(vector_store, manifest, keywords):
+    name = uuid.uuid4().hex
+    directory = os.path.join(INGEST_CHECKPOINT_PATH, name)
+    rows = write_vector_store(vector_store, directory)
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    keywords.save(os.path.join(directory, KEYWORD_STATS_FILE))
+
+    pointer = os.path.join(INGEST_CHECKPOINT_PATH, 'current')
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(name)
+    os.replace(pointer + '.tmp', pointer)
+
+    # The documents indexed so far are read back from the checkpoint's mapped files instead of staying in memory
+    vector_store.docstore = CompactDocstore(directory)
+    vector_store.index_to_docstore_id = ChunkIdMap(vector_store.docstore.ids)
+    for other in os.listdir(INGEST_CHECKPOINT_PATH):
+        if other not in (name, 'current'):
+            shutil.rmtree(os.path.join(INGEST_CHECKPOINT_PATH, other), ignore_errors=True)
+    logger.info(f"Checkpointed the ingest at {rows} chunks")
+
+def remove_checkpoint():
+    shutil.rmtree(INGEST_CHECKPOINT_PATH, ignore_errors=True)
+
+def load_checkpoint(directory_path):
+    directory = checkpoint_directory()
+    if directory is None:
+        return None, None
+    try:
+        with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest['directory'] != str(directory_path.resolve()):
+            logger.info("Discarding the checkpoint of an interrupted ingest of another directory")
+            remove_checkpoint()
+            return None, None
+        vector_store = load_vector_store_at(directory, writable=True)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Discarding an unreadable ingest checkpoint: {e}")
+        remove_checkpoint()
+        return None, None
+    logger.info(f"Resuming an interrupted ingest from its checkpoint ({vector_store.index.ntotal} chunks)")
+    return vector_store, manifest
+
+def load_incremental_state(directory_path):
+    # Resume an interrupted ingest of the same directory from its checkpoint. Otherwise reuse the stored
+    # index only if it was built from the same directory, can remove vectors, is of the configured type,
+    # and holds exactly the chunks the manifest says it does. Returns (vector store, manifest, resumed).
+    vector_store, manifest = load_checkpoint(directory_path)
+    if vector_store is not None:
+        return vector_store, manifest, True
+
+    manifest = load_manifest()
+    if manifest is None or manifest['directory'] != str(directory_path.resolve()):
+        return None, new_manifest(directory_path.resolve()), False
+
+    vector_store, _ = load_faiss_vector_store(writable=True)
+    if vector_store is None or not supports_incremental_updates(vector_store):
+        return None, new_manifest(directory_path.resolve()), False
+    if not matches_configured_index(vector_store.index):
+        logger.info("Stored index type differs from VECTOR_INDEX_TYPE; rebuilding from scratch")
+        return None, new_manifest(directory_path.resolve()), False
+
+    manifest_ids = {chunk_id for entry in manifest['files'].values() for chunk_id in entry['chunk_ids']}
+    if manifest_ids != set(vector_store.index_to_docstore_id):
+        logger.warning("Ingest manifest does not match the stored index; rebuilding from scratch")
+        return None, new_manifest(directory_path.resolve()), False
+    return vector_store, manifest, False
+
+def load_keyword_extractor(vector_store, resumed):
+    # Document frequencies saved with the index (or with the checkpoint being resumed), recounted from the
+    # indexed chunks when they are missing or do not match the index
+    if vector_store is None:
+        return KeywordExtractor()
+    path = os.path.join(checkpoint_directory(), KEYWORD_STATS_FILE) if resumed else KEYWORD_STATS_PATH
+    keywords = KeywordExtractor.load(path)
+    if keywords is None or keywords.documents != vector_store.index.ntotal:
+        logger.info("Recounting keyword document frequencies from the indexed chunks")
+        keywords = KeywordExtractor.from_texts(
+            doc.page_content for _, doc in iter_sorted_documents(vector_store.index_to_docstore_id, vector_store.docstore)
+        )
+    return keywords
+
+def record_ingest_metrics(stats):
+    for status in ('added', 'changed', 'removed', 'unchanged', 'failed'):
+        INGEST_FILES.labels(status=status).inc(stats[f'files_{status}'])
+    INGEST_PAGES.inc(stats.get('pages', 0))
+    INGEST_OCR_PAGES.inc(stats.get('ocr_pages', 0))
+    INGEST_CHUNKS.labels(operation='added').inc(stats['chunks'])
+    INGEST_CHUNKS.labels(operation='removed').inc(stats['chunks_removed'])
+    for stage in INGEST_STAGES:
+        INGEST_STAGE_SECONDS.labels(stage=stage).observe(stats[f'{stage}_seconds'])
+        if stage != 'total':
+            trace_stage(f"ingest_{stage}", stats[f'{stage}_seconds'])
+
+def ingest_documents(directory, progress=None):
+    # Streams the files that need work through extract -> chunk -> embed -> index one batch at a time, so
+    # memory holds a few batches rather than the whole corpus. progress, if given, is called with a dict of
+    # counters after every batch and checkpoint.
+    directory_path = Path(directory)
+    start = time.perf_counter()
+    stats = {
+        'files_added': 0, 'files_changed': 0, 'files_removed': 0, 'files_unchanged': 0, 'files_failed': 0,
+        'failed_files': {},
+        'chunks': 0, 'chunks_removed': 0, 'extract_seconds': 0.0, 'chunk_seconds': 0.0, 'keyword_seconds': 0.0,
+        'index_seconds': 0.0,
+        'embedding_seconds': 0.0, 'embedding_calls': 0, 'embedding_batches': 0, 'embedding_retries': 0,
+        'cache_hits': 0, 'cache_misses': 0, 'checkpoints': 0,
+    }
+
+    vector_store, manifest, resumed = load_incremental_state(directory_path)
+    stats['resumed'] = resumed
+    keywords = load_keyword_extractor(vector_store, resumed)
+    files = manifest['files']
+    stale_ids = []
+    to_process = []
+    seen = set()
+
+    # Compare every file against the manifest; only added or changed files are extracted again
+    for relative_path, airline_name, file_path in scan_policy_files(directory_path):
+        seen.add(relative_path)
+        entry = files.get(relative_path)
+        fingerprint, changed = fingerprint_file(file_path, entry)
+        # Files chunked with other chunking settings are chunked again, and so are files that were only
+        # partly extracted
+        fingerprint['chunker'] = chunker_settings()
+        changed = changed or entry.get('chunker') != fingerprint['chunker'] or 'error' in entry
+        if not changed:
+            files[relative_path] = dict(entry, **fingerprint)
+            stats['files_unchanged'] += 1
+            continue
+        if entry:
+            stale_ids.extend(files.pop(relative_path)['chunk_ids'])
+            stats['files_changed'] += 1
+        else:
+            stats['files_added'] += 1
+        to_process.append((relative_path, airline_name, file_path, fingerprint))
+
+    for relative_path in [path for path in files if path not in seen]:
+        stale_ids.extend(files.pop(relative_path)['chunk_ids'])
+        stats['files_removed'] += 1
+
+    def report(stage):
+        if progress is not None:
+            progress({
+                'stage': stage,
+                'files_total': len(to_process),
+                'files_done': files_done,
+                'chunks_done': stats['chunks'],
+                'chunks_removed': stats['chunks_removed'],
+                'checkpoints': stats['checkpoints'],
+            })
+
+    files_done = 0
+    report('scanning')
+    # From here on the manifest only lists files whose chunks are in the index, so a checkpoint of the
+    # two always agrees
+    if vector_store is not None and stale_ids:
+        stage_start = time.perf_counter()
+        indexed = [chunk_id for chunk_id in stale_ids if chunk_id in vector_store.index_to_docstore_id]
+        keywords.remove_texts([doc.page_content for doc in get_documents(vector_store, indexed)])
+        stats['chunks_removed'] = remove_documents_by_ids(vector_store, stale_ids)
+        stats['index_seconds'] += time.perf_counter() - stage_start
+
+    fingerprints = {relative_path: (airline_name, fingerprint) for relative_path, airline_name, _, fingerprint in to_process}
+    extracted = iter_extracted_documents([item[:3] for item in to_process], stats)
+    batches = bounded_stage(iter_chunk_batches(extracted, stats), INGEST_QUEUE_SIZE, name='ingest-chunk')
+    embedded = iter_embedded_batches(batches, stats)
+    last_checkpoint = time.monotonic()
+    chunks_since_checkpoint = 0
+    try:
+        while True:
+            report('embedding')
+            item = next(embedded, None)
+            if item is None:
+                break
+            batch, chunks, embeddings = item
+            ids = list(range(manifest['next_id'], manifest['next_id'] + len(chunks)))
+            manifest['next_id'] += len(chunks)
+
+            stage_start = time.perf_counter()
+            keywords.add_keywords(chunks)
+            stats['keyword_seconds'] += time.perf_counter() - stage_start
+
+            stage_start = time.perf_counter()
+            if chunks:
+                if vector_store is None:
+                    vector_store = create_streaming_vector_store(embeddings.shape[1])
+                add_documents_with_ids(vector_store, chunks, embeddings, ids)
+            del embeddings
+            offset = 0
+            for relative_path, file_chunks, error in batch:
+                if error is not None:
+                    stats['files_failed'] += 1
+                    stats['failed_files'][relative_path] = error
+                if file_chunks is None:
+                    # Left out of the manifest, so the next ingest tries the file again
+                    continue
+                airline_name, fingerprint = fingerprints[relative_path]
+                files[relative_path] = dict(
+                    fingerprint, airline_name=airline_name, chunk_ids=ids[offset:offset + len(file_chunks)]
+                )
+                if error is not None:
+                    # Indexed without its failed pages; the error makes the next ingest extract it again
+                    files[relative_path]['error'] = error
+                offset += len(file_chunks)
+            files_done += len(batch)
+            stats['chunks'] += len(chunks)
+            chunks_since_checkpoint += len(chunks)
+
+            more_files = files_done < len(to_process)
+            if vector_store is not None and more_files and (
+                (INGEST_CHECKPOINT_CHUNKS and chunks_since_checkpoint >= INGEST_CHECKPOINT_CHUNKS)
+                or (INGEST_CHECKPOINT_SECONDS and time.monotonic() - last_checkpoint >= INGEST_CHECKPOINT_SECONDS)
+            ):
+                write_checkpoint(vector_store, manifest, keywords)
+                stats['checkpoints'] += 1
+                last_checkpoint = time.monotonic()
+                chunks_since_checkpoint = 0
+            stats['index_seconds'] += time.perf_counter() - stage_start
+            report('indexing')
+    finally:
+        embedded.close()
+        batches.close()
+    # Keywords are part of enrichment, reported with the chunk stage
+    stats['chunk_seconds'] += stats['keyword_seconds']
+
+    stage_start = time.perf_counter()
+    if vector_store is None:
+        raise ValueError("Cannot build the index without documents")
+    if stats['chunks'] or stats['chunks_removed'] or resumed:
+        report('saving')
+        train_configured_index(vector_store)
+        save_faiss_vector_store(vector_store)
+        # Serve the written generation from its mapped files rather than keeping the ingest's copy in memory
+        vector_store, _ = load_faiss_vector_store()
+
+    # The manifest is written after the index so it never describes chunks that were not saved
+    save_manifest(manifest)
+    keywords.save(KEYWORD_STATS_PATH)
+    remove_checkpoint()
+    recognized_airlines = get_recognized_airlines(vector_store)
+    stats['index_seconds'] += time.perf_counter() - stage_start
+
+    stats['total_seconds'] = time.perf_counter() - start
+    record_ingest_metrics(stats)
+    report('done')
+    logger.info(
+        f"Ingested {stats['files_added']} added / {stats['files_changed']} changed / {stats['files_removed']} removed files "
+        f"({stats['files_unchanged']} unchanged, {stats['files_failed']} failed): {stats['chunks']} new chunks, {stats['chunks_removed']} removed chunks, "
+        f"{stats['embedding_calls']} embedding calls ({stats['embedding_batches']} batches, {stats['embedding_retries']} retries) "
+        f"in {stats['embedding_seconds']:.2f}s, "
+        f"embedding cache {stats['cache_hits']} hits / {stats['cache_misses']} misses, "
+        f"{stats['checkpoints']} checkpoints{' (resumed)' if resumed else ''} (total {stats['total_seconds']:.2f}s)"
+    )
+    if stats['failed_files']:
+        logger.warning(
+            f"{stats['files_failed']} files failed and will be retried by the next ingest: "
+            + ", ".join(f"{path} ({error})" for path, error in stats['failed_files'].items())
+        )
+    return vector_store, recognized_airlines, stats
@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer
+from config import KEYWORDS_PER_CHUNK
+from utils.lexical_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Chunk keywords are the chunk's top TF-IDF terms, weighted with document frequencies over the whole corpus
+# rather than over one file. The frequencies are kept between ingests (keyword_stats.json next to the
+# manifest, and in every checkpoint) and updated as chunks are added and removed, so an incremental ingest
+# only tokenizes the new and the removed chunks. Keywords of chunks already in the index are not recomputed
+# when the frequencies change.
+STATS_VERSION = 1
+STATS_FILE = 'keyword_stats.json'
+# Single characters are never useful keywords
+MIN_KEYWORD_LENGTH = 2
+
+def keyword_tokens(text):
+    return [token for token in tokenize(text) if len(token) >= MIN_KEYWORD_LENGTH]
+
+class KeywordExtractor:
+    def __init__(self, terms=(), document_frequency=(), documents=0):
+        self.terms = list(terms)
+        self.vocabulary = {term: column for column, term in enumerate(self.terms)}
+        self.document_frequency = np.asarray(document_frequency, dtype=np.int64)
+        self.documents = documents
+
+    def count_matrix(self, texts, grow=True):
+        # Term counts of texts as a CSR matrix over the corpus vocabulary. The batch is counted with its own
+        # vocabulary and its columns are then mapped to corpus columns, so only distinct terms touch the dict.
+        vectorizer = CountVectorizer(tokenizer=keyword_tokens, lowercase=False, token_pattern=None, dtype=np.float32)
+        try:
+            counts = vectorizer.fit_transform(texts).tocsr()
+        except ValueError:
+            # No text contains a single term
+            return sp.csr_matrix((len(texts), len(self.terms)), dtype=np.float32)
+
+        batch_terms = vectorizer.get_feature_names_out()
+        columns = np.empty(len(batch_terms), dtype=np.int64)
+        for position, term in enumerate(batch_terms):
+            column = self.vocabulary.get(term)
+            if column is None:
+                if grow:
+                    column = self.vocabulary[term] = len(self.terms)
+                    self.terms.append(term)
+                else:
+                    column = -1
+            columns[position] = column
+
+        known = columns[counts.indices] >= 0
+        rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))[known]
+        return sp.csr_matrix(
+            (counts.data[known], (rows, columns[counts.indices][known])), shape=(counts.shape[0], len(self.terms))
+        )
+
+    def _update(self, counts, sign):
+        if len(self.document_frequency) < len(self.terms):
+            self.document_frequency = np.concatenate([
+                self.document_frequency, np.zeros(len(self.terms) - len(self.document_frequency), dtype=np.int64)
+            ])
+        self.document_frequency[:counts.shape[1]] += sign * np.bincount(counts.indices, minlength=counts.shape[1])
+        self.documents += sign * counts.shape[0]
+        np.maximum(self.document_frequency, 0, out=self.document_frequency)
+        self.documents = max(0, self.documents)
+
+    def add_texts(self, texts):
+        counts = self.count_matrix(texts)
+        self._update(counts, 1)
+        return counts
+
+    def remove_texts(self, texts):
+        self._update(self.count_matrix(texts, grow=False), -1)
+
+    def top_keywords(self, counts, k=KEYWORDS_PER_CHUNK):
+        # Top k terms of every row by TF-IDF (smoothed IDF, as scikit-learn computes it). Each row's non-zero
+        # entries are laid out in a rows x (longest row) block, never rows x vocabulary, and the top k are
+        # picked with one argpartition over the block.
+        rows = counts.shape[0]
+        lengths = np.diff(counts.indptr)
+        if rows == 0 or not lengths.any() or k <= 0:
+            return [[] for _ in range(rows)]
+
+        document_frequency = self.document_frequency[:counts.shape[1]]
+        idf = np.log((1 + self.documents) / (1 + document_frequency)) + 1
+        weights = counts.data * idf[counts.indices]
+
+        width = int(lengths.max())
+        row_of_entry = np.repeat(np.arange(rows), lengths)
+        position = np.arange(len(counts.indices)) - np.repeat(counts.indptr[:-1], lengths)
+        block = np.full((rows, width), -np.inf)
+        block[row_of_entry, position] = weights
+        column_block = np.full((rows, width), -1, dtype=np.int64)
+        column_block[row_of_entry, position] = counts.indices
+
+        if width > k:
+            top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(width), (rows, width))
+        top_weights = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_weights, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_weights = np.take_along_axis(top_weights, order, axis=1)
+        top_columns = np.take_along_axis(column_block, top, axis=1)
+        return [
+            [self.terms[column] for column, weight in zip(columns, row_weights) if weight > 0]
+            for columns, row_weights in zip(top_columns.tolist(), top_weights.tolist())
+        ]
+
+    def add_keywords(self, chunks):
+        # Counts the chunks into the corpus frequencies and sets their 'keywords' metadata
+        counts = self.add_texts([chunk['text'] for chunk in chunks])
+        for chunk, keywords in zip(chunks, self.top_keywords(counts)):
+            chunk['metadata']['keywords'] = keywords
+
+    def save(self, path):
+        # Terms no chunk contains any more are dropped
+        live = np.flatnonzero(self.document_frequency > 0)
+        stats = {
+            'version': STATS_VERSION,
+            'documents': int(self.documents),
+            'terms': [self.terms[column] for column in live],
+            'document_frequency': self.document_frequency[live].tolist(),
+        }
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(stats, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding='utf-8') as f:
+                stats = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable keyword statistics {path}: {e}")
+            return None
+        if stats.get('version') != STATS_VERSION:
+            return None
+        return cls(stats['terms'], stats['document_frequency'], stats['documents'])
+
+    @classmethod
+    def from_texts(cls, texts, batch_size=10000):
+        # Recounts the frequencies of an existing corpus, e.g. an index built before they were kept
+        extractor = cls()
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) >= batch_size:
+                extractor.add_texts(batch)
+                batch = []
+        if batch:
+            extractor.add_texts(batch)
+        return extractor
@@ -0,0 +1,121 @@
+import json
+import logging
+import os
+import re
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS, CountVectorizer
+
+logger = logging.getLogger(__name__)
+
+# Corpus-wide BM25 index over every chunk of a generation, stored next to the FAISS index:
+#   lexical.json          format version, BM25 parameters and the vocabulary (term -> column)
+#   lexical.data.f32      BM25 weight of every (chunk, term) pair, as the CSC arrays of a
+#   lexical.indices.i32   chunks x terms scipy matrix, so one query term is one contiguous
+#   lexical.indptr.i32    column slice. The arrays are memory-mapped like the rest of the generation.
+# Rows are in the same order as the compact store's ids.i64.
+FORMAT_VERSION = 1
+META_FILE = 'lexical.json'
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Keeps hyphenated terms ("carry-on") and amounts ("$35", "23kg") as single tokens
+TOKEN_PATTERN = re.compile(r"[a-z0-9$]+(?:[-'.][a-z0-9]+)*")
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in ENGLISH_STOP_WORDS]
+
+def _map_array(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+def build_lexical_index(directory, texts, ids):
+    # texts are the chunk texts (plus their TF-IDF keywords) in row order
+    vectorizer = CountVectorizer(tokenizer=tokenize, lowercase=False, token_pattern=None)
+    try:
+        counts = vectorizer.fit_transform(texts).tocsr().astype(np.float32)
+    except ValueError:
+        # No chunk contains a single indexable term
+        counts = sp.csr_matrix((len(ids), 0), dtype=np.float32)
+        vectorizer.vocabulary_ = {}
+
+    rows = counts.shape[0]
+    doc_lengths = np.asarray(counts.sum(axis=1)).ravel()
+    average_length = doc_lengths.mean() if rows and doc_lengths.mean() > 0 else 1.0
+    document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log1p((rows - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+
+    # Precompute the BM25 term weight of every non-zero entry, so a query is only a sum of columns
+    tf = counts.data
+    row_of_entry = np.repeat(np.arange(rows), np.diff(counts.indptr))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths[row_of_entry] / average_length)
+    counts.data = (idf[counts.indices] * tf * (BM25_K1 + 1) / (tf + norm)).astype(np.float32)
+    weights = counts.tocsc()
+    if weights.nnz >= 2 ** 31:
+        raise ValueError(f"Lexical index with {weights.nnz} entries is too large")
+
+    weights.data.astype(np.float32).tofile(os.path.join(directory, 'lexical.data.f32'))
+    weights.indices.astype(np.int32).tofile(os.path.join(directory, 'lexical.indices.i32'))
+    weights.indptr.astype(np.int32).tofile(os.path.join(directory, 'lexical.indptr.i32'))
+    meta = {
+        'version': FORMAT_VERSION,
+        'rows': rows,
+        'k1': BM25_K1,
+        'b': BM25_B,
+        'vocabulary': {term: int(column) for term, column in vectorizer.vocabulary_.items()},
+    }
+    with open(os.path.join(directory, META_FILE + '.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(directory, META_FILE + '.tmp'), os.path.join(directory, META_FILE))
+    logger.info(f"Built lexical index: {rows} chunks, {len(meta['vocabulary'])} terms, {weights.nnz} postings")
+    return rows
+
+def load_lexical_index(directory, ids):
+    if directory is None or not os.path.exists(os.path.join(directory, META_FILE)):
+        return None
+    with open(os.path.join(directory, META_FILE), encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('version') != FORMAT_VERSION:
+        logger.warning(f"Ignoring lexical index version {meta.get('version')} in {directory}")
+        return None
+    if meta['rows'] != len(ids):
+        raise ValueError(f"Lexical index in {directory} has {meta['rows']} rows, expected {len(ids)}")
+
+    data = _map_array(os.path.join(directory, 'lexical.data.f32'), np.float32)
+    indices = _map_array(os.path.join(directory, 'lexical.indices.i32'), np.int32)
+    indptr = _map_array(os.path.join(directory, 'lexical.indptr.i32'), np.int32)
+    weights = sp.csc_matrix((data, indices, indptr), shape=(meta['rows'], len(meta['vocabulary'])), copy=False)
+    return LexicalIndex(weights, meta['vocabulary'], ids)
+
+class LexicalIndex:
+    def __init__(self, weights, vocabulary, ids):
+        self.weights = weights
+        self.vocabulary = vocabulary
+        self.ids = ids
+
+    def query_columns(self, text):
+        return sorted({self.vocabulary[token] for token in tokenize(text) if token in self.vocabulary})
+
+    def search(self, text, k, row_mask=None):
+        # Returns ([(chunk id, score)], number of query terms, number of query terms each hit matched)
+        columns = self.query_columns(text)
+        if not columns or not self.weights.shape[0]:
+            return [], 0, []
+
+        matched = self.weights[:, columns]
+        scores = np.asarray(matched.sum(axis=1)).ravel()
+        if row_mask is not None:
+            scores = np.where(row_mask, scores, 0.0)
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+        term_hits = np.diff(matched.tocsr().indptr)[candidates]
+        hits = [(int(self.ids[row]), float(scores[row])) for row in candidates]
+        return hits, len(columns), [int(count) for count in term_hits]
+
+    def row_mask(self, chunk_ids):
+        return np.isin(self.ids, np.asarray(chunk_ids, dtype=np.int64))
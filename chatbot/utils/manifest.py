@@ -0,0 +1,48 @@
+import hashlib
+import json
+import logging
+import os
+from config import MANIFEST_PATH
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+def new_manifest(directory):
+    return {'version': MANIFEST_VERSION, 'directory': str(directory), 'next_id': 0, 'files': {}}
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return None
+    try:
+        with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Error reading ingest manifest {MANIFEST_PATH}: {e}")
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def save_manifest(manifest):
+    with open(MANIFEST_PATH + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(MANIFEST_PATH + '.tmp', MANIFEST_PATH)
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Returns the fingerprint of a file and whether it differs from its manifest entry.
+# mtime and size are checked first; the content is only hashed when they changed.
+def fingerprint_file(file_path, entry):
+    stat = os.stat(file_path)
+    if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+        return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': entry['sha256']}, False
+
+    sha256 = file_digest(file_path)
+    fingerprint = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha256}
+    return fingerprint, not entry or entry['sha256'] != sha256
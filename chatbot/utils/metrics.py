@@ -0,0 +1,121 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# Request traces and the session store timing. The counters, gauges and histograms are prometheus_client
+# metrics declared next to the code they measure; under gunicorn they run in its multiprocess mode, so
+# every worker and ingest job writes its values to METRICS_PATH and /metrics aggregates them.
+
+# Per-request traces
+
+_current_trace = contextvars.ContextVar('request_trace', default=None)
+# Flask opens the session before any before_request hook can start the trace; the read is kept here
+# as (start, seconds) and becomes the first stage of the trace started next in the same context
+_pending_session_read = contextvars.ContextVar('pending_session_read', default=None)
+
+class RequestTrace:
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.stages = []
+        self.attributes = {}
+
+    def add_stage(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+    def duration(self):
+        return time.perf_counter() - self.start
+
+    def to_dict(self):
+        duration = self.duration()
+        staged = sum(seconds for _, seconds in self.stages)
+        return {
+            'name': self.name,
+            'started_at': self.started_at,
+            'pid': os.getpid(),
+            'duration_ms': round(duration * 1000, 1),
+            'stages': [{'stage': stage, 'ms': round(seconds * 1000, 1)} for stage, seconds in self.stages],
+            # Time outside every recorded stage: request parsing, JSON encoding, waiting for a thread, ...
+            'unaccounted_ms': round(max(0.0, duration - staged) * 1000, 1),
+            'attributes': self.attributes,
+        }
+
+def start_trace(name):
+    trace = RequestTrace(name)
+    pending = _pending_session_read.get()
+    if pending is not None:
+        _pending_session_read.set(None)
+        trace.start, seconds = pending
+        trace.started_at -= time.perf_counter() - trace.start
+        trace.add_stage('session_read', seconds)
+    _current_trace.set(trace)
+    return trace
+
+def current_trace():
+    return _current_trace.get()
+
+def trace_stage(stage, seconds):
+    # Record a stage on the current request's trace; a no-op outside a traced request
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+def trace_attribute(key, value):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes[key] = value
+
+def finish_trace(trace, directory, slow_seconds, sample_rate=1.0, max_files=100):
+    # Dump the trace as JSON when the request took at least slow_seconds (0 disables dumping).
+    # Only sample_rate of the slow requests are written, and at most max_files traces are kept.
+    _current_trace.set(None)
+    if not slow_seconds or trace.duration() < slow_seconds or random.random() >= sample_rate:
+        return None
+
+    data = trace.to_dict()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{int(trace.started_at * 1000)}-{os.getpid()}-{trace.name.strip('/').replace('/', '_') or 'root'}.json")
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, default=str)
+        traces = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+        for name in traces[:-max_files]:
+            os.remove(os.path.join(directory, name))
+    except OSError as e:
+        logger.warning(f"Could not write the request trace {path}: {e}")
+        return None
+    logger.info(f"Slow request {trace.name} took {data['duration_ms']:.0f}ms; trace written to {path}")
+    return path
+
+class TimedSessionInterface:
+    # Wraps a Flask session interface to time the session store reads and writes (memcached round trips)
+    def __init__(self, interface, histogram):
+        self.interface = interface
+        self.histogram = histogram
+
+    def __getattr__(self, name):
+        return getattr(self.interface, name)
+
+    def open_session(self, app, request):
+        start = time.perf_counter()
+        try:
+            return self.interface.open_session(app, request)
+        finally:
+            seconds = time.perf_counter() - start
+            self.histogram.labels(operation='read').observe(seconds)
+            _pending_session_read.set((start, seconds))
+
+    def save_session(self, app, session, response):
+        start = time.perf_counter()
+        try:
+            return self.interface.save_session(app, session, response)
+        finally:
+            seconds = time.perf_counter() - start
+            self.histogram.labels(operation='write').observe(seconds)
+            trace_stage('session_write', seconds)
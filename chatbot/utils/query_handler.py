@@ -1,136 +1,351 @@
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import PromptTemplate
-from pathlib import Path
-from langchain_core.output_parsers import StrOutputParser
-from langchain.schema.runnable import RunnableLambda, RunnableMap
-import logging
-import re
-
-# Set up logging to debug issues
-logger = logging.getLogger(__name__)
-
-llm = ChatOpenAI(model_name="gpt-4o", temperature=0)
-
-def get_query_answer(question, vector_store, chat_history, recognized_airlines):
-    # Prepare the conversation context
-    conversation_history = "\n".join(
-        [f"User: {entry['user']}\nBot: {entry['bot']}" for entry in chat_history]
-    ) if chat_history else ""
-
-    # Define the retriever
-    retriever = vector_store.as_retriever(search_kwargs={"k": 3})
-
-    # Define the function to format documents
-    def format_docs(documents):
-        formatted_docs = []
-        for doc in documents:
-            content = doc.page_content
-            formatted_docs.append(content)
-        return "\n\n".join(formatted_docs)
-
-    # Create the custom prompt template
-    prompt_template = """You are a friendly and knowledgeable airline expert specializing in policies for the following airlines: {airlines}.
-            Your task is to provide human-like, conversational answers to the user's questions, summarizing important details and making sure the response is easy to understand.
-            Ensure that you refer to the previous conversation when answering, especially if no airline is mentioned.
-            You should give clear and concise information with a warm, approachable tone.
-            The answer should be from the relevant context; do not generate information that is not present in the documents.
-            Whenever relevant, you can point to external links or additional resources.
-            Remember to clarify when needed, but do so naturally, and avoid repeating information unnecessarily.
-            If the user asks for more details, provide them in small, digestible sections, but don't overwhelm them with too much information at once.
-            Structure your response so that it feels like a real conversation rather than a factual dump.
-            After providing your answer, suggest 2-3 relevant follow-up short questions the user might ask next, under a heading 'Suggested Questions', formatted as a bullet list.
-
-            {conversation_history}
-
-            Context:
-            {context}
-
-            Question:
-            {question}
-
-            Answer:"""
-
-    custom_rag_prompt = PromptTemplate(
-        input_variables=["airlines", "conversation_history", "context", "question"],
-        template=prompt_template
-    )
-
-    rag_chain = (
-        RunnableMap({
-            "context": RunnableLambda(lambda x: retriever.get_relevant_documents(x["question"])) | format_docs,
-            "airlines": RunnableLambda(lambda x: x["airlines"]),
-            "conversation_history": RunnableLambda(lambda x: x["conversation_history"]),
-            "question": RunnableLambda(lambda x: x["question"])
-        })
-        | custom_rag_prompt
-        | llm
-        | StrOutputParser()
-    )
-
-    # Prepare inputs
-    inputs = {
-        "airlines": ', '.join(recognized_airlines),
-        "conversation_history": conversation_history,
-        "question": question
-    }
-
-    # Invoke the chain
-    try:
-        answer = rag_chain.invoke(inputs)
-    except Exception as e:
-        logger.error(f"Error invoking the chain: {e}")
-        return "I'm sorry, but I couldn't process your request at this time.", [], []
-
-    # Get the source documents
-    source_documents = retriever.get_relevant_documents(question)
-
-    if 'Suggested Questions' in answer:
-        answer_text, suggested_questions_section = answer.split('Suggested Questions', 1)
-        # Extract the quick replies from the bullet list
-        quick_replies = re.findall(r"-\s*(.*)", suggested_questions_section)
-    else:
-        answer_text = answer
-        quick_replies = []
-
-    # Serialize metadata for JSON compatibility
-    def serialize_metadata(metadata):
-        serialized_metadata = {}
-        for key, value in metadata.items():
-            if isinstance(value, Path):
-                logging.debug(f"Converting PosixPath to string: {value}")
-                serialized_metadata[key] = str(value)
-            else:
-                serialized_metadata[key] = str(value)
-        return serialized_metadata
-
-    processed_source_documents = []
-    links_section = ""
-
-    for doc in source_documents:
-        serialized_metadata = serialize_metadata(doc.metadata)
-
-        # Format the hyperlinks in markdown
-        if 'links' in serialized_metadata:
-            links = serialized_metadata['links']
-            if isinstance(links, list):
-                if not links_section:
-                    links_section = "\n\n**Additional Resources**\n\nHere are some helpful links:\n"
-                for link in links:
-                    if isinstance(link, tuple) and len(link) == 2:
-                        title, url = link
-                        links_section += f"- [{title}]({url})\n"
-                    elif isinstance(link, str):
-                        links_section += f"- {link}\n"
-                    else:
-                        logging.warning(f"Unrecognized link format: {link}")
-
-        processed_source_documents.append({
-            'content': doc.page_content,
-            'metadata': serialized_metadata
-        })
-
-    # Append links to the answer if any
-    if links_section:
-        answer += links_section
-
-    return answer_text.strip(), processed_source_documents, quick_replies
+from langchain_openai import ChatOpenAI
+from langchain_core.prompts import PromptTemplate
+from pathlib import Path
+from langchain_core.output_parsers import StrOutputParser
+from utils.utils import detect_airline
+from utils.vector_search import search_documents, search_ids, get_documents
+from prometheus_client import Counter, Histogram
+from utils.metrics import trace_stage, trace_attribute
+from utils.tokens import count_tokens
+from utils.context_builder import build_context
+from config import (
+    HYBRID_RETRIEVAL_ENABLED, HYBRID_CANDIDATES, HYBRID_RRF_K, HYBRID_EMBED_BUDGET_MS,
+    LEXICAL_SKIP_EMBEDDING, LEXICAL_CONFIDENCE_MARGIN, METRICS_ENABLED, CONTEXT_MAX_CHUNKS
+)
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+import logging
+import re
+import time
+
+# Set up logging to debug issues
+logger = logging.getLogger(__name__)
+
+llm = ChatOpenAI(model_name="gpt-4o", temperature=0)
+
+QUERY_STAGE_SECONDS = Histogram('chatbot_query_stage_seconds', 'Time spent in each stage of answering a question', ['stage'])
+QUERIES = Counter('chatbot_queries_total', 'Questions answered, by retrieval mode and answer cache use', ['retrieval', 'cached'])
+ANSWER_CACHE_LOOKUPS = Counter('chatbot_answer_cache_lookups_total', 'Semantic answer cache lookups', ['result'])
+LLM_TOKENS = Counter('chatbot_llm_tokens_total', 'Tokens sent to (prompt) and generated by (completion) the chat model', ['direction'])
+LLM_ERRORS = Counter('chatbot_llm_errors_total', 'Chat model calls that failed')
+
+# Create the custom prompt template
+prompt_template = """You are a friendly and knowledgeable airline expert specializing in policies for the following airlines: {airlines}.
+            Your task is to provide human-like, conversational answers to the user's questions, summarizing important details and making sure the response is easy to understand.
+            Ensure that you refer to the previous conversation when answering, especially if no airline is mentioned.
+            You should give clear and concise information with a warm, approachable tone.
+            The answer should be from the relevant context; do not generate information that is not present in the documents.
+            Whenever relevant, you can point to external links or additional resources.
+            Remember to clarify when needed, but do so naturally, and avoid repeating information unnecessarily.
+            If the user asks for more details, provide them in small, digestible sections, but don't overwhelm them with too much information at once.
+            Structure your response so that it feels like a real conversation rather than a factual dump.
+            After providing your answer, suggest 2-3 relevant follow-up short questions the user might ask next, under a heading 'Suggested Questions', formatted as a bullet list.
+
+            {conversation_history}
+
+            Context:
+            {context}
+
+            Question:
+            {question}
+
+            Answer:"""
+
+custom_rag_prompt = PromptTemplate(
+    input_variables=["airlines", "conversation_history", "context", "question"],
+    template=prompt_template
+)
+
+# The chain is built once; retrieval happens before it is invoked, so the retrieved
+# documents feed both the prompt context and the returned sources
+rag_chain = custom_rag_prompt | llm | StrOutputParser()
+
+def set_llm(chat_model):
+    # Swap the chat model (e.g. for offline benchmarks) and rebuild the chain around it
+    global llm, rag_chain
+    llm = chat_model
+    rag_chain = custom_rag_prompt | llm | StrOutputParser()
+
+def llm_model():
+    # Model name used to count prompt tokens
+    return getattr(llm, 'model_name', 'gpt-4o')
+
+# Serialize metadata for JSON compatibility
+def serialize_metadata(metadata):
+    serialized_metadata = {}
+    for key, value in metadata.items():
+        if isinstance(value, Path):
+            logging.debug(f"Converting PosixPath to string: {value}")
+            serialized_metadata[key] = str(value)
+        else:
+            serialized_metadata[key] = str(value)
+    return serialized_metadata
+
+def fuse_rankings(rankings, k, rrf_k=HYBRID_RRF_K):
+    # Reciprocal rank fusion: only ranks matter, so BM25 scores and L2 distances need no common scale
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return [chunk_id for chunk_id, _ in sorted(scores.items(), key=lambda item: -item[1])[:k]]
+
+def retrieve_documents(query_embedding, store, airline=None, k=3, lexical_hits=None):
+    # Search only the detected airline's chunks; without an airline, search the whole index.
+    # With BM25 hits the two rankings are fused; either side may be missing (embedding skipped or over budget).
+    selector = store.airline_selectors.get(airline) if airline else None
+    if not lexical_hits:
+        return [doc for doc, _ in search_documents(store.vector_store, query_embedding, k=k, selector=selector)]
+
+    rankings = [[chunk_id for chunk_id, _ in lexical_hits]]
+    if query_embedding is not None:
+        rankings.append([chunk_id for chunk_id, _ in search_ids(store.vector_store, query_embedding, HYBRID_CANDIDATES, selector)])
+    return get_documents(store.vector_store, fuse_rankings(rankings, k))
+
+def lexical_is_confident(hits, query_terms, matched_terms, k):
+    # The top k hits (the chunks the answer will use) all contain every query term and clearly outscore
+    # the next best chunk
+    if query_terms < 2 or len(hits) < k or any(count < query_terms for count in matched_terms[:k]):
+        return False
+    return len(hits) == k or hits[k - 1][1] >= LEXICAL_CONFIDENCE_MARGIN * hits[k][1]
+
+def lexical_search(question, store, airline, timings, k=CONTEXT_MAX_CHUNKS):
+    if not HYBRID_RETRIEVAL_ENABLED or store.lexical_index is None:
+        return [], False
+    start = time.perf_counter()
+    row_mask = store.airline_rows.get(airline) if airline else None
+    hits, query_terms, matched_terms = store.lexical_index.search(question, HYBRID_CANDIDATES, row_mask)
+    timings['lexical'] = time.perf_counter() - start
+    return hits, lexical_is_confident(hits, query_terms, matched_terms, k)
+
+def embed_within_budget(question, store, lexical_hits):
+    # Without BM25 results there is nothing to fall back on, so the embedding is always awaited
+    if not lexical_hits or HYBRID_EMBED_BUDGET_MS <= 0:
+        return store.vector_store.embedding_function.embed_query(question)
+
+    future = store.vector_store.embedding_function.submit_query(question)
+    try:
+        return future.result(timeout=HYBRID_EMBED_BUDGET_MS / 1000)
+    except FuturesTimeoutError:
+        logger.warning(f"Question embedding exceeded {HYBRID_EMBED_BUDGET_MS:.0f}ms; answering from lexical results")
+        return None
+
+def analyze_question(question, store, chat_history, timings, answer_cache=None, history_summary='', k=CONTEXT_MAX_CHUNKS):
+    # Detects the airline from the question or the conversation so far, runs the BM25 search and embeds
+    # the question. Returns (airline, query embedding or None, BM25 hits).
+    # The summary of older turns counts as the oldest turn, so an airline named early on is not forgotten.
+    if history_summary:
+        chat_history = [{'user': '', 'bot': history_summary}] + list(chat_history)
+    airline = detect_airline(question, chat_history, store.recognized_airlines)
+    logger.debug(f"Detected airline: {airline or 'none, searching all airlines'}")
+
+    # k is the number of chunks the answer is retrieved with, so the skip follows CONTEXT_MAX_CHUNKS
+    lexical_hits, confident = lexical_search(question, store, airline, timings, k)
+    # The answer cache is keyed by the question embedding, so it is only skipped when the cache is off
+    if confident and LEXICAL_SKIP_EMBEDDING and answer_cache is None:
+        logger.debug("Confident lexical match; skipping the question embedding")
+        return airline, None, lexical_hits
+
+    start = time.perf_counter()
+    query_embedding = embed_within_budget(question, store, lexical_hits)
+    timings['embed'] = time.perf_counter() - start
+    return airline, query_embedding, lexical_hits
+
+def prepare_query(question, store, chat_history, airline, query_embedding, lexical_hits, timings, history_summary=''):
+    # Retrieves the question's documents exactly once; the ones that fit the prompt's token budget
+    # feed both the prompt and the returned sources
+    start = time.perf_counter()
+    source_documents = retrieve_documents(query_embedding, store, airline, k=CONTEXT_MAX_CHUNKS, lexical_hits=lexical_hits)
+    timings['search'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    inputs, source_documents = build_context(
+        custom_rag_prompt, question, store.recognized_airlines, source_documents, chat_history, history_summary, llm_model()
+    )
+    timings['context'] = time.perf_counter() - start
+    return inputs, source_documents
+
+def lookup_cached_answer(answer_cache, query_embedding, store, airline, timings):
+    if answer_cache is None or query_embedding is None:
+        return None
+    start = time.perf_counter()
+    cached = answer_cache.lookup(query_embedding, store.generation, airline)
+    timings['cache_lookup'] = time.perf_counter() - start
+    ANSWER_CACHE_LOOKUPS.labels(result='miss' if cached is None else 'hit').inc()
+    return cached
+
+def process_answer(answer, source_documents):
+    if 'Suggested Questions' in answer:
+        answer_text, suggested_questions_section = answer.split('Suggested Questions', 1)
+        # Extract the quick replies from the bullet list
+        quick_replies = re.findall(r"-\s*(.*)", suggested_questions_section)
+    else:
+        answer_text = answer
+        quick_replies = []
+
+    processed_source_documents = []
+    links_section = ""
+
+    for doc in source_documents:
+        serialized_metadata = serialize_metadata(doc.metadata)
+
+        # Format the hyperlinks in markdown
+        if 'links' in serialized_metadata:
+            links = serialized_metadata['links']
+            if isinstance(links, list):
+                if not links_section:
+                    links_section = "\n\n**Additional Resources**\n\nHere are some helpful links:\n"
+                for link in links:
+                    if isinstance(link, tuple) and len(link) == 2:
+                        title, url = link
+                        links_section += f"- [{title}]({url})\n"
+                    elif isinstance(link, str):
+                        links_section += f"- {link}\n"
+                    else:
+                        logging.warning(f"Unrecognized link format: {link}")
+
+        processed_source_documents.append({
+            'content': doc.page_content,
+            'metadata': serialized_metadata
+        })
+
+    # Append links to the answer if any
+    if links_section:
+        answer += links_section
+
+    return answer_text.strip(), processed_source_documents, quick_replies
+
+def format_timings(timings):
+    return ', '.join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in timings.items())
+
+def retrieval_mode(query_embedding, lexical_hits):
+    if not lexical_hits:
+        return 'vector'
+    return 'lexical' if query_embedding is None else 'hybrid'
+
+def record_query_metrics(timings, store, airline, retrieval, cached, inputs=None, answer=None):
+    for stage, seconds in timings.items():
+        QUERY_STAGE_SECONDS.labels(stage=stage).observe(seconds)
+        if stage == 'first_token':
+            # Part of the llm stage, not a stage of its own
+            trace_attribute('first_token_ms', round(seconds * 1000, 1))
+        else:
+            trace_stage(stage, seconds)
+    QUERIES.labels(retrieval=retrieval, cached='true' if cached else 'false').inc()
+    trace_attribute('generation', store.generation)
+    trace_attribute('airline', airline)
+    trace_attribute('retrieval', retrieval)
+    trace_attribute('cached', cached)
+
+    # Token counts are estimated locally with tiktoken, so they also work for streamed answers
+    if METRICS_ENABLED and inputs is not None:
+        model = llm_model()
+        prompt_tokens = count_tokens(custom_rag_prompt.format(**inputs), model)
+        LLM_TOKENS.labels(direction='prompt').inc(prompt_tokens)
+        trace_attribute('prompt_tokens', prompt_tokens)
+        if answer:
+            completion_tokens = count_tokens(answer, model)
+            LLM_TOKENS.labels(direction='completion').inc(completion_tokens)
+            trace_attribute('completion_tokens', completion_tokens)
+
+def get_query_answer(question, store, chat_history, answer_cache=None, history_summary=''):
+    timings = {}
+    airline, query_embedding, lexical_hits = analyze_question(question, store, chat_history, timings, answer_cache, history_summary)
+
+    # Near-duplicates of earlier questions are answered from the cache without calling the LLM
+    cached = lookup_cached_answer(answer_cache, query_embedding, store, airline, timings)
+    if cached is not None:
+        logger.info(f"Answered from cache, timings: {format_timings(timings)}")
+        record_query_metrics(timings, store, airline, retrieval_mode(query_embedding, lexical_hits), True)
+        return cached['answer'], cached['sources'], cached['quickReplies'], timings
+
+    inputs, source_documents = prepare_query(
+        question, store, chat_history, airline, query_embedding, lexical_hits, timings, history_summary
+    )
+
+    # Invoke the chain
+    start = time.perf_counter()
+    try:
+        answer = rag_chain.invoke(inputs)
+    except Exception as e:
+        logger.error(f"Error invoking the chain: {e}")
+        LLM_ERRORS.inc()
+        record_query_metrics(timings, store, airline, retrieval_mode(query_embedding, lexical_hits), False, inputs)
+        return "I'm sorry, but I couldn't process your request at this time.", [], [], timings
+    timings['llm'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    answer_text, processed_source_documents, quick_replies = process_answer(answer, source_documents)
+    timings['post_process'] = time.perf_counter() - start
+
+    if answer_cache is not None and query_embedding is not None:
+        answer_cache.store(query_embedding, store.generation, airline, {
+            'answer': answer_text, 'quickReplies': quick_replies, 'sources': processed_source_documents
+        })
+
+    logger.info(f"Query timings: {format_timings(timings)}")
+    record_query_metrics(timings, store, airline, retrieval_mode(query_embedding, lexical_hits), False, inputs, answer)
+    return answer_text, processed_source_documents, quick_replies, timings
+
+SUGGESTED_QUESTIONS_MARKER = 'Suggested Questions'
+
+def stream_query_answer(question, store, chat_history, answer_cache=None, history_summary=''):
+    # Yields ('token', text) events as the LLM generates the answer, then one ('done', result) event.
+    # The 'Suggested Questions' section is held back from the token stream and sent as quick replies instead.
+    timings = {}
+    airline, query_embedding, lexical_hits = analyze_question(question, store, chat_history, timings, answer_cache, history_summary)
+
+    cached = lookup_cached_answer(answer_cache, query_embedding, store, airline, timings)
+    if cached is not None:
+        logger.info(f"Streamed answer from cache, timings: {format_timings(timings)}")
+        record_query_metrics(timings, store, airline, retrieval_mode(query_embedding, lexical_hits), True)
+        yield 'token', cached['answer']
+        yield 'done', dict(cached, timings=timings, cached=True)
+        return
+
+    inputs, source_documents = prepare_query(
+        question, store, chat_history, airline, query_embedding, lexical_hits, timings, history_summary
+    )
+
+    start = time.perf_counter()
+    answer = ""
+    sent = 0
+    marker_found = False
+    try:
+        for chunk in rag_chain.stream(inputs):
+            if 'first_token' not in timings:
+                timings['first_token'] = time.perf_counter() - start
+            answer += chunk
+            if marker_found:
+                continue
+
+            marker_index = answer.find(SUGGESTED_QUESTIONS_MARKER)
+            if marker_index != -1:
+                marker_found = True
+                safe = marker_index
+            else:
+                # Keep back enough characters to recognise a marker split across chunks
+                safe = len(answer) - len(SUGGESTED_QUESTIONS_MARKER) + 1
+            if safe > sent:
+                yield 'token', answer[sent:safe]
+                sent = safe
+    except Exception as e:
+        logger.error(f"Error streaming the chain: {e}")
+        LLM_ERRORS.inc()
+        record_query_metrics(timings, store, airline, retrieval_mode(query_embedding, lexical_hits), False, inputs, answer)
+        yield 'error', {'error': "I'm sorry, but I couldn't process your request at this time."}
+        return
+
+    if not marker_found and len(answer) > sent:
+        yield 'token', answer[sent:]
+    timings['llm'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    answer_text, processed_source_documents, quick_replies = process_answer(answer, source_documents)
+    timings['post_process'] = time.perf_counter() - start
+
+    result = {'answer': answer_text, 'quickReplies': quick_replies, 'sources': processed_source_documents}
+    if answer_cache is not None and query_embedding is not None:
+        answer_cache.store(query_embedding, store.generation, airline, result)
+
+    logger.info(f"Streamed query timings: {format_timings(timings)}")
+    record_query_metrics(timings, store, airline, retrieval_mode(query_embedding, lexical_hits), False, inputs, answer)
+    yield 'done', dict(result, timings=timings, cached=False)
@@ -0,0 +1,29 @@
+import logging
+import os
+import signal
+
+logger = logging.getLogger(__name__)
+
+# Set in each gunicorn worker by the post_fork hook in gunicorn.conf.py; None under the Flask dev server
+_master_pid = None
+
+def register_master(pid):
+    global _master_pid
+    _master_pid = pid
+
+def registered_master():
+    return _master_pid
+
+def request_worker_reload():
+    # Ask the gunicorn master to load the newest index generation and replace its workers gracefully.
+    # New workers are forked from the master, so they share the freshly loaded index copy-on-write
+    # instead of each loading their own copy. In-flight requests finish on the old workers.
+    if _master_pid is None:
+        return False
+    try:
+        os.kill(_master_pid, signal.SIGHUP)
+    except OSError as e:
+        logger.warning(f"Could not signal the gunicorn master {_master_pid} to reload workers: {e}")
+        return False
+    logger.info(f"Asked the gunicorn master {_master_pid} to reload workers")
+    return True
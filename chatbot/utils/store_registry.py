@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from config import FAISS_INDEX_PATH, DOCUMENTS_PATH, DOCSTORE_MAPPING_PATH, GENERATION_PATH, STORE_RELOAD_INTERVAL
+from utils.utils import get_airline_partitions
+from utils.vector_search import (
+    load_faiss_vector_store, load_legacy_vector_store, build_id_selector, load_generation_lexical_index
+)
+from prometheus_client import Counter, Gauge, Histogram
+from utils.metrics import trace_stage
+
+logger = logging.getLogger(__name__)
+
+INDEX_LOAD_SECONDS = Histogram('chatbot_index_load_seconds', 'Time to load an index generation from disk')
+INDEX_LOAD_ERRORS = Counter('chatbot_index_load_errors_total', 'Index generations that failed to load')
+# Per process: under gunicorn every live worker reports its own values, with a pid label
+INDEX_GENERATION = Gauge(
+    'chatbot_index_generation_info', 'Index generation served by this process', ['generation'], multiprocess_mode='liveall'
+)
+INDEX_VECTORS = Gauge('chatbot_index_vectors', 'Vectors in the served index generation', multiprocess_mode='liveall')
+INDEX_LOADED_AT = Gauge(
+    'chatbot_index_loaded_timestamp_seconds', 'When the served index generation was loaded', multiprocess_mode='liveall'
+)
+_info_generation = None
+
+def publish_generation(store):
+    # Info-style gauge: the generation loaded last has the value 1. The previous one is set to 0 rather than
+    # removed, as the multiprocess files keep every label set a process has written.
+    global _info_generation
+    if _info_generation is not None and _info_generation != store.generation:
+        INDEX_GENERATION.labels(generation=_info_generation).set(0)
+    INDEX_GENERATION.labels(generation=store.generation).set(1)
+    _info_generation = store.generation
+    INDEX_VECTORS.set(store.vector_store.index.ntotal)
+    INDEX_LOADED_AT.set(store.loaded_at)
+
+# One loaded index per worker process, shared read-only by every request.
+# Requests take a reference to the current generation and keep using it until they finish,
+# so swapping in a new generation never affects queries that are already in flight.
+class StoreGeneration:
+    def __init__(self, vector_store, recognized_airlines, generation):
+        self.vector_store = vector_store
+        self.recognized_airlines = recognized_airlines
+        self.generation = generation
+        self.loaded_at = time.time()
+        partitions = get_airline_partitions(vector_store)
+        # One search selector per airline, built once per generation
+        self.airline_selectors = {airline: build_id_selector(ids) for airline, ids in partitions.items()}
+        # BM25 index of the same generation, with one row mask per airline for filtered lexical searches
+        self.lexical_index = load_generation_lexical_index(generation)
+        self.airline_rows = {
+            airline: self.lexical_index.row_mask(ids) for airline, ids in partitions.items()
+        } if self.lexical_index is not None else {}
+
+        publish_generation(self)
+
+# Signatures of stores written before generation markers existed
+LEGACY_PREFIX = 'legacy-'
+
+_lock = threading.Lock()
+_current = None
+_current_signature = None
+_last_check = 0.0
+
+def _disk_signature():
+    if not os.path.exists(GENERATION_PATH):
+        # Index written before generation markers existed: fall back to the index file stats
+        stats = []
+        for path in (FAISS_INDEX_PATH, DOCUMENTS_PATH, DOCSTORE_MAPPING_PATH):
+            if not os.path.exists(path):
+                return None
+            stat = os.stat(path)
+            stats.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        return LEGACY_PREFIX + hashlib.sha1('|'.join(stats).encode()).hexdigest()[:12]
+
+    with open(GENERATION_PATH) as f:
+        return f.read().strip()
+
+def _load_generation(signature):
+    start = time.perf_counter()
+    # The generation named by the signature, not whatever the marker names by now, so the vector index,
+    # the BM25 index and the generation label always belong together
+    if signature.startswith(LEGACY_PREFIX):
+        vector_store, recognized_airlines = load_legacy_vector_store()
+    else:
+        vector_store, recognized_airlines = load_faiss_vector_store(generation=signature)
+    if vector_store is None:
+        return None
+    store = StoreGeneration(vector_store, recognized_airlines, signature)
+    seconds = time.perf_counter() - start
+    INDEX_LOAD_SECONDS.observe(seconds)
+    # A request that triggers the reload pays for it; show that in its trace
+    trace_stage('index_load', seconds)
+    logger.info(f"Loaded vector store generation {signature} ({vector_store.index.ntotal} vectors) in {seconds * 1000:.0f}ms")
+    return store
+
+def publish_current_store():
+    # Gauges are per process: a worker forked from the preloaded master serves the master's store but
+    # starts with none of its gauge values
+    if _current is not None:
+        publish_generation(_current)
+
+def get_store(force=False):
+    # force checks the disk right away instead of waiting for STORE_RELOAD_INTERVAL
+    global _current, _current_signature, _last_check
+
+    now = time.monotonic()
+    if not force and _current is not None and now - _last_check < STORE_RELOAD_INTERVAL:
+        return _current
+
+    # Only a thread with no store yet, or one that forced the check, waits for another thread's load;
+    # everyone else keeps serving the current generation until the new one is swapped in
+    if not _lock.acquire(blocking=force or _current is None):
+        return _current
+    try:
+        if not force and _current is not None and now - _last_check < STORE_RELOAD_INTERVAL:
+            return _current
+        _last_check = now
+
+        try:
+            signature = _disk_signature()
+        except OSError as e:
+            logger.error(f"Error checking the vector store on disk: {e}")
+            return _current
+
+        if signature is None or signature == _current_signature:
+            return _current
+
+        try:
+            store = _load_generation(signature)
+        except Exception as e:
+            # Keep serving the previous generation if the new files cannot be read
+            logger.error(f"Error loading vector store generation {signature}: {e}")
+            INDEX_LOAD_ERRORS.inc()
+            return _current
+
+        if store is not None:
+            _current, _current_signature = store, signature
+        return _current
+    finally:
+        _lock.release()
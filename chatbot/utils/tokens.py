@@ -0,0 +1,34 @@
+import logging
+from functools import lru_cache
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Rough characters-per-token ratio used when no tokenizer is available (e.g. offline without a tiktoken cache).
+# Deliberately low so estimates err on the side of more tokens.
+FALLBACK_CHARS_PER_TOKEN = 3
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        logger.warning(f"Tokenizer for {model} unavailable, estimating token counts: {e}")
+        return None
+
+def count_tokens(text, model):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // FALLBACK_CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text, max_tokens, model):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * FALLBACK_CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
@@ -1,12 +1,15 @@
 import logging
-from sklearn.feature_extraction.text import TfidfVectorizer
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import re
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
 def get_recognized_airlines(vector_store):
     if isinstance(vector_store, tuple):
         vector_store = vector_store[0]  # Unpack the first element
+    if hasattr(vector_store.docstore, 'airlines'):
+        # Compact stores read the airline column instead of building every document
+        return list(vector_store.docstore.airlines())
     recognized_airlines = set()
     for doc_id, doc in vector_store.docstore._dict.items():
         airline_name = doc.metadata.get('airline_name', None)
@@ -14,55 +17,64 @@ def get_recognized_airlines(vector_store):
             recognized_airlines.add(airline_name)
     return list(recognized_airlines)
 
-def split_content(text, chunk_size=500, chunk_overlap=50):
-    if not text:
-        return []
-
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
-    )
-    chunks = text_splitter.split_text(text)
-    return chunks
-
-def enrich_chunks(chunks, file_name, links, airline_name):
-    if not chunks:
-        return []
-    enriched_chunks = []
+def get_airline_partitions(vector_store):
+    # Index ids of the chunks belonging to each airline, used to restrict searches to one airline
+    if hasattr(vector_store.docstore, 'airline_partitions'):
+        return vector_store.docstore.airline_partitions()
+    partitions = {}
+    for index_id, doc_id in vector_store.index_to_docstore_id.items():
+        doc = vector_store.docstore.search(doc_id)
+        airline_name = doc.metadata.get('airline_name', None) if hasattr(doc, 'metadata') else None
+        if airline_name:
+            partitions.setdefault(airline_name, []).append(index_id)
+    return partitions
 
-    try:
-        # Fit TfidfVectorizer on all chunks
-        vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
-        tfidf_matrix = vectorizer.fit_transform(chunks)
-        feature_names = vectorizer.get_feature_names_out()
-    except Exception as e:
-        logger.error(f"Error fitting TfidfVectorizer: {e}")
-        return enriched_chunks
+@lru_cache(maxsize=None)
+def airline_name_patterns(airline_name):
+    # "AmericanAirlines" should match "American Airlines", "americanairlines" and "American"
+    words = re.findall(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+', airline_name) or [airline_name]
+    variants = {' '.join(words), ''.join(words)}
+    if len(words) > 1:
+        variants.add(words[0])
+    return tuple(re.compile(r'\b' + re.escape(variant) + r'\b', re.IGNORECASE) for variant in variants)
 
-    for i, chunk in enumerate(chunks):
-        try:
-            # Get the TF-IDF vector for the chunk
-            tfidf_vector = tfidf_matrix[i]
-            # Get top keywords based on TF-IDF score
-            sorted_indices = tfidf_vector.toarray()[0].argsort()[::-1]
-            top_n = 5
-            top_indices = sorted_indices[:top_n]
-            keywords = [feature_names[index] for index in top_indices if tfidf_vector[0, index] > 0]
+def find_airlines(text, recognized_airlines):
+    if not text:
+        return set()
+    return {
+        airline for airline in recognized_airlines
+        if any(pattern.search(text) for pattern in airline_name_patterns(airline))
+    }
 
-            enriched_chunks.append({
-                'text': chunk,
-                'metadata': {
-                    'file_name': file_name,
-                    'keywords': keywords,
-                    'links': links,
-                    'airline_name': airline_name
-                }
-            })
-        except Exception as e:
-            logger.error(f"Error enriching chunk: {e}")
+def detect_airline(question, chat_history, recognized_airlines):
+    # The question wins; otherwise follow-ups inherit the airline of the most recent turn that names one.
+    # When several airlines are mentioned the question is comparative and nothing is detected.
+    mentioned = find_airlines(question, recognized_airlines)
+    for entry in reversed(chat_history or []):
+        if mentioned:
+            break
+        mentioned = find_airlines(entry.get('user'), recognized_airlines) or find_airlines(entry.get('bot'), recognized_airlines)
+    if len(mentioned) == 1:
+        return next(iter(mentioned))
+    return None
 
-    return enriched_chunks
+def enrich_chunks(chunks, file_name, links, airline_name):
+    # chunks come from utils.chunking. Keywords are added per batch by utils.keywords, with frequencies
+    # over the whole corpus.
+    enriched = []
+    for chunk in chunks:
+        metadata = {
+            'file_name': file_name,
+            'keywords': [],
+            'links': links,
+            'airline_name': airline_name
+        }
+        if chunk.get('title'):
+            metadata['section'] = chunk['title']
+        if chunk.get('page'):
+            metadata['page'] = chunk['page']
+        enriched.append({'text': chunk['text'], 'metadata': metadata})
+    return enriched
 
 def process_chat_history(chat_history):
     processed_chat_history = []
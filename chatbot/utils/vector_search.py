@@ -1,69 +1,327 @@
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.schema import Document
-from langchain_community.docstore import InMemoryDocstore
-import faiss
-import os
-import pickle
-from config import FAISS_INDEX_PATH, DOCUMENTS_PATH, DOCSTORE_MAPPING_PATH, STORAGE_PATH
-import logging
-from utils.utils import get_recognized_airlines
-
-logger = logging.getLogger(__name__)
-
-def setup_faiss_vector_store(documents):
-    embedding_model = OpenAIEmbeddings(model="text-embedding-ada-002")
-    
-    # Convert documents into LangChain-compatible format with airline name and other metadata
-    langchain_documents = [
-        Document(page_content=doc['text'], metadata=doc['metadata'])
-        for doc in documents
-    ]
-    
-    # Create the FAISS vector store
-    vector_store = FAISS.from_documents(langchain_documents, embedding_model)
-    
-    # Save the vector store, documents, and index_to_docstore_id to disk
-    save_faiss_vector_store(vector_store)
-    
-    return vector_store
-
-def save_faiss_vector_store(vector_store):
-    if not os.path.exists(STORAGE_PATH):
-        os.makedirs(STORAGE_PATH) 
-    
-    # Save FAISS index to disk
-    faiss.write_index(vector_store.index, FAISS_INDEX_PATH)
-    
-    # Save the docstore to disk
-    with open(DOCUMENTS_PATH, 'wb') as f:
-        # Save the internal dictionary of the docstore
-        pickle.dump(vector_store.docstore._dict, f)
-
-    # Save the index_to_docstore_id mapping to disk
-    with open(DOCSTORE_MAPPING_PATH, 'wb') as f:
-        pickle.dump(vector_store.index_to_docstore_id, f)
-
-def load_faiss_vector_store():
-    if not os.path.exists(FAISS_INDEX_PATH) or not os.path.exists(DOCUMENTS_PATH) or not os.path.exists(DOCSTORE_MAPPING_PATH):
-        return None, []
-
-    # Load FAISS index from disk
-    faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-
-    # Load the index_to_docstore_id mapping
-    with open(DOCSTORE_MAPPING_PATH, 'rb') as f:
-        index_to_docstore_id = pickle.load(f)
-
-    # Load the docstore data
-    with open(DOCUMENTS_PATH, 'rb') as f:
-        docstore_dict = pickle.load(f)
-
-    # Reconstruct the docstore
-    docstore = InMemoryDocstore(docstore_dict)
-
-    # Recreate the FAISS vector store
-    embedding_function = OpenAIEmbeddings(model="text-embedding-ada-002")
-    vector_store = FAISS(embedding_function, index=faiss_index, docstore=docstore, index_to_docstore_id=index_to_docstore_id)
-    recognized_airlines = get_recognized_airlines(vector_store)
-    return vector_store, recognized_airlines
+from langchain_community.vectorstores import FAISS
+from langchain.schema import Document
+from langchain_community.docstore import InMemoryDocstore
+import faiss
+import math
+import numpy as np
+import os
+import pickle
+import shutil
+import time
+import uuid
+from config import (
+    FAISS_INDEX_PATH, DOCUMENTS_PATH, DOCSTORE_MAPPING_PATH, GENERATION_PATH, GENERATIONS_PATH,
+    STORE_KEEP_GENERATIONS, VECTOR_INDEX_TYPE, VECTOR_INDEX_NLIST, VECTOR_INDEX_NPROBE, VECTOR_INDEX_PQ_M,
+    VECTOR_INDEX_HNSW_M, VECTOR_INDEX_EF_CONSTRUCTION, VECTOR_INDEX_EF_SEARCH, VECTOR_INDEX_TRAIN_SAMPLE,
+    VECTOR_INDEX_MIN_TRAIN
+)
+import logging
+from utils.compact_store import (
+    CompactDocstore, ChunkIdMap, is_compact_store, iter_sorted_documents, read_compact_index, write_compact_store
+)
+from utils.batching import MicroBatcher
+from utils.embeddings import CachedEmbeddings
+from utils.lexical_index import build_lexical_index, load_lexical_index
+from utils.utils import get_recognized_airlines
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ('flat', 'sq', 'ivf', 'ivfsq', 'ivfpq', 'hnsw')
+TRAINED_INDEX_TYPES = ('ivf', 'ivfsq', 'ivfpq')
+# Types that cannot take vectors before they are trained: the IVF types and the scalar quantizer's value ranges
+NEEDS_TRAINING = TRAINED_INDEX_TYPES + ('sq',)
+
+def resolve_index_type(index_type, vector_count):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown vector index type {index_type!r}; expected one of {', '.join(INDEX_TYPES)}")
+    # Clustering needs enough vectors per list; small corpora are searched exhaustively instead
+    if index_type in TRAINED_INDEX_TYPES and vector_count < VECTOR_INDEX_MIN_TRAIN:
+        return 'flat'
+    return index_type
+
+def index_factory_string(index_type, dimension, vector_count, nlist=None, pq_m=None, hnsw_m=None):
+    # Every index is wrapped in IDMap2 so vectors keep their chunk ids and can be removed on re-ingest
+    nlist = nlist or VECTOR_INDEX_NLIST or int(4 * math.sqrt(vector_count))
+    # k-means wants at least 39 training vectors per list
+    nlist = max(1, min(nlist, vector_count // 39))
+    pq_m = pq_m or VECTOR_INDEX_PQ_M or max(1, dimension // 16)
+    if index_type == 'ivfpq' and dimension % pq_m:
+        raise ValueError(f"PQ subquantizer count {pq_m} must divide the embedding dimension {dimension}")
+
+    descriptions = {
+        'flat': "Flat",
+        'sq': "SQ8",
+        'ivf': f"IVF{nlist},Flat",
+        'ivfsq': f"IVF{nlist},SQ8",
+        'ivfpq': f"IVF{nlist},PQ{pq_m}x8",
+        'hnsw': f"HNSW{hnsw_m or VECTOR_INDEX_HNSW_M}",
+    }
+    return "IDMap2," + descriptions[index_type]
+
+def create_index(dimension, training_vectors=None, index_type=None, **options):
+    # Builds an empty index of the configured type, trained on a sample of training_vectors when it needs training
+    vector_count = 0 if training_vectors is None else len(training_vectors)
+    index_type = resolve_index_type(index_type or VECTOR_INDEX_TYPE, vector_count)
+    index = faiss.index_factory(dimension, index_factory_string(index_type, dimension, vector_count, **options))
+
+    inner = faiss.downcast_index(index.index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efConstruction = VECTOR_INDEX_EF_CONSTRUCTION
+
+    if not index.is_trained:
+        if not vector_count:
+            raise ValueError(f"A {index_type} index needs training vectors")
+        sample = np.ascontiguousarray(training_vectors, dtype=np.float32)
+        if vector_count > VECTOR_INDEX_TRAIN_SAMPLE:
+            rows = np.random.default_rng(0).choice(vector_count, VECTOR_INDEX_TRAIN_SAMPLE, replace=False)
+            sample = sample[np.sort(rows)]
+        start = time.perf_counter()
+        index.train(sample)
+        logger.info(f"Trained {index_type} index on {len(sample)} vectors in {time.perf_counter() - start:.2f}s")
+    return index
+
+def index_kind(index):
+    inner = faiss.downcast_index(index.index) if hasattr(index, 'id_map') else faiss.downcast_index(index)
+    # Subclasses first: IndexIVFFlat and IndexIVFScalarQuantizer derive from IndexIVF, IndexFlatL2 from IndexFlat
+    for index_class, kind in (
+        (faiss.IndexIVFPQ, 'ivfpq'), (faiss.IndexIVFScalarQuantizer, 'ivfsq'), (faiss.IndexIVFFlat, 'ivf'),
+        (faiss.IndexHNSW, 'hnsw'), (faiss.IndexScalarQuantizer, 'sq'), (faiss.IndexFlat, 'flat'),
+    ):
+        if isinstance(inner, index_class):
+            return kind
+    return type(inner).__name__
+
+def matches_configured_index(index):
+    return index_kind(index) == resolve_index_type(VECTOR_INDEX_TYPE, index.ntotal)
+
+def search_parameters(index, selector=None, nprobe=None, ef_search=None):
+    # Parameters passed to a search replace the index defaults, so nprobe / efSearch must be set on every call
+    inner = faiss.downcast_index(index.index) if hasattr(index, 'id_map') else index
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe or VECTOR_INDEX_NPROBE)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search or VECTOR_INDEX_EF_SEARCH)
+    return faiss.SearchParameters(sel=selector) if selector is not None else None
+
+def rebuild_index_without(index, ids):
+    # HNSW graphs cannot delete vectors; rebuild the graph from the vectors that remain
+    inner = faiss.downcast_index(index.index)
+    index_ids = faiss.vector_to_array(index.id_map)
+    keep = ~np.isin(index_ids, np.asarray(ids, dtype=np.int64))
+    vectors = inner.reconstruct_n(0, inner.ntotal)[keep]
+    rebuilt = create_index(index.d, vectors, index_kind(index))
+    rebuilt.add_with_ids(vectors, index_ids[keep])
+    return rebuilt
+
+def create_streaming_vector_store(dimension):
+    # Vectors are stored under their chunk ids so they can be removed again on re-ingest. Ingestion adds them
+    # batch by batch, so types that must be trained on the corpus start out as a flat index and are converted
+    # by train_configured_index once every vector is in.
+    index_type = 'flat' if VECTOR_INDEX_TYPE in NEEDS_TRAINING else VECTOR_INDEX_TYPE
+    index = create_index(dimension, index_type=index_type)
+    return FAISS(CachedEmbeddings(), index=index, docstore=InMemoryDocstore({}), index_to_docstore_id={})
+
+def train_configured_index(vector_store):
+    # Replaces a flat index built by a streaming ingest with the configured type, trained on its vectors
+    index = vector_store.index
+    index_type = resolve_index_type(VECTOR_INDEX_TYPE, index.ntotal)
+    if index_type == 'flat' or index_kind(index) != 'flat':
+        return False
+
+    start = time.perf_counter()
+    inner = faiss.downcast_index(index.index)
+    # A view of the flat index's vectors, so they are not copied for training
+    vectors = faiss.rev_swig_ptr(inner.get_xb(), inner.ntotal * inner.d).reshape(inner.ntotal, inner.d)
+    index_ids = faiss.vector_to_array(index.id_map)
+    trained = create_index(index.d, vectors, index_type)
+    for offset in range(0, len(index_ids), 65536):
+        trained.add_with_ids(vectors[offset:offset + 65536], index_ids[offset:offset + 65536])
+    vector_store.index = trained
+    logger.info(f"Converted the streamed index to {index_type} ({len(index_ids)} vectors) in {time.perf_counter() - start:.2f}s")
+    return True
+
+def add_documents_with_ids(vector_store, documents, embeddings, ids):
+    # The vectors were already computed during ingestion; add them to the index in one bulk call
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if embeddings.shape[0] != len(documents) or len(ids) != len(documents):
+        raise ValueError(f"Cannot add {len(documents)} documents with {embeddings.shape[0]} embeddings and {len(ids)} ids")
+    if not documents:
+        return
+
+    vector_store.index.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+
+    # Convert documents into LangChain-compatible format with airline name and other metadata
+    docstore_ids = [str(chunk_id) for chunk_id in ids]
+    vector_store.docstore.add({
+        docstore_id: Document(page_content=doc['text'], metadata=doc['metadata'])
+        for docstore_id, doc in zip(docstore_ids, documents)
+    })
+    vector_store.index_to_docstore_id.update(zip(ids, docstore_ids))
+
+def remove_documents_by_ids(vector_store, ids):
+    ids = [chunk_id for chunk_id in ids if chunk_id in vector_store.index_to_docstore_id]
+    if not ids:
+        return 0
+
+    if index_kind(vector_store.index) == 'hnsw':
+        vector_store.index = rebuild_index_without(vector_store.index, ids)
+    else:
+        vector_store.index.remove_ids(np.asarray(ids, dtype=np.int64))
+    vector_store.docstore.delete([vector_store.index_to_docstore_id.pop(chunk_id) for chunk_id in ids])
+    return len(ids)
+
+def supports_incremental_updates(vector_store):
+    return isinstance(vector_store.index, faiss.IndexIDMap2)
+
+def build_id_selector(ids):
+    return faiss.IDSelectorBatch(np.asarray(ids, dtype=np.int64))
+
+def search_batch(items):
+    # items: (index, selector, k, query embedding) sharing one index, selector and k; one search over the
+    # query matrix answers all of them
+    index, selector, k, _ = items[0]
+    queries = np.asarray([query_embedding for _, _, _, query_embedding in items], dtype=np.float32)
+    distances, labels = index.search(queries, k, params=search_parameters(index, selector))
+    return [
+        [(int(label), float(distance)) for distance, label in zip(row_distances, row_labels) if label != -1]
+        for row_distances, row_labels in zip(distances, labels)
+    ]
+
+# Searches of concurrent requests against the same index and airline run as one batched search
+search_batcher = MicroBatcher('search', search_batch, concurrency=2)
+
+def search_ids(vector_store, query_embedding, k=3, selector=None):
+    # A selector restricts the search to one partition (e.g. one airline) before distances are computed
+    index = vector_store.index
+    return search_batcher.call((index, selector, k, query_embedding), key=(id(index), id(selector), k))
+
+def get_documents(vector_store, ids):
+    documents = []
+    for chunk_id in ids:
+        doc = vector_store.docstore.search(vector_store.index_to_docstore_id[chunk_id])
+        if isinstance(doc, Document):
+            documents.append(doc)
+    return documents
+
+def search_documents(vector_store, query_embedding, k=3, selector=None):
+    results = []
+    for chunk_id, distance in search_ids(vector_store, query_embedding, k, selector):
+        doc = vector_store.docstore.search(vector_store.index_to_docstore_id[chunk_id])
+        if isinstance(doc, Document):
+            results.append((doc, distance))
+    return results
+
+def save_faiss_vector_store(vector_store):
+    # Every save writes a complete new generation directory; the generation marker is switched to it last,
+    # so readers never see a half-written index and workers still on the previous generation keep working
+    generation = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    directory = os.path.join(GENERATIONS_PATH, generation)
+    rows = write_vector_store(vector_store, directory)
+
+    # The BM25 index covers the whole corpus, so it is rebuilt from the written rows on every save.
+    # Each chunk's section title and TF-IDF keywords are indexed along with its text.
+    docstore = CompactDocstore(directory)
+    documents = (docstore.document_at(row) for row in range(len(docstore.ids)))
+    build_lexical_index(
+        directory,
+        (' '.join([doc.page_content, doc.metadata.get('section', '')] + doc.metadata.get('keywords', [])) for doc in documents),
+        docstore.ids
+    )
+
+    with open(GENERATION_PATH + '.tmp', 'w') as f:
+        f.write(generation)
+    os.replace(GENERATION_PATH + '.tmp', GENERATION_PATH)
+    logger.info(f"Saved vector store generation {generation} ({rows} chunks)")
+
+    remove_old_generations(generation)
+    return generation
+
+def write_vector_store(vector_store, directory):
+    return write_compact_store(
+        directory, vector_store.index, iter_sorted_documents(vector_store.index_to_docstore_id, vector_store.docstore)
+    )
+
+def load_vector_store_at(directory, writable=False):
+    faiss_index = read_compact_index(directory, writable=writable)
+    docstore = CompactDocstore(directory)
+    return FAISS(CachedEmbeddings(), index=faiss_index, docstore=docstore, index_to_docstore_id=ChunkIdMap(docstore.ids))
+
+def remove_old_generations(current):
+    # Keep a few previous generations for workers that have not reloaded yet; their open mappings
+    # stay valid after the files are deleted, so only the disk space is reclaimed
+    generations = sorted(
+        (name for name in os.listdir(GENERATIONS_PATH) if name != current),
+        key=lambda name: os.path.getmtime(os.path.join(GENERATIONS_PATH, name))
+    )
+    for name in generations[:max(0, len(generations) - STORE_KEEP_GENERATIONS + 1)]:
+        shutil.rmtree(os.path.join(GENERATIONS_PATH, name), ignore_errors=True)
+
+    # Pickle files from before the compact format are superseded by the first generation written
+    for path in (FAISS_INDEX_PATH, DOCUMENTS_PATH, DOCSTORE_MAPPING_PATH):
+        if os.path.exists(path):
+            os.remove(path)
+
+def generation_path(generation):
+    directory = os.path.join(GENERATIONS_PATH, generation)
+    return directory if is_compact_store(directory) else None
+
+def current_generation():
+    if not os.path.exists(GENERATION_PATH):
+        return None
+    with open(GENERATION_PATH) as f:
+        return f.read().strip()
+
+def current_generation_path():
+    generation = current_generation()
+    return generation_path(generation) if generation else None
+
+def load_generation_lexical_index(generation):
+    # None for legacy stores, which are searched by vector only
+    directory = generation_path(generation)
+    if directory is None:
+        return None
+    return load_lexical_index(directory, CompactDocstore(directory).ids)
+
+def load_faiss_vector_store(writable=False, generation=None):
+    # Serving workers map the index read-only; pass writable=True to load an index that will be updated.
+    # generation loads that generation directory rather than the one the marker names now, for callers that
+    # already read the marker and label what they load with it.
+    if generation is not None:
+        directory = generation_path(generation)
+        if directory is None:
+            raise FileNotFoundError(f"Index generation {generation} is not in {GENERATIONS_PATH}")
+    else:
+        directory = current_generation_path()
+    if directory is None:
+        return load_legacy_vector_store()
+
+    vector_store = load_vector_store_at(directory, writable=writable)
+    recognized_airlines = get_recognized_airlines(vector_store)
+    return vector_store, recognized_airlines
+
+def load_legacy_vector_store():
+    # Indexes saved before the compact format: pickled docstore and id mapping next to the FAISS index.
+    # The next ingest writes a compact generation and removes these files.
+    if not os.path.exists(FAISS_INDEX_PATH) or not os.path.exists(DOCUMENTS_PATH) or not os.path.exists(DOCSTORE_MAPPING_PATH):
+        return None, []
+    logger.warning("Loading a pickled vector store; re-run ingestion to convert it to the compact format")
+
+    # Load FAISS index from disk
+    faiss_index = faiss.read_index(FAISS_INDEX_PATH)
+
+    # Load the index_to_docstore_id mapping
+    with open(DOCSTORE_MAPPING_PATH, 'rb') as f:
+        index_to_docstore_id = pickle.load(f)
+
+    # Load the docstore data
+    with open(DOCUMENTS_PATH, 'rb') as f:
+        docstore_dict = pickle.load(f)
+
+    # Reconstruct the docstore
+    docstore = InMemoryDocstore(docstore_dict)
+
+    # Recreate the FAISS vector store
+    embedding_function = CachedEmbeddings()
+    vector_store = FAISS(embedding_function, index=faiss_index, docstore=docstore, index_to_docstore_id=index_to_docstore_id)
+    recognized_airlines = get_recognized_airlines(vector_store)
+    return vector_store, recognized_airlines